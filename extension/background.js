@@ -1,6 +1,13 @@
 const SERVER_URL = 'http://localhost:3000';
+// How long the server may hold a /check-status long-poll open, and how many
+// queued requests it may hand us per round trip.
+const LONG_POLL_SECONDS = 25;
+const MAX_REQUESTS_PER_POLL = 4;
 
-// Create an alarm to periodically check the server.
+let polling = false;
+
+// The alarm is a watchdog: it restarts the long-poll loop if the service
+// worker was suspended, and is the only trigger for servers without long-poll.
 chrome.alarms.create('checkServerStatus', {
     periodInMinutes: 0.1 // Run every 6 seconds (0.1 minutes)
 });
@@ -8,26 +15,43 @@ chrome.alarms.create('checkServerStatus', {
 // Add a listener for the alarm.
 chrome.alarms.onAlarm.addListener((alarm) => {
     if (alarm.name === 'checkServerStatus') {
-        checkForScreenshotRequest();
+        pollForScreenshotRequests();
     }
 });
 
-async function checkForScreenshotRequest() {
+async function pollForScreenshotRequests() {
+    if (polling) {
+        return;
+    }
+    polling = true;
     try {
-        const response = await fetch(`${SERVER_URL}/check-status`);
-        const data = await response.json();
-
-        // Check if a request exists.
-        if (data.request) {
-            console.log(`Server requested a screenshot for ID: ${data.request.id}`);
-            // If a request is found, trigger the screenshot process.
-            await captureAndUploadScreenshot(data.request.id);
+        while (true) {
+            const response = await fetch(
+                `${SERVER_URL}/check-status?wait=${LONG_POLL_SECONDS}&max=${MAX_REQUESTS_PER_POLL}`
+            );
+            const data = await response.json();
+            const requests = data.requests || (data.request ? [data.request] : []);
+
+            for (const request of requests) {
+                console.log(`Server requested a screenshot for ID: ${request.id}`);
+                await captureAndUploadScreenshot(request.id);
+            }
+
+            // Older servers answer immediately and don't echo "wait";
+            // fall back to the alarm cadence instead of spinning.
+            if (data.wait === undefined && requests.length === 0) {
+                break;
+            }
         }
     } catch (error) {
         console.error('Error polling server:', error);
+    } finally {
+        polling = false;
     }
 }
 
+pollForScreenshotRequests();
+
 async function captureAndUploadScreenshot(id) {
     try {
         // We'll capture the entire visible area of the current window.
@@ -40,17 +64,19 @@ async function captureAndUploadScreenshot(id) {
             return;
         }
         
-        // Upload the screenshot to the server.
-        await fetch(`${SERVER_URL}/upload-screenshot`, {
+        // Upload the raw PNG bytes; the server streams them straight to disk
+        // instead of parsing and base64-decoding a JSON body.
+        const png = await (await fetch(screenshotDataUrl)).blob();
+        const response = await fetch(`${SERVER_URL}/upload-screenshot?id=${encodeURIComponent(id)}`, {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Content-Type': 'image/png'
             },
-            body: JSON.stringify({
-                id: id,
-                screenshotData: screenshotDataUrl
-            })
+            body: png
         });
+        if (!response.ok) {
+            throw new Error(`Upload failed with status ${response.status}`);
+        }
 
         console.log(`Screenshot for ID: ${id} uploaded successfully.`);
 
@@ -1,10 +1,23 @@
 let ws;
 let reconnectAttempts = 0;
 const maxReconnectAttempts = 10;
+// Set once the server acknowledges binary screenshot frames in its hello
+let binaryFrames = false;
+
+// Chrome allows two captureVisibleTab calls per second, so batch captures are
+// spaced at least this far apart
+const MIN_CAPTURE_INTERVAL_MS = 550;
+// Time a tab gets to paint after it is brought to the front for a batch
+const TAB_SETTLE_MS = 150;
+let lastCaptureAt = 0;
+// Captures run one at a time: a batch switches tabs, and a single capture
+// in between would grab whichever tab it left in front
+let captureChain = Promise.resolve();
 
 function setupWebsocket() {
   console.log("Setting up WebSocket connection...");
   ws = new WebSocket("ws://localhost:8765");
+  binaryFrames = false;
   
   ws.onopen = () => {
     console.log("WebSocket connected to MCP server");
@@ -12,29 +25,39 @@ function setupWebsocket() {
     
     // Send a test message to confirm connection
     ws.send(JSON.stringify({ action: 'test', message: 'Extension connected successfully' }));
+
+    // Offer binary screenshot frames; older servers ignore this and we keep sending JSON
+    ws.send(JSON.stringify({ action: 'hello', capabilities: ['binary_frames', 'batch_capture'] }));
+    reportFocusedTab();
   };
 
   ws.onmessage = (event) => {
     console.log("WebSocket message received:", event.data);
     try {
       const message = JSON.parse(event.data);
-      if (message.action === "capture") {
+      if (message.action === "hello") {
+        binaryFrames = !!message.binaryFrames;
+        console.log("Server hello received, binary frames:", binaryFrames);
+      } else if (message.action === "capture") {
         console.log("Capture request received via WebSocket");
         
         // Test if we have the right permissions first
         if (typeof chrome === 'undefined') {
           console.error("Chrome API not available");
-          sendError("Chrome API not available");
+          sendError("Chrome API not available", message.id);
           return;
         }
         
         if (!chrome.tabs || !chrome.tabs.captureVisibleTab) {
           console.error("chrome.tabs.captureVisibleTab not available");
-          sendError("Screenshot API not available");
+          sendError("Screenshot API not available", message.id);
           return;
         }
         
-        captureScreenshot();
+        runExclusive(() => new Promise((resolve) => captureScreenshot(message.id, resolve)));
+      } else if (message.action === "capture_batch") {
+        console.log(`Batch capture request received for ${(message.targets || []).length} targets`);
+        runExclusive(() => captureBatch(message.id, message.targets || []));
       }
     } catch (error) {
       console.error("Error parsing WebSocket message:", error);
@@ -59,52 +82,206 @@ function setupWebsocket() {
   };
 }
 
-function sendError(errorMessage) {
+// "id" echoes the capture command's id so the server can match the reply
+function sendError(errorMessage, id) {
   console.error("Sending error:", errorMessage);
   if (ws && ws.readyState === WebSocket.OPEN) {
     ws.send(JSON.stringify({
       action: 'screenshot',
+      id: id,
       error: errorMessage
     }));
   }
 }
 
-function captureScreenshot() {
+// Binary frame layout: [4-byte big-endian header length][JSON header][raw image bytes]
+function encodeFrame(header, imageBytes) {
+  const headerBytes = new TextEncoder().encode(JSON.stringify(header));
+  const frame = new Uint8Array(4 + headerBytes.length + imageBytes.length);
+  new DataView(frame.buffer).setUint32(0, headerBytes.length);
+  frame.set(headerBytes, 4);
+  frame.set(imageBytes, 4 + headerBytes.length);
+  return frame.buffer;
+}
+
+function dataUrlToBytes(dataUrl) {
+  const binary = atob(dataUrl.split(',', 2)[1]);
+  const bytes = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i++) {
+    bytes[i] = binary.charCodeAt(i);
+  }
+  return bytes;
+}
+
+function sendBinaryScreenshot(header, dataUrl) {
+  ws.send(encodeFrame(header, dataUrlToBytes(dataUrl)));
+}
+
+function captureScreenshot(id, done = () => {}) {
   console.log("Starting screenshot capture...");
   
   try {
-    chrome.tabs.captureVisibleTab(null, { format: "png" }, (dataUrl) => {
-      console.log("captureVisibleTab callback called");
+    // Capture the focused window's active tab and name it in the reply, so
+    // the server files the frame under the tab it actually shows
+    chrome.tabs.query({ active: true, lastFocusedWindow: true }, (tabs) => {
+      const tab = (tabs || [])[0];
+      const tabInfo = tab ? tabDetails(tab) : {};
+      chrome.tabs.captureVisibleTab(tab ? tab.windowId : null, { format: "png" }, (dataUrl) => {
+        console.log("captureVisibleTab callback called");
+        lastCaptureAt = Date.now();
+        done();
       
-      if (chrome.runtime.lastError) {
-        console.error("Screenshot capture error:", chrome.runtime.lastError);
-        sendError(chrome.runtime.lastError.message);
-        return;
-      }
+        if (chrome.runtime.lastError) {
+          console.error("Screenshot capture error:", chrome.runtime.lastError);
+          sendError(chrome.runtime.lastError.message, id);
+          return;
+        }
       
-      if (!dataUrl) {
-        console.error("No data URL returned");
-        sendError("No screenshot data received");
-        return;
-      }
+        if (!dataUrl) {
+          console.error("No data URL returned");
+          sendError("No screenshot data received", id);
+          return;
+        }
       
-      console.log("Screenshot captured successfully, data URL length:", dataUrl.length);
+        console.log("Screenshot captured successfully, data URL length:", dataUrl.length);
       
-      if (ws && ws.readyState === WebSocket.OPEN) {
-        console.log("Sending screenshot via WebSocket");
-        ws.send(JSON.stringify({
-          action: 'screenshot',
-          dataUrl: dataUrl
-        }));
-        console.log("Screenshot sent successfully");
-      } else {
-        console.error("WebSocket not ready when trying to send screenshot, state:", ws ? ws.readyState : 'no connection');
-        sendError("WebSocket connection lost");
-      }
+        if (ws && ws.readyState === WebSocket.OPEN) {
+          console.log("Sending screenshot via WebSocket");
+          if (binaryFrames) {
+            sendBinaryScreenshot({ action: 'screenshot', id: id, mime: 'image/png', ...tabInfo }, dataUrl);
+          } else {
+            ws.send(JSON.stringify({
+              action: 'screenshot',
+              id: id,
+              dataUrl: dataUrl,
+              ...tabInfo
+            }));
+          }
+          console.log("Screenshot sent successfully");
+        } else {
+          console.error("WebSocket not ready when trying to send screenshot, state:", ws ? ws.readyState : 'no connection');
+          sendError("WebSocket connection lost", id);
+        }
+      });
     });
   } catch (error) {
     console.error("Exception in captureScreenshot:", error);
-    sendError("Exception during capture: " + error.message);
+    sendError("Exception during capture: " + error.message, id);
+    done();
+  }
+}
+
+function tabDetails(tab) {
+  return { tabId: tab.id, windowId: tab.windowId, tabUrl: tab.url, tabTitle: tab.title };
+}
+
+// Tell the server which tab is in front, so it doesn't serve a frame cached
+// for the previous tab after a switch
+function reportActiveTab(tab) {
+  if (tab && ws && ws.readyState === WebSocket.OPEN) {
+    ws.send(JSON.stringify({ action: 'tab', ...tabDetails(tab) }));
+  }
+}
+
+function reportFocusedTab() {
+  chrome.tabs.query({ active: true, lastFocusedWindow: true }, (tabs) => reportActiveTab((tabs || [])[0]));
+}
+
+function runExclusive(job) {
+  const run = captureChain.then(job);
+  captureChain = run.catch((error) => console.error("Capture job failed:", error));
+  return run;
+}
+
+function sleep(ms) {
+  return new Promise((resolve) => setTimeout(resolve, ms));
+}
+
+// Targets: {tabId}, {windowId} (its active tab) or {url} (every tab whose URL
+// contains it). Returns one entry per tab to capture, or an error per target.
+async function resolveBatchTargets(targets) {
+  const resolved = [];
+  let allTabs = null;
+  for (let target = 0; target < targets.length; target++) {
+    const spec = targets[target] || {};
+    try {
+      if (spec.tabId !== undefined) {
+        resolved.push({ target, tab: await chrome.tabs.get(spec.tabId) });
+      } else if (spec.windowId !== undefined) {
+        const [tab] = await chrome.tabs.query({ active: true, windowId: spec.windowId });
+        resolved.push(tab ? { target, tab } : { target, error: `No window with id ${spec.windowId}` });
+      } else if (spec.url !== undefined) {
+        allTabs = allTabs || await chrome.tabs.query({});
+        const matches = allTabs.filter((tab) => tab.url && tab.url.includes(spec.url));
+        if (matches.length === 0) {
+          resolved.push({ target, error: `No tab with a URL containing ${spec.url}` });
+        }
+        matches.forEach((tab) => resolved.push({ target, tab }));
+      } else {
+        resolved.push({ target, error: "Target needs a tabId, windowId or url" });
+      }
+    } catch (error) {
+      resolved.push({ target, error: error.message });
+    }
+  }
+  return resolved;
+}
+
+function sendBatchResult(header, dataUrl) {
+  if (!ws || ws.readyState !== WebSocket.OPEN) {
+    throw new Error("WebSocket connection lost");
+  }
+  if (dataUrl && binaryFrames) {
+    sendBinaryScreenshot({ ...header, mime: 'image/png' }, dataUrl);
+  } else {
+    ws.send(JSON.stringify(dataUrl ? { ...header, dataUrl: dataUrl } : header));
+  }
+}
+
+// Captures each target in turn and sends every result as soon as it is taken,
+// so the server can stream the first image before the last one is captured.
+// Tabs are brought to the front to be captured (captureVisibleTab only sees
+// the visible tab); each window's original tab is restored afterwards.
+async function captureBatch(id, targets) {
+  const restore = new Map(); // windowId -> tab that was active before the batch
+  let index = 0;
+  try {
+    for (const item of await resolveBatchTargets(targets)) {
+      const header = { action: 'batch_result', id: id, index: index++, target: item.target };
+      if (item.error) {
+        sendBatchResult({ ...header, error: item.error });
+        continue;
+      }
+      const tab = item.tab;
+      Object.assign(header, tabDetails(tab));
+      try {
+        if (!tab.active) {
+          if (!restore.has(tab.windowId)) {
+            const [active] = await chrome.tabs.query({ active: true, windowId: tab.windowId });
+            if (active) {
+              restore.set(tab.windowId, active.id);
+            }
+          }
+          await chrome.tabs.update(tab.id, { active: true });
+          await sleep(TAB_SETTLE_MS);
+        }
+        await sleep(Math.max(0, lastCaptureAt + MIN_CAPTURE_INTERVAL_MS - Date.now()));
+        lastCaptureAt = Date.now();
+        const dataUrl = await chrome.tabs.captureVisibleTab(tab.windowId, { format: "png" });
+        sendBatchResult(header, dataUrl);
+      } catch (error) {
+        console.error(`Batch capture of tab ${tab.id} failed:`, error);
+        sendBatchResult({ ...header, error: error.message });
+      }
+    }
+  } finally {
+    for (const [windowId, tabId] of restore) {
+      await chrome.tabs.update(tabId, { active: true }).catch((error) =>
+        console.error(`Could not restore tab ${tabId} in window ${windowId}:`, error));
+    }
+    if (ws && ws.readyState === WebSocket.OPEN) {
+      ws.send(JSON.stringify({ action: 'batch_done', id: id, count: index }));
+    }
   }
 }
 
@@ -118,6 +295,20 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
   }
 });
 
+chrome.tabs.onActivated.addListener(({ tabId }) => {
+  chrome.tabs.get(tabId, (tab) => {
+    if (!chrome.runtime.lastError) {
+      reportActiveTab(tab);
+    }
+  });
+});
+chrome.tabs.onUpdated.addListener((tabId, change, tab) => {
+  if (tab.active && (change.url || change.title)) {
+    reportActiveTab(tab);
+  }
+});
+chrome.windows.onFocusChanged.addListener(reportFocusedTab);
+
 // Start WebSocket connection
 console.log("Extension loaded, setting up WebSocket...");
 setupWebsocket();
\ No newline at end of file
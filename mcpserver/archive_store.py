@@ -0,0 +1,336 @@
+"""
+Packed, append-only screenshot archive.
+
+One file per frame means millions of small files at a 2s cadence across many
+tabs. ArchiveStore instead appends frames to rolling segment files:
+
+    archive/00000001.seg   frame bytes and their JSON metadata, back to back
+    archive/00000001.idx   one fixed-size entry per frame (INDEX_ENTRY):
+                           timestamp, offset, frame length, metadata length
+
+A new segment is started once the current one reaches ``segment_bytes`` or
+``segment_seconds``. Reads map the segment with mmap and return memoryview
+slices, so serving a frame doesn't copy it. Space is reclaimed by retention,
+which only ever deletes whole sealed segments; nothing is rewritten in place.
+
+The index entry is written after the frame, so after a crash the active
+segment is trimmed back to the last indexed frame when the store is opened.
+"""
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+
+from screenshot_store import SCREENSHOTS_DIR
+
+DEFAULT_DIRECTORY = SCREENSHOTS_DIR / "archive"
+
+SEGMENT_BYTES = 64 * 1024 * 1024
+SEGMENT_SECONDS = 3600
+
+# timestamp, offset in the segment, frame length, metadata length
+INDEX_ENTRY = struct.Struct("<dQII")
+
+
+class Frame:
+    """A frame read from the archive; ``data`` is a zero-copy memoryview"""
+
+    __slots__ = ("segment", "offset", "timestamp", "meta", "data")
+
+    def __init__(self, segment, offset, timestamp, meta, data):
+        self.segment = segment
+        self.offset = offset
+        self.timestamp = timestamp
+        self.meta = meta
+        self.data = data
+
+    def __repr__(self):
+        return f"<Frame {self.segment}:{self.offset} t={self.timestamp:.3f} {len(self.data)} bytes>"
+
+
+class _Segment:
+    def __init__(self, directory, number):
+        self.number = number
+        self.path = directory / f"{number:08d}.seg"
+        self.index_path = directory / f"{number:08d}.idx"
+        self.entries = None  # loaded lazily, list of INDEX_ENTRY tuples
+        self.offsets = None  # entry offsets, for bisecting
+        self.first = None  # first and last frame timestamps
+        self.last = None
+        self.count = 0
+        self.size = 0
+        self.map = None
+
+    def load_summary(self):
+        """Read the first and last index entries and the sizes"""
+        self.size = self.path.stat().st_size if self.path.exists() else 0
+        index_size = self.index_path.stat().st_size if self.index_path.exists() else 0
+        self.count = index_size // INDEX_ENTRY.size
+        if self.count:
+            with open(self.index_path, "rb") as f:
+                self.first = INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))[0]
+                f.seek((self.count - 1) * INDEX_ENTRY.size)
+                self.last = INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))[0]
+
+    def load_entries(self):
+        if self.entries is None:
+            with open(self.index_path, "rb") as f:
+                raw = f.read(self.count * INDEX_ENTRY.size)
+            self.entries = list(INDEX_ENTRY.iter_unpack(raw))
+            self.offsets = [entry[1] for entry in self.entries]
+        return self.entries
+
+    def view(self, end):
+        """A mapping covering at least the first ``end`` bytes"""
+        if self.map is None or len(self.map) < end:
+            # The active segment grows; map it again rather than mremap so
+            # memoryviews handed out earlier stay valid
+            with open(self.path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def release(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # A caller still holds a memoryview; the GC unmaps it later
+                pass
+            self.map = None
+
+
+class ArchiveStore:
+    def __init__(self, directory=DEFAULT_DIRECTORY, segment_bytes=SEGMENT_BYTES,
+                 segment_seconds=SEGMENT_SECONDS, max_age=None, max_bytes=None):
+        """
+        segment_bytes   - start a new segment once the current one is this big
+        segment_seconds - or once its first frame is this old
+        max_age         - delete sealed segments whose newest frame is older
+                          than this many seconds
+        max_bytes       - delete the oldest sealed segments while the archive
+                          is bigger than this
+        """
+        self.directory = Path(directory).expanduser()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._segments = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".seg") and entry.name[:-4].isdigit():
+                number = int(entry.name[:-4])
+                self._segments[number] = _Segment(self.directory, number)
+        for segment in self._segments.values():
+            segment.load_summary()
+        self._active = None
+        self._data_file = None
+        self._index_file = None
+        if self._segments:
+            self._open(self._segments[max(self._segments)], recover=True)
+        else:
+            self._open(_Segment(self.directory, 1))
+
+    def _open(self, segment, recover=False):
+        if recover:
+            # Drop a torn index entry and any frame bytes that never got one
+            entries = segment.count
+            end = 0
+            if entries:
+                with open(segment.index_path, "rb") as f:
+                    f.seek((entries - 1) * INDEX_ENTRY.size)
+                    _, offset, length, meta_length = INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))
+                end = offset + length + meta_length
+            for path, size in ((segment.index_path, entries * INDEX_ENTRY.size), (segment.path, end)):
+                if path.exists() and path.stat().st_size != size:
+                    os.truncate(path, size)
+            segment.size = end
+        self._segments[segment.number] = segment
+        self._data_file = open(segment.path, "ab")
+        self._index_file = open(segment.index_path, "ab")
+        self._active = segment
+
+    def _roll(self):
+        self._data_file.close()
+        self._index_file.close()
+        self._open(_Segment(self.directory, self._active.number + 1))
+        self._apply_retention(time.time())
+
+    def _should_roll(self, now):
+        segment = self._active
+        if not segment.count:
+            return False
+        return segment.size >= self.segment_bytes or now - segment.first >= self.segment_seconds
+
+    def save(self, data, meta, fsync=False):
+        """Append one frame and return its segment's path.
+
+        The frame's location is recorded in ``meta['segment']`` and
+        ``meta['offset']`` for the caller.
+        """
+        timestamp = meta.get("timestamp") or time.time()
+        record = {key: value for key, value in meta.items() if key != "timestamp"}
+        meta_bytes = json.dumps(record, separators=(",", ":")).encode()
+        with self._lock:
+            if self._should_roll(timestamp):
+                self._roll()
+            segment = self._active
+            offset = segment.size
+            self._data_file.write(data)
+            self._data_file.write(meta_bytes)
+            self._data_file.flush()
+            self._index_file.write(INDEX_ENTRY.pack(timestamp, offset, len(data), len(meta_bytes)))
+            self._index_file.flush()
+            if fsync:
+                os.fsync(self._data_file.fileno())
+                os.fsync(self._index_file.fileno())
+            segment.size = offset + len(data) + len(meta_bytes)
+            segment.count += 1
+            if segment.first is None:
+                segment.first = timestamp
+            segment.last = timestamp
+            if segment.entries is not None:
+                segment.entries.append((timestamp, offset, len(data), len(meta_bytes)))
+                segment.offsets.append(offset)
+        meta["segment"] = segment.number
+        meta["offset"] = offset
+        return segment.path
+
+    def _frame(self, segment, entry, with_meta=True):
+        timestamp, offset, length, meta_length = entry
+        view = memoryview(segment.view(offset + length + meta_length))
+        meta = None
+        if with_meta:
+            meta = json.loads(view[offset + length:offset + length + meta_length].tobytes())
+        return Frame(segment.number, offset, timestamp, meta, view[offset:offset + length])
+
+    def read(self, segment_number, offset):
+        """The frame stored at ``offset`` in a segment, or None"""
+        with self._lock:
+            segment = self._segments.get(segment_number)
+            if segment is None:
+                return None
+            entries = segment.load_entries()
+            i = bisect.bisect_left(segment.offsets, offset)
+            if i == len(entries) or entries[i][1] != offset:
+                return None
+            return self._frame(segment, entries[i])
+
+    def iter_range(self, start=None, end=None, with_meta=True):
+        """Yield frames with start <= timestamp < end, oldest first.
+
+        Timestamps only grow within a segment as long as the writers' clocks
+        do; frames are returned in the order they were appended.
+        """
+        with self._lock:
+            segments = [self._segments[n] for n in sorted(self._segments)]
+        for segment in segments:
+            if not segment.count:
+                continue
+            if start is not None and segment.last < start:
+                continue
+            if end is not None and segment.first >= end:
+                break
+            with self._lock:
+                if segment.number not in self._segments:
+                    # Deleted by retention while we were iterating
+                    continue
+                entries = list(segment.load_entries()[:segment.count])
+            for entry in entries:
+                if start is not None and entry[0] < start:
+                    continue
+                if end is not None and entry[0] >= end:
+                    continue
+                with self._lock:
+                    if segment.number not in self._segments:
+                        break
+                    frame = self._frame(segment, entry, with_meta)
+                yield frame
+
+    def latest(self):
+        """The most recently saved frame, or None"""
+        with self._lock:
+            segment = self._active
+            if not segment.count:
+                return None
+            return self._frame(segment, segment.load_entries()[-1])
+
+    def segments(self):
+        """Summaries of the archive's segments, oldest first"""
+        with self._lock:
+            return [
+                {"segment": s.number, "frames": s.count, "bytes": s.size,
+                 "first": s.first, "last": s.last, "active": s is self._active}
+                for s in (self._segments[n] for n in sorted(self._segments))
+            ]
+
+    def apply_retention(self, now=None):
+        """Delete sealed segments past max_age/max_bytes; returns how many"""
+        with self._lock:
+            return self._apply_retention(time.time() if now is None else now)
+
+    def _apply_retention(self, now):
+        if self.max_age is None and self.max_bytes is None:
+            return 0
+        total = sum(segment.size for segment in self._segments.values())
+        removed = 0
+        for number in sorted(self._segments):
+            segment = self._segments[number]
+            if segment is self._active:
+                break
+            expired = (
+                self.max_age is not None and segment.last is not None
+                and segment.last < now - self.max_age
+            )
+            oversized = self.max_bytes is not None and total > self.max_bytes
+            if not (expired or oversized or not segment.count):
+                break
+            del self._segments[number]
+            segment.release()
+            for path in (segment.path, segment.index_path):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            total -= segment.size
+            removed += 1
+        return removed
+
+    def close(self):
+        with self._lock:
+            self._data_file.close()
+            self._index_file.close()
+            for segment in self._segments.values():
+                segment.release()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or export a screenshot archive")
+    parser.add_argument("--directory", default=str(DEFAULT_DIRECTORY))
+    parser.add_argument("--export", metavar="DIR", help="Write frames out as individual files")
+    parser.add_argument("--since", type=float, help="Unix timestamp to export from")
+    parser.add_argument("--until", type=float, help="Unix timestamp to export up to")
+    args = parser.parse_args()
+
+    store = ArchiveStore(args.directory)
+    try:
+        if args.export:
+            out = Path(args.export)
+            out.mkdir(parents=True, exist_ok=True)
+            count = 0
+            for frame in store.iter_range(args.since, args.until, with_meta=False):
+                (out / f"{frame.timestamp:.3f}-{frame.segment}-{frame.offset}.png").write_bytes(frame.data)
+                count += 1
+            print(f"Exported {count} frames to {out}")
+        else:
+            for summary in store.segments():
+                print(json.dumps(summary))
+    finally:
+        store.close()
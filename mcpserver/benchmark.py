@@ -0,0 +1,681 @@
+"""
+Offline benchmark for the screenshot servers, no Chrome required.
+
+Each server script is started in a subprocess (with HOME and the working
+directory pointed at a scratch directory, so screenshots land there). A
+simulated extension speaks that server's protocol and answers every capture
+with a synthetic PNG after a configurable delay:
+
+    server.py, ws-server.py,      {"action": "capture"} -> screenshot frame
+    ws-mcp-with-flask-server.py,
+    gateway.py
+    newserver.py                  screenshot_command -> screenshot_status
+                                  + screenshot_result
+    sserver.py                    /check-status long-poll -> /upload-screenshot
+
+M concurrent requesters then hit the server's HTTP API for the run's
+duration. newserver.py has no HTTP API, so its requesters run next to the
+server in a driver subprocess (``--drive-newserver``). ws-server.py pulls
+frames on its own schedule; only its capture rate is measured.
+
+Reported per server: throughput, p50/p99 latency, peak RSS of the server
+process tree, and event-loop lag (the harness's own, plus the server's when
+it exports webmcp_event_loop_lag_seconds on /metrics). Results are written as
+JSON; pass ``--compare old.json`` to print the change against an earlier run.
+
+    python benchmark.py --clients 2 --requesters 8 --duration 20
+    python benchmark.py server.py sserver.py --png-kb 500 --binary
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import zlib
+from abc import ABC, abstractmethod
+from datetime import datetime
+from pathlib import Path
+
+import aiohttp
+import websockets
+
+from frames import encode_frame
+
+HERE = Path(__file__).resolve().parent
+RESULTS_DIR = HERE / "benchmark_results"
+
+WS_URL = "ws://localhost:8765"
+
+# How each server is driven: its HTTP capture endpoint, the extension
+# protocol it speaks, the ports to wait for, and where its metrics live
+SERVERS = {
+    "server.py": {
+        "protocol": "action",
+        "ports": [8765, 8766],
+        "capture_url": "http://localhost:8766/capture",
+        "metrics_url": "http://localhost:8766/metrics",
+    },
+    "ws-mcp-with-flask-server.py": {
+        "protocol": "action",
+        "ports": [8765, 5001],
+        "capture_url": "http://localhost:5001/screenshot",
+        "metrics_url": "http://localhost:5001/metrics",
+    },
+    "ws-server.py": {
+        "protocol": "action",
+        "ports": [8765],
+        "capture_url": None,  # the server pulls frames itself
+        "metrics_url": "http://localhost:8767/metrics",
+    },
+    "newserver.py": {
+        "protocol": "command",
+        "ports": [8765],
+        "capture_url": None,  # requesters run in the driver subprocess
+        "metrics_url": "http://localhost:8767/metrics",
+    },
+    "gateway.py": {
+        "protocol": "action",
+        "ports": [8765],
+        "capture_url": "http://localhost:8765/screenshot",
+        "metrics_url": "http://localhost:8765/metrics",
+    },
+    "sserver.py": {
+        "protocol": "polling",
+        "ports": [3000],
+        "capture_url": "http://localhost:3000",
+        "metrics_url": "http://localhost:3000/metrics",
+    },
+}
+
+STARTUP_TIMEOUT = 15
+REQUEST_TIMEOUT = 30
+LOOP_LAG_INTERVAL = 0.05
+RSS_SAMPLE_INTERVAL = 0.1
+LOOP_LAG_METRIC = "webmcp_event_loop_lag_seconds"
+
+
+# --- Synthetic frames ---
+
+def synthetic_png(size, width=256):
+    """A valid PNG of roughly ``size`` bytes (random pixels don't compress)"""
+    height = max(1, size // (width * 3 + 1))
+    rows = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height))
+
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(rows, 1)) + chunk(b"IEND", b""))
+
+
+class FramePool:
+    """A few pre-built frames, so generating PNGs isn't part of the measurement"""
+
+    def __init__(self, size, count=8):
+        self.frames = [synthetic_png(size) for _ in range(count)]
+        self.data_urls = ["data:image/png;base64," + base64.b64encode(f).decode() for f in self.frames]
+
+    def pick(self):
+        index = random.randrange(len(self.frames))
+        return self.frames[index], self.data_urls[index]
+
+
+# --- Measurement helpers ---
+
+class LoopLagMonitor:
+    """Samples how late the running event loop wakes up from a short sleep"""
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - started - self.interval))
+
+    def summary(self):
+        if not self.samples:
+            return None
+        return {
+            "p99_ms": round(percentile(self.samples, 99) * 1000, 2),
+            "max_ms": round(max(self.samples) * 1000, 2),
+        }
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def process_tree_rss(pid):
+    """Resident set size in bytes of ``pid`` and its descendants (Linux only)"""
+    children = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            # Field 4 of /proc/<pid>/stat is the parent pid
+            stat = (entry / "stat").read_text()
+            ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry.name))
+
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, []))
+        try:
+            for line in Path(f"/proc/{current}/status").read_text().splitlines():
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+async def sample_peak_rss(pid, peak):
+    if not Path("/proc").is_dir():
+        return
+    while True:
+        peak[0] = max(peak[0], await asyncio.to_thread(process_tree_rss, pid))
+        await asyncio.sleep(RSS_SAMPLE_INTERVAL)
+
+
+async def scrape_loop_lag(session, url):
+    """Server-side loop lag from its /metrics, if it exports it"""
+    if not url:
+        return None
+    try:
+        async with session.get(url) as response:
+            text = await response.text()
+    except aiohttp.ClientError:
+        return None
+    for line in text.splitlines():
+        if line.startswith(LOOP_LAG_METRIC + "_max"):
+            return {"max_ms": round(float(line.split()[-1]) * 1000, 2)}
+    return None
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        self.errors = {}
+
+    def ok(self, started):
+        self.latencies.append(time.perf_counter() - started)
+
+    def error(self, reason):
+        self.errors[reason] = self.errors.get(reason, 0) + 1
+
+    def summary(self, elapsed):
+        result = {
+            "completed": len(self.latencies),
+            "errors": sum(self.errors.values()),
+            "error_kinds": self.errors,
+            "throughput_rps": round(len(self.latencies) / elapsed, 2) if elapsed else None,
+            "latency_ms": None,
+        }
+        if self.latencies:
+            result["latency_ms"] = {
+                "p50": round(percentile(self.latencies, 50) * 1000, 2),
+                "p99": round(percentile(self.latencies, 99) * 1000, 2),
+                "mean": round(statistics.fmean(self.latencies) * 1000, 2),
+                "max": round(max(self.latencies) * 1000, 2),
+            }
+        return result
+
+
+# --- Simulated extensions ---
+
+class SimulatedExtension(ABC):
+    def __init__(self, frames, delay, jitter, binary):
+        self.frames = frames
+        self.delay = delay
+        self.jitter = jitter
+        self.binary = binary
+        self.captures = 0
+
+    async def think(self):
+        """Stand-in for captureVisibleTab + toDataURL time"""
+        await asyncio.sleep(max(0.0, random.gauss(self.delay, self.jitter)))
+
+    @abstractmethod
+    async def run(self, stop):
+        """Answer capture requests until ``stop`` is set"""
+
+
+class ActionExtension(SimulatedExtension):
+    """extension.js: {"action": "capture"} in, {"action": "screenshot"} out"""
+
+    async def run(self, stop):
+        async with websockets.connect(WS_URL, max_size=None) as ws:
+            await ws.send(json.dumps({"action": "hello", "capabilities": ["binary_frames"] if self.binary else []}))
+            binary = False
+            while not stop.is_set():
+                try:
+                    message = await asyncio.wait_for(ws.recv(), 0.5)
+                except asyncio.TimeoutError:
+                    continue
+                data = json.loads(message)
+                if data.get("action") == "hello":
+                    binary = bool(data.get("binaryFrames"))
+                elif data.get("action") == "capture":
+                    asyncio.create_task(self.reply(ws, data.get("id"), binary))
+
+    async def reply(self, ws, capture_id, binary):
+        await self.think()
+        frame, data_url = self.frames.pick()
+        try:
+            if binary:
+                await ws.send(encode_frame({"action": "screenshot", "id": capture_id, "mime": "image/png"}, frame))
+            else:
+                await ws.send(json.dumps({"action": "screenshot", "id": capture_id, "dataUrl": data_url}))
+            self.captures += 1
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+class CommandExtension(SimulatedExtension):
+    """newserver.py: screenshot_command in, screenshot_status + screenshot_result out"""
+
+    async def run(self, stop):
+        async with websockets.connect(WS_URL, max_size=None) as ws:
+            await ws.send(json.dumps({
+                "type": "hello",
+                "clientId": f"bench-{uuid.uuid4().hex[:8]}",
+                "capabilities": ["binary_frames"] if self.binary else [],
+                "tabUrl": "https://example.com/",
+                "tabTitle": "Benchmark",
+            }))
+            binary = False
+            while not stop.is_set():
+                try:
+                    message = await asyncio.wait_for(ws.recv(), 0.5)
+                except asyncio.TimeoutError:
+                    continue
+                data = json.loads(message)
+                if data.get("type") == "hello":
+                    binary = bool(data.get("binaryFrames"))
+                elif data.get("type") == "screenshot_command":
+                    asyncio.create_task(self.reply(ws, data.get("commandId"), binary))
+
+    async def reply(self, ws, command_id, binary):
+        await self.think()
+        frame, data_url = self.frames.pick()
+        try:
+            await ws.send(json.dumps({
+                "type": "screenshot_status", "commandId": command_id, "success": True,
+                "tabTitle": "Benchmark", "tabUrl": "https://example.com/",
+            }))
+            if binary:
+                await ws.send(encode_frame({"type": "screenshot_result", "commandId": command_id}, frame))
+            else:
+                await ws.send(json.dumps({"type": "screenshot_result", "commandId": command_id, "dataUrl": data_url}))
+            self.captures += 1
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+
+class PollingExtension(SimulatedExtension):
+    """background.js: long-polls /check-status and posts to /upload-screenshot"""
+
+    def __init__(self, *args, base_url, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.base_url = base_url
+
+    async def run(self, stop):
+        timeout = aiohttp.ClientTimeout(total=None)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while not stop.is_set():
+                try:
+                    async with session.get(f"{self.base_url}/check-status", params={"wait": 1, "max": 4}) as response:
+                        data = await response.json()
+                except aiohttp.ClientError:
+                    await asyncio.sleep(0.1)
+                    continue
+                await asyncio.gather(*(self.reply(session, item["id"]) for item in data.get("requests") or []))
+
+    async def reply(self, session, request_id):
+        await self.think()
+        png, data_url = self.frames.pick()
+        try:
+            if self.binary:
+                # Raw image/png upload, no base64
+                upload = session.post(f"{self.base_url}/upload-screenshot", params={"id": request_id},
+                                      data=png, headers={"Content-Type": "image/png"})
+            else:
+                upload = session.post(f"{self.base_url}/upload-screenshot",
+                                      json={"id": request_id, "screenshotData": data_url})
+            async with upload as response:
+                await response.read()
+            self.captures += 1
+        except aiohttp.ClientError:
+            pass
+
+
+EXTENSIONS = {"action": ActionExtension, "command": CommandExtension, "polling": PollingExtension}
+
+
+# --- Requesters ---
+
+async def http_requester(session, url, stop, recorder, params=None):
+    """server.py /capture and ws-mcp /screenshot: one GET per screenshot"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            async with session.get(url, params=params) as response:
+                await response.read()
+                if response.status == 200:
+                    recorder.ok(started)
+                else:
+                    recorder.error(f"http_{response.status}")
+        except asyncio.TimeoutError:
+            recorder.error("timeout")
+        except aiohttp.ClientError as e:
+            recorder.error(type(e).__name__)
+
+
+async def polling_requester(session, base_url, stop, recorder, params=None):
+    """sserver.py: queue a request, then wait for its result"""
+    while not stop.is_set():
+        request_id = f"bench-{uuid.uuid4().hex}"
+        started = time.perf_counter()
+        try:
+            async with session.post(f"{base_url}/request-screenshot", json={"id": request_id}) as response:
+                await response.read()
+            async with session.get(f"{base_url}/screenshot/{request_id}",
+                                   params={"wait": REQUEST_TIMEOUT, **(params or {})}) as response:
+                await response.read()
+                if response.status == 200:
+                    recorder.ok(started)
+                else:
+                    recorder.error(f"http_{response.status}")
+        except asyncio.TimeoutError:
+            recorder.error("timeout")
+        except aiohttp.ClientError as e:
+            recorder.error(type(e).__name__)
+
+
+# --- Running one server ---
+
+def port_open(port):
+    with socket.socket() as sock:
+        sock.settimeout(0.2)
+        return sock.connect_ex(("localhost", port)) == 0
+
+
+async def wait_for_ports(ports, process, timeout=STARTUP_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with code {process.returncode}")
+        if all(port_open(port) for port in ports):
+            return
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f"server did not open ports {ports} within {timeout}s")
+
+
+def start_server(name, args, workdir):
+    env = dict(os.environ, HOME=str(workdir), PYTHONUNBUFFERED="1")
+    if name == "newserver.py":
+        command = [sys.executable, str(Path(__file__).resolve()), "--drive-newserver",
+                   "--clients", str(args.clients), "--requesters", str(args.requesters),
+                   "--duration", str(args.duration)]
+    else:
+        command = [sys.executable, str(HERE / name)]
+    # Only the driver's output is read; a chatty server would otherwise block
+    # once the unread pipe fills up
+    stdout = subprocess.PIPE if name == "newserver.py" else subprocess.DEVNULL
+    return subprocess.Popen(
+        command, cwd=workdir, env=env, stdin=subprocess.DEVNULL,
+        stdout=stdout, stderr=subprocess.DEVNULL, start_new_session=True,
+    )
+
+
+def stop_server(process):
+    if process.poll() is not None:
+        return
+    # The whole session: Flask's reloader runs the app in a child process
+    os.killpg(process.pid, signal.SIGINT)
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+async def run_server(name, args, frames):
+    spec = SERVERS[name]
+    print(f"[Bench] {name}: {args.clients} clients, {args.requesters} requesters, {args.duration}s")
+    with tempfile.TemporaryDirectory(prefix="webmcp-bench-") as workdir:
+        process = start_server(name, args, workdir)
+        peak_rss = [0]
+        rss_task = asyncio.create_task(sample_peak_rss(process.pid, peak_rss))
+        lag = LoopLagMonitor()
+        lag.start()
+        stop = asyncio.Event()
+        # Extensions outlive the requesters so in-flight captures can finish
+        extensions_stop = asyncio.Event()
+        recorder = Recorder()
+        extension_cls = EXTENSIONS[spec["protocol"]]
+        options = {"base_url": spec["capture_url"]} if spec["protocol"] == "polling" else {}
+        extensions = [extension_cls(frames, args.delay, args.jitter, args.binary, **options)
+                      for _ in range(args.clients)]
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT + 5)
+        try:
+            await wait_for_ports(spec["ports"], process)
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                extension_tasks = [asyncio.create_task(ext.run(extensions_stop)) for ext in extensions]
+                await asyncio.sleep(0.5)  # let every extension connect and say hello
+
+                started = time.perf_counter()
+                if name == "newserver.py":
+                    # The driver runs the requesters and prints their results
+                    output = await asyncio.to_thread(process.stdout.read)
+                    result = json.loads(output.decode().strip().splitlines()[-1])
+                    recorder.latencies = result["latencies"]
+                    recorder.errors = result["errors"]
+                    server_lag = result["loop_lag"]
+                    elapsed = result["elapsed"]
+                else:
+                    if spec["protocol"] == "polling":
+                        requesters = [polling_requester(session, spec["capture_url"], stop, recorder, args.variant)
+                                      for _ in range(args.requesters)]
+                    elif spec["capture_url"]:
+                        requesters = [http_requester(session, spec["capture_url"], stop, recorder, args.variant)
+                                      for _ in range(args.requesters)]
+                    else:
+                        requesters = []
+                    requester_tasks = [asyncio.create_task(r) for r in requesters]
+                    await asyncio.sleep(args.duration)
+                    server_lag = await scrape_loop_lag(session, spec["metrics_url"])
+                    stop.set()
+                    await asyncio.gather(*requester_tasks, return_exceptions=True)
+                    elapsed = time.perf_counter() - started
+                extensions_stop.set()
+                await asyncio.gather(*extension_tasks, return_exceptions=True)
+        finally:
+            stop_server(process)
+            rss_task.cancel()
+            await lag.stop()
+
+    result = recorder.summary(elapsed)
+    captures = sum(ext.captures for ext in extensions)
+    result.update({
+        "server": name,
+        "extension_captures": captures,
+        "capture_rate": round(captures / elapsed, 2) if elapsed else None,
+        "peak_rss_mb": round(peak_rss[0] / 2**20, 1) if peak_rss[0] else None,
+        "loop_lag_ms": {"harness": lag.summary(), "server": server_lag},
+    })
+    latency = result["latency_ms"] or {}
+    print(f"[Bench] {name}: {result['throughput_rps']} req/s, p50 {latency.get('p50')} ms, "
+          f"p99 {latency.get('p99')} ms, {result['errors']} errors, peak RSS {result['peak_rss_mb']} MB")
+    return result
+
+
+# --- newserver.py driver ---
+
+async def drive_newserver(args):
+    """Run newserver's WebSocketServer with in-process requesters; print results as JSON"""
+    import logging
+    logging.disable(logging.WARNING)
+    from newserver import WebSocketServer
+
+    server = WebSocketServer(host="localhost", port=8765, metrics_port=8767)
+    server_task = asyncio.create_task(server.start_server())
+    lag = LoopLagMonitor()
+    lag.start()
+
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while len(server.clients) < args.clients and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+    recorder = Recorder()
+    stop = asyncio.Event()
+
+    async def requester():
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                await server.capture_screenshot(timeout=REQUEST_TIMEOUT)
+                recorder.ok(started)
+            except asyncio.TimeoutError:
+                recorder.error("timeout")
+            except Exception as e:
+                recorder.error(type(e).__name__)
+
+    started = time.perf_counter()
+    tasks = [asyncio.create_task(requester()) for _ in range(args.requesters)]
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    await lag.stop()
+    server_task.cancel()
+    await asyncio.gather(server_task, return_exceptions=True)
+    print(json.dumps({
+        "latencies": recorder.latencies,
+        "errors": recorder.errors,
+        "elapsed": elapsed,
+        "loop_lag": lag.summary(),
+    }))
+
+
+# --- Reports ---
+
+def compare(current, baseline_path):
+    """Print the change of the headline numbers against an earlier results file"""
+    baseline = {run["server"]: run for run in json.loads(Path(baseline_path).read_text())["runs"]}
+    for run in current["runs"]:
+        old = baseline.get(run["server"])
+        if old is None:
+            continue
+        rows = [
+            ("throughput_rps", run["throughput_rps"], old["throughput_rps"]),
+            ("p50_ms", (run["latency_ms"] or {}).get("p50"), (old["latency_ms"] or {}).get("p50")),
+            ("p99_ms", (run["latency_ms"] or {}).get("p99"), (old["latency_ms"] or {}).get("p99")),
+            ("peak_rss_mb", run["peak_rss_mb"], old["peak_rss_mb"]),
+        ]
+        print(f"[Compare] {run['server']}")
+        for label, new_value, old_value in rows:
+            if new_value is None or not old_value:
+                continue
+            change = (new_value - old_value) / old_value * 100
+            print(f"  {label:>15}: {old_value} -> {new_value} ({change:+.1f}%)")
+
+
+async def main(args):
+    frames = FramePool(args.png_kb * 1024)
+    runs = []
+    for name in args.servers or list(SERVERS):
+        try:
+            runs.append(await run_server(name, args, frames))
+        except Exception as e:
+            print(f"[Bench] {name} failed: {e}")
+            runs.append({"server": name, "failed": str(e)})
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "clients": args.clients,
+            "requesters": args.requesters,
+            "duration": args.duration,
+            "png_kb": args.png_kb,
+            "delay": args.delay,
+            "jitter": args.jitter,
+            "binary": args.binary,
+            "variant": args.variant,
+        },
+        "runs": runs,
+    }
+    output = Path(args.output) if args.output else RESULTS_DIR / f"bench-{datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"[Bench] Results written to {output}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the WebMCP screenshot servers with a simulated extension")
+    parser.add_argument("servers", nargs="*", metavar="SERVER",
+                        help=f"servers to run (default: all of {', '.join(SERVERS)})")
+    parser.add_argument("--clients", type=int, default=1, help="simulated extensions")
+    parser.add_argument("--requesters", type=int, default=4, help="concurrent HTTP requesters")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per server")
+    parser.add_argument("--png-kb", type=int, default=200, help="synthetic screenshot size")
+    parser.add_argument("--delay", type=float, default=0.05, help="simulated capture time in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="std deviation of the capture time")
+    parser.add_argument("--binary", action="store_true", help="offer binary frames (raw PNG uploads for sserver.py) instead of base64 JSON")
+    parser.add_argument("--format", help="ask HTTP endpoints for a transcoded format (webp, jpeg)")
+    parser.add_argument("--width", type=int, help="ask HTTP endpoints for a downscaled width")
+    parser.add_argument("--output", help="results file (default: benchmark_results/bench-<time>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--drive-newserver", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.servers if name not in SERVERS]
+    if unknown:
+        parser.error(f"unknown server(s): {', '.join(unknown)}")
+    args.variant = {key: str(value) for key, value in (("format", args.format), ("width", args.width)) if value}
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.drive_newserver:
+        asyncio.run(drive_newserver(args))
+    else:
+        asyncio.run(main(args))
@@ -0,0 +1,210 @@
+"""
+Per-browser capture scheduling.
+
+Chrome throttles captureVisibleTab to a few calls per second per window;
+going over that budget just produces extension errors. CaptureScheduler
+gives every client a token bucket and makes capture commands wait for a
+token instead of being fired immediately:
+
+    INTERACTIVE  - an HTTP/MCP caller is waiting for this capture
+    MONITORING   - periodic or streaming captures that can wait or be skipped
+
+Waiters are served by priority, then in arrival order. A request with a
+deadline is rejected up front (CaptureRejected) when the queue ahead of it
+plus the client's typical capture time already overshoots the deadline, and
+is dropped from the queue if the deadline passes while it waits. Overload
+then shows up as bounded queueing and quick 429s rather than error storms.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+
+import metrics
+
+INTERACTIVE = 0
+MONITORING = 1
+PRIORITIES = {'interactive': INTERACTIVE, 'monitoring': MONITORING}
+
+# Chrome's limit is MAX_CAPTURE_VISIBLE_TAB_CALLS_PER_SECOND = 2
+DEFAULT_RATE = 2.0
+DEFAULT_BURST = 2
+# Weight of the newest sample in the capture latency moving average
+LATENCY_EWMA_ALPHA = 0.3
+
+REJECTED_TOTAL = metrics.REGISTRY.counter(
+    'webmcp_captures_rejected_total', 'Captures refused by the scheduler, by reason')
+QUEUE_WAIT_SECONDS = metrics.REGISTRY.histogram(
+    'webmcp_capture_queue_wait_seconds', 'Time captures waited for a rate-limit token')
+
+
+class CaptureRejected(Exception):
+    """The capture can't start (or finish) before its deadline"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_priority(value, default=INTERACTIVE):
+    """Priority from a query parameter ('interactive'/'monitoring'); ValueError if unknown"""
+    if value is None:
+        return default
+    if value not in PRIORITIES:
+        raise ValueError(f"Unknown priority {value!r}; use one of {', '.join(PRIORITIES)}")
+    return PRIORITIES[value]
+
+
+class TokenBucket:
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        self._refill()
+        return self.tokens
+
+    def try_take(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def time_until(self, tokens=1):
+        """Seconds until ``tokens`` tokens will have accumulated"""
+        self._refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+
+class _Lane:
+    """Token bucket and priority queue of one client"""
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.waiters = []  # heap of (priority, seq, future)
+        self.latency = None
+        self.timer = None
+
+    def queued(self):
+        return sum(1 for _, _, future in self.waiters if not future.done())
+
+    def ahead_of(self, priority):
+        return sum(1 for p, _, future in self.waiters if p <= priority and not future.done())
+
+    def estimate(self, priority):
+        """Expected seconds until a new capture at ``priority`` has finished"""
+        wait = self.bucket.time_until(self.ahead_of(priority) + 1)
+        return wait + (self.latency or 0.0)
+
+
+class CaptureScheduler:
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        """
+        rate  - captures per second allowed per client
+        burst - captures a client may take back to back after being idle
+        """
+        self.rate = rate
+        self.burst = burst
+        self._lanes = {}
+        self._seq = itertools.count()
+        metrics.QUEUE_DEPTH.set_function(self.queued, queue='scheduler')
+
+    def queued(self):
+        return sum(lane.queued() for lane in self._lanes.values())
+
+    def _lane(self, key):
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _Lane(self.rate, self.burst)
+        return lane
+
+    def estimate(self, key, priority=INTERACTIVE):
+        return self._lane(key).estimate(priority)
+
+    async def acquire(self, key, priority=INTERACTIVE, deadline=None):
+        """Wait for a capture token for client ``key``.
+
+        ``deadline`` is a time.monotonic() value by which the capture should
+        have finished; raises CaptureRejected when that can't be met.
+        """
+        lane = self._lane(key)
+        started = time.monotonic()
+        if deadline is not None:
+            eta = lane.estimate(priority)
+            if started + eta > deadline:
+                REJECTED_TOTAL.inc(reason='early')
+                raise CaptureRejected(
+                    f"Capture can't complete in time: ~{eta:.1f}s needed, "
+                    f"{max(0.0, deadline - started):.1f}s left",
+                    retry_after=lane.bucket.time_until(lane.ahead_of(priority) + 1),
+                )
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(lane.waiters, (priority, next(self._seq), future))
+        self._pump(key)
+        try:
+            if deadline is None:
+                await future
+            else:
+                # Leave room for the capture itself after the token arrives
+                budget = deadline - time.monotonic() - (lane.latency or 0.0)
+                await asyncio.wait_for(future, max(0.0, budget))
+        except asyncio.TimeoutError:
+            REJECTED_TOTAL.inc(reason='expired')
+            raise CaptureRejected("Deadline passed while queued for a capture slot")
+        finally:
+            if not future.done():
+                future.cancel()
+            # A cancelled head of the queue may have been blocking others
+            self._pump(key)
+        QUEUE_WAIT_SECONDS.observe(time.monotonic() - started)
+
+    def record(self, key, latency):
+        """Feed a completed capture's duration into the deadline estimates"""
+        lane = self._lanes.get(key)
+        if lane is None:
+            return
+        if lane.latency is None:
+            lane.latency = latency
+        else:
+            lane.latency += LATENCY_EWMA_ALPHA * (latency - lane.latency)
+
+    def remove(self, key, error="Client disconnected"):
+        """Forget a client; its queued captures fail with ConnectionError"""
+        lane = self._lanes.pop(key, None)
+        if lane is None:
+            return
+        if lane.timer is not None:
+            lane.timer.cancel()
+        for _, _, future in lane.waiters:
+            if not future.done():
+                future.set_exception(ConnectionError(error))
+
+    def _pump(self, key):
+        lane = self._lanes.get(key)
+        if lane is None:
+            return
+        while lane.waiters:
+            priority, seq, future = lane.waiters[0]
+            if future.done():
+                heapq.heappop(lane.waiters)
+                continue
+            if not lane.bucket.try_take():
+                break
+            heapq.heappop(lane.waiters)
+            future.set_result(None)
+        if lane.timer is not None:
+            lane.timer.cancel()
+            lane.timer = None
+        if lane.waiters:
+            lane.timer = asyncio.get_running_loop().call_later(
+                lane.bucket.time_until(1), self._pump, key
+            )
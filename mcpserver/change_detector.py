@@ -0,0 +1,124 @@
+"""
+Change detection for periodic captures.
+
+ChangeDetector decodes each frame to a grayscale NumPy array and compares it
+tile by tile with the last frame that was kept. Frames whose changed area is
+below a threshold are reported as unchanged so the caller can drop them.
+AdaptiveInterval stretches the capture period while a page is static and
+snaps back when it changes.
+
+Requires numpy and Pillow: pip install numpy pillow
+"""
+import io
+
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    np = None
+    Image = None
+
+
+class ChangeDetector:
+    def __init__(self, tile_size=32, pixel_threshold=12, min_changed_fraction=0.002):
+        """
+        tile_size            - edge of the square tiles frames are compared in
+        pixel_threshold      - mean absolute gray-level difference (0-255) for
+                               a tile to count as changed
+        min_changed_fraction - share of tiles that must change for the frame
+                               to be kept
+        """
+        if np is None:
+            raise ImportError("Change detection needs numpy and Pillow: pip install numpy pillow")
+        self.tile_size = tile_size
+        self.pixel_threshold = pixel_threshold
+        self.min_changed_fraction = min_changed_fraction
+        self.last_kept = None
+        self.size = None
+
+    def _decode(self, image_bytes):
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            gray = np.asarray(image.convert("L"), dtype=np.int16)
+        self.size = (gray.shape[1], gray.shape[0])
+        # Pad to whole tiles so the frame reshapes into a tile grid
+        t = self.tile_size
+        pad_h = -gray.shape[0] % t
+        pad_w = -gray.shape[1] % t
+        if pad_h or pad_w:
+            gray = np.pad(gray, ((0, pad_h), (0, pad_w)), mode="edge")
+        return gray
+
+    def _tile_diff(self, previous, current):
+        """Mean absolute difference per tile, as a (rows, cols) array"""
+        t = self.tile_size
+        rows, cols = current.shape[0] // t, current.shape[1] // t
+        diff = np.abs(current - previous)
+        return diff.reshape(rows, t, cols, t).mean(axis=(1, 3))
+
+    def compare(self, image_bytes):
+        """Compare a frame with the last kept one.
+
+        Returns (changed, boxes, fraction): whether the frame should be kept,
+        the bounding boxes (x0, y0, x1, y1) of connected changed-tile regions
+        in pixels, and the share of tiles that changed. Kept frames become the
+        new reference.
+        """
+        current = self._decode(image_bytes)
+        previous = self.last_kept
+        if previous is None or previous.shape != current.shape:
+            self.last_kept = current
+            w, h = self.size
+            return True, [(0, 0, w, h)], 1.0
+
+        changed_tiles = self._tile_diff(previous, current) > self.pixel_threshold
+        fraction = float(changed_tiles.mean())
+        if fraction < self.min_changed_fraction:
+            return False, [], fraction
+
+        self.last_kept = current
+        return True, self._boxes(changed_tiles), fraction
+
+    def _boxes(self, changed_tiles):
+        """Bounding boxes of 4-connected regions of changed tiles"""
+        t = self.tile_size
+        width, height = self.size
+        rows, cols = changed_tiles.shape
+        seen = np.zeros_like(changed_tiles)
+        boxes = []
+        for r, c in zip(*np.nonzero(changed_tiles)):
+            if seen[r, c]:
+                continue
+            seen[r, c] = True
+            stack = [(r, c)]
+            r0, c0, r1, c1 = r, c, r, c
+            while stack:
+                y, x = stack.pop()
+                r0, c0, r1, c1 = min(r0, y), min(c0, x), max(r1, y), max(c1, x)
+                for ny, nx in ((y - 1, x), (y + 1, x), (y, x - 1), (y, x + 1)):
+                    if 0 <= ny < rows and 0 <= nx < cols and changed_tiles[ny, nx] and not seen[ny, nx]:
+                        seen[ny, nx] = True
+                        stack.append((ny, nx))
+            boxes.append((
+                int(c0) * t,
+                int(r0) * t,
+                min(width, (int(c1) + 1) * t),
+                min(height, (int(r1) + 1) * t),
+            ))
+        return boxes
+
+
+class AdaptiveInterval:
+    """Capture period that backs off on static pages and resets on change"""
+
+    def __init__(self, minimum=0.5, maximum=30.0, initial=2.0, backoff=1.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.current = initial
+
+    def update(self, changed):
+        if changed:
+            self.current = self.minimum
+        else:
+            self.current = min(self.maximum, self.current * self.backoff)
+        return self.current
@@ -0,0 +1,131 @@
+"""
+Per-client outbound queues.
+
+Every connected client gets a ClientOutbox: a bounded queue drained by its own
+writer task. Fan-out only enqueues, so one stalled browser can no longer hold
+up a broadcast to everybody else; its messages wait (or are dropped) in its
+own queue.
+
+Messages sent with a ``coalesce_key`` (heartbeats, status updates) are
+disposable: a newer one replaces the queued one with the same key, and they
+are dropped rather than queued when the outbox is full. A client whose sends
+keep timing out or failing, or whose queue overflows, is evicted.
+"""
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class ClientOutbox:
+    def __init__(self, websocket, max_queue=32, send_timeout=5.0, max_failures=3, on_evict=None):
+        """
+        max_queue    - messages buffered before new ones are refused
+        send_timeout - seconds a single send may take before it counts as failed
+        max_failures - consecutive failed sends/overflows before eviction
+        on_evict     - coroutine function called with the websocket on eviction
+        """
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.max_failures = max_failures
+        self.on_evict = on_evict
+        self.failures = 0
+        self.sent = 0
+        self.dropped = 0
+        self.evicted = False
+        self._queue = deque()    # entries are [message, coalesce_key]
+        self._coalesced = {}     # coalesce_key -> queued entry
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._writer())
+
+    def __len__(self):
+        return len(self._queue)
+
+    def send_nowait(self, message, coalesce_key=None):
+        """Queue a message; returns False if it was dropped"""
+        if self.evicted:
+            return False
+        if coalesce_key is not None:
+            entry = self._coalesced.get(coalesce_key)
+            if entry is not None:
+                # Replace the stale queued copy instead of sending both
+                entry[0] = message
+                return True
+
+        if len(self._queue) >= self.max_queue:
+            if coalesce_key is not None or not self._drop_disposable():
+                self.dropped += 1
+                self._record_failure("outbound queue full")
+                return False
+
+        entry = [message, coalesce_key]
+        self._queue.append(entry)
+        if coalesce_key is not None:
+            self._coalesced[coalesce_key] = entry
+        self._ready.set()
+        return True
+
+    async def close(self):
+        """Stop the writer; queued messages are discarded"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._queue.clear()
+        self._coalesced.clear()
+
+    def _drop_disposable(self):
+        """Make room by dropping the oldest coalescable message, if any"""
+        for entry in self._queue:
+            if entry[1] is not None:
+                self._queue.remove(entry)
+                del self._coalesced[entry[1]]
+                self.dropped += 1
+                return True
+        return False
+
+    async def _writer(self):
+        while True:
+            while not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+            message, coalesce_key = self._queue.popleft()
+            if coalesce_key is not None:
+                self._coalesced.pop(coalesce_key, None)
+            try:
+                await asyncio.wait_for(self.websocket.send(message), self.send_timeout)
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                self._record_failure(f"send timed out after {self.send_timeout}s")
+            except Exception as e:
+                self._record_failure(f"send failed: {e}")
+            else:
+                self.sent += 1
+                self.failures = 0
+
+    def _record_failure(self, reason):
+        self.failures += 1
+        logger.warning(f"Client send problem ({self.failures}/{self.max_failures}): {reason}")
+        if self.failures >= self.max_failures and not self.evicted:
+            self.evicted = True
+            asyncio.get_running_loop().create_task(self._evict(reason))
+
+    async def _evict(self, reason):
+        logger.error(f"❌ Evicting unresponsive client: {reason}")
+        if self.on_evict is not None:
+            await self.on_evict(self.websocket)
+        try:
+            await asyncio.wait_for(self.websocket.close(code=1011, reason="unresponsive"), 2)
+        except Exception:
+            # A fully stalled peer may never finish the closing handshake
+            transport = getattr(self.websocket, 'transport', None)
+            if transport is not None:
+                transport.abort()
+        await self.close()
@@ -0,0 +1,199 @@
+"""
+Registry of connected browser extensions and capture routing.
+
+Each connection gets a ClientInfo recording who it is (client id,
+capabilities), what it is showing (window/tab from hello and
+screenshot_status messages) and how it is doing (commands in flight, recent
+latency). ClientRegistry picks the client a capture command goes to:
+
+    least_loaded - fewest commands in flight, then lowest recent latency
+    affinity     - only clients whose id, tab URL or tab title match the
+                   requested affinity; least loaded among those
+
+Every client has a concurrency cap; acquire() waits for a free slot instead
+of piling more commands onto a busy browser.
+"""
+import asyncio
+import time
+import uuid
+
+LEAST_LOADED = 'least_loaded'
+AFFINITY = 'affinity'
+
+# Weight of the newest sample in the latency moving average
+LATENCY_EWMA_ALPHA = 0.3
+
+
+class ClientInfo:
+    def __init__(self, websocket, max_in_flight=4):
+        self.websocket = websocket
+        self.client_id = str(uuid.uuid4())
+        remote = getattr(websocket, 'remote_address', None)
+        self.remote_address = "%s:%s" % tuple(remote[:2]) if remote else None
+        self.connected_at = time.time()
+        self.capabilities = set()
+        self.window_id = None
+        self.tab_id = None
+        self.tab_title = None
+        self.tab_url = None
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.latency_ms = None
+        self.completed = 0
+        self.failed = 0
+
+    def update_from_hello(self, hello):
+        self.client_id = hello.get('clientId') or self.client_id
+        self.capabilities = set(hello.get('capabilities') or [])
+        if hello.get('maxInFlight'):
+            self.max_in_flight = int(hello['maxInFlight'])
+        self.update_tab(hello)
+
+    def update_tab(self, data):
+        """Record window/tab details reported by the extension"""
+        self.window_id = data.get('windowId', self.window_id)
+        self.tab_id = data.get('tabId', self.tab_id)
+        self.tab_title = data.get('tabTitle', self.tab_title)
+        self.tab_url = data.get('tabUrl', self.tab_url)
+
+    def record_result(self, latency, ok):
+        if ok:
+            self.completed += 1
+            latency_ms = latency * 1000
+            if self.latency_ms is None:
+                self.latency_ms = latency_ms
+            else:
+                self.latency_ms += LATENCY_EWMA_ALPHA * (latency_ms - self.latency_ms)
+        else:
+            self.failed += 1
+
+    def matches(self, affinity):
+        if affinity is None:
+            return True
+        return (
+            affinity == self.client_id
+            or (self.tab_url is not None and affinity in self.tab_url)
+            or (self.tab_title is not None and affinity in self.tab_title)
+        )
+
+    @property
+    def available(self):
+        return self.in_flight < self.max_in_flight
+
+    def to_dict(self):
+        return {
+            'clientId': self.client_id,
+            'remoteAddress': self.remote_address,
+            'connectedAt': self.connected_at,
+            'capabilities': sorted(self.capabilities),
+            'windowId': self.window_id,
+            'tabId': self.tab_id,
+            'tabTitle': self.tab_title,
+            'tabUrl': self.tab_url,
+            'inFlight': self.in_flight,
+            'maxInFlight': self.max_in_flight,
+            'latencyMs': self.latency_ms,
+            'completed': self.completed,
+            'failed': self.failed,
+        }
+
+
+class ClientRegistry:
+    """Connected clients keyed by websocket; iterates over the websockets"""
+
+    def __init__(self, max_in_flight=4):
+        self.max_in_flight = max_in_flight
+        self._clients = {}
+        self._changed = asyncio.Condition()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __iter__(self):
+        return iter(list(self._clients))
+
+    def __contains__(self, websocket):
+        return websocket in self._clients
+
+    def add(self, websocket):
+        info = ClientInfo(websocket, max_in_flight=self.max_in_flight)
+        self._clients[websocket] = info
+        self._notify()
+        return info
+
+    def remove(self, websocket):
+        info = self._clients.pop(websocket, None)
+        self._notify()
+        return info
+
+    def get(self, websocket):
+        return self._clients.get(websocket)
+
+    def by_id(self, client_id):
+        for info in self._clients.values():
+            if info.client_id == client_id:
+                return info
+        return None
+
+    def infos(self):
+        return list(self._clients.values())
+
+    def pick(self, policy=LEAST_LOADED, affinity=None):
+        """Best available client for a new command, or None if all are busy"""
+        candidates = [info for info in self._clients.values() if info.available]
+        if policy == AFFINITY or affinity is not None:
+            candidates = [info for info in candidates if info.matches(affinity)]
+        elif policy != LEAST_LOADED:
+            raise ValueError(f"Unknown routing policy: {policy}")
+        if not candidates:
+            return None
+        return min(
+            candidates,
+            key=lambda info: (
+                info.in_flight / info.max_in_flight,
+                info.latency_ms if info.latency_ms is not None else 0.0,
+            )
+        )
+
+    def has_candidates(self, affinity=None):
+        """Whether any connected client could ever serve this affinity"""
+        return any(info.matches(affinity) for info in self._clients.values())
+
+    async def acquire(self, policy=LEAST_LOADED, affinity=None, timeout=None, client=None):
+        """Reserve a slot on the chosen (or given) client, waiting while all are busy"""
+        async def wait_for_slot():
+            async with self._changed:
+                while True:
+                    if client is not None:
+                        info = self._clients.get(client)
+                        if info is None:
+                            raise ConnectionError("Target client is not connected")
+                        if not info.available:
+                            info = None
+                    else:
+                        if not self.has_candidates(affinity):
+                            raise ConnectionError(f"No connected client matches {affinity!r}")
+                        info = self.pick(policy, affinity)
+                    if info is not None:
+                        info.in_flight += 1
+                        return info
+                    await self._changed.wait()
+
+        return await asyncio.wait_for(wait_for_slot(), timeout)
+
+    def release(self, info, latency=None, ok=True):
+        """Free a slot taken by acquire() and record how the command went"""
+        info.in_flight = max(0, info.in_flight - 1)
+        if latency is not None:
+            info.record_result(latency, ok)
+        self._notify()
+
+    def _notify(self):
+        async def notify():
+            async with self._changed:
+                self._changed.notify_all()
+        try:
+            asyncio.get_running_loop().create_task(notify())
+        except RuntimeError:
+            # No running loop (e.g. during teardown): nobody can be waiting
+            pass
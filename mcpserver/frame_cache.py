@@ -0,0 +1,59 @@
+"""
+Freshness-bounded cache of the latest frame per tab.
+
+Agents tend to call screenshot tools in tight loops. FrameCache remembers
+the most recent capture of every (client, tab) and hands it back when the
+caller says it is fresh enough (``max_age_ms``), so most of those calls are
+answered without a browser round trip. A miss (or max_age_ms=0) means the
+caller captures and put()s the new frame.
+"""
+import time
+from collections import OrderedDict
+
+import metrics
+
+DEFAULT_MAX_ENTRIES = 256
+
+FRAME_CACHE_TOTAL = metrics.REGISTRY.counter(
+    'webmcp_frame_cache_total', 'Frame cache lookups, by result (hit, miss)')
+
+
+class CachedFrame:
+    __slots__ = ("image", "captured_at", "tab")
+
+    def __init__(self, image, captured_at, tab):
+        self.image = image
+        self.captured_at = captured_at
+        self.tab = tab
+
+    @property
+    def age_ms(self):
+        return (time.monotonic() - self.captured_at) * 1000
+
+
+class FrameCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._frames = OrderedDict()  # (client id, tab id) -> CachedFrame
+
+    def get(self, key, max_age_ms):
+        """The cached frame for ``key`` if it is at most max_age_ms old, else None"""
+        frame = self._frames.get(key)
+        if frame is None or max_age_ms <= 0 or frame.age_ms > max_age_ms:
+            FRAME_CACHE_TOTAL.inc(result='miss')
+            return None
+        self._frames.move_to_end(key)
+        FRAME_CACHE_TOTAL.inc(result='hit')
+        return frame
+
+    def put(self, key, image, captured_at=None, tab=None):
+        """Remember a capture; ``captured_at`` is a time.monotonic() value"""
+        frame = CachedFrame(image, time.monotonic() if captured_at is None else captured_at, tab)
+        self._frames[key] = frame
+        self._frames.move_to_end(key)
+        while len(self._frames) > self.max_entries:
+            self._frames.popitem(last=False)
+        return frame
+
+    def __len__(self):
+        return len(self._frames)
@@ -0,0 +1,316 @@
+"""
+Queryable index of saved screenshots.
+
+Every frame a ScreenshotWriter saves gets a row in a SQLite database (WAL
+mode) with when it was taken, which client and tab it came from, the tab's
+URL and title, its content hash and where its bytes live. Lookups go through
+indexes, so finding frames never means listing the screenshots directory:
+
+    frames for a URL (or URL prefix) between two times
+    frames from one client or tab, newest or oldest first
+    the latest frame of every tab (kept in a small ``tabs`` table)
+
+Results are paginated with an opaque ``cursor`` (keyset pagination on
+timestamp and row id), so deep pages cost the same as the first one.
+
+HTTP API (mounted on gateway.py, or standalone: python frame_index.py):
+
+    GET /frames?url=&url_prefix=&client=&tab=&since=&until=&order=&limit=&cursor=
+    GET /frames/latest?client=&limit=&offset=
+    GET /frames/<id>
+    GET /frames/<id>/image
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from screenshot_store import SCREENSHOTS_DIR
+
+DEFAULT_PATH = SCREENSHOTS_DIR / "frames.sqlite3"
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    id         INTEGER PRIMARY KEY,
+    timestamp  REAL NOT NULL,
+    client     TEXT,
+    tab_key    TEXT,
+    tab_id     TEXT,
+    tab_url    TEXT,
+    tab_title  TEXT,
+    command_id TEXT,
+    hash       TEXT,
+    path       TEXT,
+    offset     INTEGER,
+    size       INTEGER
+);
+CREATE INDEX IF NOT EXISTS frames_timestamp ON frames (timestamp, id);
+CREATE INDEX IF NOT EXISTS frames_client ON frames (client, timestamp, id);
+CREATE INDEX IF NOT EXISTS frames_tab ON frames (client, tab_key, timestamp, id);
+CREATE INDEX IF NOT EXISTS frames_url ON frames (tab_url, timestamp, id);
+CREATE INDEX IF NOT EXISTS frames_hash ON frames (hash);
+CREATE INDEX IF NOT EXISTS frames_path ON frames (path, offset);
+CREATE TABLE IF NOT EXISTS tabs (
+    client    TEXT NOT NULL,
+    tab_key   TEXT NOT NULL,
+    frame_id  INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    PRIMARY KEY (client, tab_key)
+);
+CREATE INDEX IF NOT EXISTS tabs_timestamp ON tabs (timestamp);
+"""
+
+COLUMNS = ("id", "timestamp", "client", "tab_id", "tab_url", "tab_title",
+           "command_id", "hash", "path", "offset", "size")
+
+
+def _encode_cursor(row):
+    return f"{row['timestamp']!r}:{row['id']}"
+
+
+def _decode_cursor(cursor):
+    timestamp, _, row_id = cursor.rpartition(":")
+    try:
+        return float(timestamp), int(row_id)
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+class FrameIndex:
+    def __init__(self, path=DEFAULT_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = str(path)
+        self._local = threading.local()
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        """One connection per thread; sqlite3 connections aren't shareable"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def add(self, data, meta, path=None):
+        """Index one saved frame and return its row id.
+
+        Reads timestamp, client, tab, tab_url, tab_title, commandId, hash
+        and (for archive segments) offset from the writer's ``meta``; the
+        hash is computed when the store didn't already. Raises ValueError
+        when ``path`` is already indexed with different content: a row must
+        never point at bytes that aren't its own.
+        """
+        digest = meta.get('hash') or hashlib.sha256(data).hexdigest()
+        timestamp = meta.get('timestamp') or time.time()
+        client = meta.get('client') or ''
+        tab_id = meta.get('tab')
+        tab_url = meta.get('tab_url')
+        # Frames without a tab id are grouped per URL for "latest per tab"
+        tab_key = str(tab_id) if tab_id is not None else (tab_url or '')
+        path = meta.get('path') or path
+        path = None if path is None else str(path)
+        offset = meta.get('offset')
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if path is not None:
+                existing = db.execute(
+                    "SELECT hash FROM frames WHERE path = ? AND offset IS ? LIMIT 1", (path, offset)
+                ).fetchone()
+                if existing is not None and existing['hash'] != digest:
+                    raise ValueError(f"{path} is already indexed with different content")
+            row_id = db.execute(
+                "INSERT INTO frames (timestamp, client, tab_key, tab_id, tab_url, tab_title, "
+                "command_id, hash, path, offset, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (timestamp, client, tab_key, None if tab_id is None else str(tab_id), tab_url,
+                 meta.get('tab_title'), meta.get('commandId'), digest, path, offset, len(data)),
+            ).lastrowid
+            db.execute(
+                """
+                INSERT INTO tabs (client, tab_key, frame_id, timestamp) VALUES (?, ?, ?, ?)
+                ON CONFLICT(client, tab_key) DO UPDATE SET
+                    frame_id = excluded.frame_id, timestamp = excluded.timestamp
+                WHERE excluded.timestamp >= tabs.timestamp
+                """,
+                (client, tab_key, row_id, timestamp),
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return row_id
+
+    def query(self, url=None, url_prefix=None, client=None, tab=None, since=None, until=None,
+              order='asc', limit=DEFAULT_PAGE_SIZE, cursor=None):
+        """One page of frames matching every given filter.
+
+        Returns (frames, next_cursor); next_cursor is None on the last page.
+        """
+        if order not in ('asc', 'desc'):
+            raise ValueError("order must be asc or desc")
+        limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+        where, params = [], []
+        if url is not None:
+            where.append("tab_url = ?")
+            params.append(url)
+        if url_prefix is not None:
+            # A range instead of LIKE so the tab_url index is used
+            where.append("tab_url >= ? AND tab_url < ?")
+            params += [url_prefix, url_prefix + "\U0010ffff"]
+        if client is not None:
+            where.append("client = ?")
+            params.append(client)
+        if tab is not None:
+            where.append("tab_key = ?")
+            params.append(str(tab))
+        if since is not None:
+            where.append("timestamp >= ?")
+            params.append(float(since))
+        if until is not None:
+            where.append("timestamp < ?")
+            params.append(float(until))
+        if cursor:
+            timestamp, row_id = _decode_cursor(cursor)
+            where.append("(timestamp, id) > (?, ?)" if order == 'asc' else "(timestamp, id) < (?, ?)")
+            params += [timestamp, row_id]
+        direction = "ASC" if order == 'asc' else "DESC"
+        sql = f"SELECT {', '.join(COLUMNS)} FROM frames"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY timestamp {direction}, id {direction} LIMIT ?"
+        rows = self._db().execute(sql, params + [limit + 1]).fetchall()
+        frames = [dict(row) for row in rows[:limit]]
+        next_cursor = _encode_cursor(frames[-1]) if len(rows) > limit else None
+        return frames, next_cursor
+
+    def latest_per_tab(self, client=None, limit=DEFAULT_PAGE_SIZE, offset=0):
+        """The newest frame of each tab, most recently updated tabs first"""
+        limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+        sql = (f"SELECT {', '.join('f.' + column for column in COLUMNS)} FROM tabs t "
+               "JOIN frames f ON f.id = t.frame_id")
+        params = []
+        if client is not None:
+            sql += " WHERE t.client = ?"
+            params.append(client)
+        sql += " ORDER BY t.timestamp DESC LIMIT ? OFFSET ?"
+        rows = self._db().execute(sql, params + [limit, max(int(offset), 0)]).fetchall()
+        return [dict(row) for row in rows]
+
+    def get(self, frame_id):
+        """One frame's row as a dict, or None"""
+        row = self._db().execute(
+            f"SELECT {', '.join(COLUMNS)} FROM frames WHERE id = ?", (frame_id,)
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def find_hash(self, digest, limit=DEFAULT_PAGE_SIZE):
+        """Frames with this content hash, newest first"""
+        rows = self._db().execute(
+            f"SELECT {', '.join(COLUMNS)} FROM frames WHERE hash = ? ORDER BY timestamp DESC LIMIT ?",
+            (digest, min(max(int(limit), 1), MAX_PAGE_SIZE)),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    @staticmethod
+    def read_image(frame):
+        """The image bytes of an indexed frame; OSError if they are gone.
+
+        Frames in archive segments (see archive_store.py) are read at their
+        offset, anything else is a whole file.
+        """
+        if not frame.get('path'):
+            raise FileNotFoundError(f"Frame {frame['id']} has no stored image")
+        with open(frame['path'], 'rb') as f:
+            if frame.get('offset') is None:
+                return f.read()
+            f.seek(frame['offset'])
+            return f.read(frame['size'])
+
+    def __len__(self):
+        return self._db().execute("SELECT COUNT(*) FROM frames").fetchone()[0]
+
+
+# --- HTTP API (aiohttp) ---
+
+def add_routes(app, index):
+    """Mount the query API on an aiohttp application"""
+    import asyncio
+    from aiohttp import web
+
+    def bad_request(e):
+        return web.json_response({"error": str(e)}, status=400)
+
+    async def handle_frames(request):
+        query = request.query
+        try:
+            frames, next_cursor = await asyncio.to_thread(
+                index.query,
+                url=query.get("url"), url_prefix=query.get("url_prefix"),
+                client=query.get("client"), tab=query.get("tab"),
+                since=query.get("since"), until=query.get("until"),
+                order=query.get("order", "asc"),
+                limit=query.get("limit", DEFAULT_PAGE_SIZE), cursor=query.get("cursor"),
+            )
+        except ValueError as e:
+            return bad_request(e)
+        return web.json_response({"frames": frames, "next": next_cursor})
+
+    async def handle_latest(request):
+        query = request.query
+        try:
+            frames = await asyncio.to_thread(
+                index.latest_per_tab, client=query.get("client"),
+                limit=query.get("limit", DEFAULT_PAGE_SIZE), offset=query.get("offset", 0),
+            )
+        except ValueError as e:
+            return bad_request(e)
+        return web.json_response({"frames": frames})
+
+    async def lookup(request):
+        try:
+            frame_id = int(request.match_info["frame_id"])
+        except ValueError:
+            raise web.HTTPNotFound(text="No such frame")
+        frame = await asyncio.to_thread(index.get, frame_id)
+        if frame is None:
+            raise web.HTTPNotFound(text="No such frame")
+        return frame
+
+    async def handle_frame(request):
+        return web.json_response(await lookup(request))
+
+    async def handle_image(request):
+        frame = await lookup(request)
+        try:
+            body = await asyncio.to_thread(index.read_image, frame)
+        except OSError:
+            # Deleted by hand or by archive retention
+            raise web.HTTPGone(text=f"Image of frame {frame['id']} is no longer stored")
+        return web.Response(body=body, content_type="image/png",
+                            headers={"ETag": f'"{frame["hash"]}"'})
+
+    app.router.add_get("/frames", handle_frames)
+    app.router.add_get("/frames/latest", handle_latest)
+    app.router.add_get("/frames/{frame_id}", handle_frame)
+    app.router.add_get("/frames/{frame_id}/image", handle_image)
+
+
+if __name__ == "__main__":
+    import argparse
+    from aiohttp import web
+
+    parser = argparse.ArgumentParser(description="Serve the screenshot index query API")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8768)
+    parser.add_argument("--db", default=str(DEFAULT_PATH), help="index database")
+    args = parser.parse_args()
+
+    app = web.Application()
+    add_routes(app, FrameIndex(args.db))
+    web.run_app(app, host=args.host, port=args.port)
@@ -0,0 +1,61 @@
+"""
+Binary WebSocket frames for screenshot payloads.
+
+Extensions that announce the ``binary_frames`` capability in their hello
+message send screenshots as a single binary WebSocket frame instead of a
+base64 data URL inside JSON:
+
+    [4-byte big-endian header length][UTF-8 JSON header][raw image bytes]
+
+The header carries the same fields as the JSON message (``action``/``type``,
+``id``/``commandId``, ``mime``...), minus the image itself.
+"""
+import base64
+import json
+import struct
+
+BINARY_FRAMES = 'binary_frames'
+
+_HEADER_LENGTH = struct.Struct('!I')
+
+
+def encode_frame(header, payload):
+    """Build a binary frame from a header dict and the image bytes"""
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return b''.join((_HEADER_LENGTH.pack(len(header_bytes)), header_bytes, payload))
+
+
+def decode_frame(message):
+    """Split a binary frame into its header dict and a memoryview of the image.
+
+    The payload is a zero-copy view into ``message``.
+    """
+    view = memoryview(message)
+    if len(view) < _HEADER_LENGTH.size:
+        raise ValueError("Binary frame too short")
+    (header_length,) = _HEADER_LENGTH.unpack_from(view)
+    payload_start = _HEADER_LENGTH.size + header_length
+    if payload_start > len(view):
+        raise ValueError("Binary frame header length exceeds frame size")
+    header = json.loads(view[_HEADER_LENGTH.size:payload_start].tobytes())
+    return header, view[payload_start:]
+
+
+def decode_data_url(data_url):
+    """Decode a 'data:image/png;base64,...' URL (legacy JSON path)"""
+    if not data_url or ',' not in data_url:
+        raise ValueError("Invalid data URL format")
+    return base64.b64decode(data_url.split(',', 1)[1])
+
+
+def supports_binary_frames(hello):
+    """Whether a client hello message asked for binary frames"""
+    return BINARY_FRAMES in (hello.get('capabilities') or [])
+
+
+def hello_response(hello, key='action'):
+    """Server answer to a client hello, enabling binary frames if requested"""
+    return json.dumps({
+        key: 'hello',
+        'binaryFrames': supports_binary_frames(hello),
+    })
@@ -0,0 +1,643 @@
+"""
+Single-loop screenshot gateway.
+
+One aiohttp application on one asyncio event loop serves both sides:
+
+    ws://localhost:8765/          the extension's WebSocket (also /ws)
+    GET /screenshot               one image (format/width/quality, client/tab)
+    GET /capture                  the same as a multipart response (server.py)
+    GET /stream?fps=N             live multipart/x-mixed-replace stream
+    GET/POST /capture-batch       several tabs or windows in one request,
+                                  streamed as multipart/mixed
+    GET /status, /clients         connection and routing state
+    GET /frames, /frames/latest   saved frames by time, client, tab or URL
+                                  (see frame_index.py)
+    GET /metrics                  Prometheus metrics, including event loop lag
+    GET /debug/...                loop stalls and profiles, with --debug-endpoints
+                                  (see loop_health.py)
+
+A capture never leaves the loop: the HTTP handler sends the command and
+awaits a future that the WebSocket handler resolves, with no
+run_coroutine_threadsafe or queue hops and no GIL contention between a
+WebSocket thread and Flask workers. HTTP and WebSocket share port 8765 by
+default; --http-port adds a second listener for the same application.
+
+Pass --uvloop to run on uvloop (pip install uvloop).
+"""
+import argparse
+import asyncio
+import base64
+import json
+import time
+import uuid
+
+from aiohttp import WSMsgType, web
+
+import metrics
+from capture_scheduler import INTERACTIVE, MONITORING, CaptureRejected, CaptureScheduler, parse_priority
+from client_registry import LEAST_LOADED, ClientRegistry
+from frame_index import FrameIndex, add_routes as add_index_routes
+from frames import decode_frame, hello_response
+from loop_health import LoopMonitor, add_routes as add_debug_routes
+from metrics import TRACER
+from screenshot_store import FileStore
+from screenshot_writer import ScreenshotWriter
+from single_flight import SingleFlight
+from transcoder import Transcoder, variant_from_args
+
+HOST = "localhost"
+PORT = 8765
+CAPTURE_TIMEOUT = 15
+# Concurrent callers for the same browser share one capture; a capture that
+# finished within the window is served to late arrivals too
+COALESCE_WINDOW = 0.25
+MAX_IN_FLIGHT_PER_CLIENT = 2
+CAPTURES_PER_SECOND = 2.0
+# Chrome allows only a couple of captureVisibleTab calls per second
+MAX_STREAM_FPS = 2.0
+MAX_MESSAGE_SIZE = 32 * 1024 * 1024
+SAVE_CAPTURES = True
+# Extensions announcing this capability take capture_batch commands
+BATCH_CAPTURE = "batch_capture"
+MAX_BATCH_TARGETS = 50
+BATCH_TARGET_KEYS = ("tabId", "windowId", "url")
+# Screenshot replies name the tab they show with these keys
+TAB_KEYS = ("tabId", "windowId", "tabUrl", "tabTitle")
+
+
+class Gateway:
+    def __init__(self, host=HOST, port=PORT, http_port=None, save_captures=SAVE_CAPTURES,
+                 debug_endpoints=False):
+        self.host = host
+        self.port = port
+        self.http_port = http_port
+        self.clients = ClientRegistry(max_in_flight=MAX_IN_FLIGHT_PER_CLIENT)
+        # Capture id -> (future, websocket it was sent to)
+        self.pending = {}
+        # Batch id -> (queue of (header, image) results, websocket it was sent to)
+        self.batches = {}
+        self.captures = SingleFlight(window=COALESCE_WINDOW)
+        # Per-client token buckets keep us under Chrome's capture rate limit
+        self.scheduler = CaptureScheduler(rate=CAPTURES_PER_SECOND)
+        self.index = FrameIndex() if save_captures else None
+        self.writer = ScreenshotWriter(FileStore(), index=self.index) if save_captures else None
+        self.transcoder = Transcoder()
+        # Everything shares this loop; a blocking callback shows up as lag
+        self.loop_monitor = LoopMonitor()
+        self.debug_endpoints = debug_endpoints
+        self._runner = None
+
+        metrics.CONNECTED_CLIENTS.set_function(lambda: len(self.clients))
+        metrics.QUEUE_DEPTH.set_function(lambda: len(self.pending), queue="pending_captures")
+        if self.writer is not None:
+            metrics.QUEUE_DEPTH.set_function(lambda: self.writer.backlog, queue="writer")
+
+    def make_app(self):
+        app = web.Application(client_max_size=MAX_MESSAGE_SIZE)
+        app.router.add_get("/", self.handle_root)
+        app.router.add_get("/ws", self.handle_extension)
+        app.router.add_get("/screenshot", self.handle_screenshot)
+        app.router.add_get("/capture", self.handle_capture)
+        app.router.add_get("/stream", self.handle_stream)
+        app.router.add_get("/capture-batch", self.handle_capture_batch)
+        app.router.add_post("/capture-batch", self.handle_capture_batch)
+        app.router.add_get("/status", self.handle_status)
+        app.router.add_get("/clients", self.handle_clients)
+        app.router.add_get("/metrics", self.handle_metrics)
+        if self.index is not None:
+            add_index_routes(app, self.index)
+        if self.debug_endpoints:
+            add_debug_routes(app, self.loop_monitor)
+        return app
+
+    # --- Extension side ---
+
+    async def handle_root(self, request):
+        # The extension connects to ws://host:8765 without a path
+        if web.WebSocketResponse().can_prepare(request).ok:
+            return await self.handle_extension(request)
+        return await self.handle_status(request)
+
+    async def handle_extension(self, request):
+        ws = web.WebSocketResponse(max_msg_size=MAX_MESSAGE_SIZE, heartbeat=30)
+        await ws.prepare(request)
+        info = self.clients.add(ws)
+        info.remote_address = request.remote
+        print(f"[Gateway] Extension connected from {request.remote} ({len(self.clients)} connected)")
+        try:
+            async for message in ws:
+                received_at = time.perf_counter()
+                if message.type == WSMsgType.BINARY:
+                    # Binary frame: JSON header + raw PNG bytes, no base64
+                    try:
+                        header, payload = decode_frame(message.data)
+                    except ValueError as e:
+                        print(f"[Gateway] Invalid binary frame: {e}")
+                        continue
+                    metrics.record_payload(len(payload), "binary")
+                    if header.get("action") == "batch_result":
+                        self.resolve_batch(ws, header, payload)
+                        continue
+                    # Late results must not reopen a trace that already finished
+                    if header.get("id") in self.pending:
+                        TRACER.mark(header.get("id"), "received", received_at)
+                    # Results may name the tab they show; saved frames are indexed by it
+                    info.update_tab(header)
+                    self.resolve(ws, header, payload)
+                elif message.type == WSMsgType.TEXT:
+                    try:
+                        data = json.loads(message.data)
+                    except json.JSONDecodeError as e:
+                        print(f"[Gateway] Invalid JSON message: {e}")
+                        continue
+                    if not isinstance(data, dict):
+                        print("[Gateway] Ignoring JSON message that isn't an object")
+                        continue
+                    await self.handle_text(ws, info, data, received_at)
+                elif message.type == WSMsgType.ERROR:
+                    print(f"[Gateway] WebSocket error: {ws.exception()}")
+        finally:
+            self.clients.remove(ws)
+            self.scheduler.remove(ws, "Extension disconnected")
+            self.captures.forget(ws)
+            self.fail_pending(ws, "Extension disconnected")
+            print(f"[Gateway] Extension disconnected ({len(self.clients)} connected)")
+        return ws
+
+    async def handle_text(self, ws, info, data, received_at):
+        action = data.get("action")
+        if action == "hello":
+            info.update_from_hello(data)
+            await ws.send_str(hello_response(data))
+        elif action in ("batch_result", "batch_done"):
+            image = None
+            data_url = data.get("dataUrl")
+            if data_url and not data.get("error"):
+                metrics.record_payload(len(data_url), "base64")
+                image = base64.b64decode(data_url.split(",", 1)[1])
+            self.resolve_batch(ws, data, image)
+        elif action == "tab":
+            # The extension reports tab switches, so captures are matched and
+            # cached under the tab that is in front now; a capture that just
+            # finished shows the previous tab and mustn't be shared any more
+            info.update_tab(data)
+            self.captures.forget(ws)
+        elif action == "screenshot" or data.get("error"):
+            info.update_tab(data)
+            image = None
+            data_url = data.get("dataUrl")
+            if data_url and not data.get("error"):
+                metrics.record_payload(len(data_url), "base64")
+                traced = data.get("id") in self.pending
+                if traced:
+                    TRACER.mark(data.get("id"), "received", received_at)
+                image = base64.b64decode(data_url.split(",", 1)[1])
+                if traced:
+                    TRACER.mark(data.get("id"), "decoded")
+            self.resolve(ws, data, image)
+        else:
+            print(f"[Gateway] Unknown action: {action}")
+
+    def resolve(self, ws, header, image):
+        """Hand a screenshot (or the extension's error) to the capture waiting for it"""
+        capture_id = header.get("id")
+        entry = self.pending.pop(capture_id, None)
+        if entry is None and capture_id is None:
+            # Older extension builds don't echo the id; answer this client's oldest capture
+            capture_id = next((key for key, (_, target) in self.pending.items() if target is ws), None)
+            entry = self.pending.pop(capture_id, None)
+        if entry is None or entry[0].done():
+            return
+        future = entry[0]
+        if header.get("error"):
+            future.set_exception(RuntimeError(header["error"]))
+        elif image is None:
+            future.set_exception(RuntimeError("No screenshot data received"))
+        else:
+            future.set_result((image, header))
+
+    def resolve_batch(self, ws, header, image):
+        """Queue one result of a batch (or its end) for the request streaming it"""
+        entry = self.batches.get(header.get("id"))
+        if entry is not None and entry[1] is ws:
+            entry[0].put_nowait((header, image))
+
+    def fail_pending(self, ws, error):
+        for capture_id, (future, target) in list(self.pending.items()):
+            if target is ws:
+                del self.pending[capture_id]
+                if not future.done():
+                    future.set_exception(ConnectionError(error))
+        for queue, target in self.batches.values():
+            if target is ws:
+                queue.put_nowait(ConnectionError(error))
+
+    # --- Captures ---
+
+    async def capture(self, affinity=None, priority=INTERACTIVE, deadline=None):
+        """One screenshot from the best matching client, shared with concurrent callers.
+
+        ``deadline`` (time.monotonic()) lets the scheduler refuse captures
+        that would finish too late; see capture_scheduler.py.
+        """
+        return await self.capture_client(self.pick_client(affinity), priority, deadline)
+
+    def pick_client(self, affinity=None, capability=None):
+        """The client a capture for ``affinity`` goes to; ConnectionError if none matches"""
+        candidates = [info for info in self.clients.infos() if info.matches(affinity)]
+        if not candidates:
+            raise ConnectionError("No extension connected" if affinity is None
+                                  else f"No connected extension matches {affinity!r}")
+        if capability is not None:
+            candidates = [info for info in candidates if capability in info.capabilities]
+            if not candidates:
+                raise ConnectionError(f"No connected extension supports {capability}")
+            return min(candidates, key=lambda i: i.in_flight)
+        # Prefer a client with a free slot; when all are busy, queue behind the
+        # least busy one (or join its in-flight capture)
+        return self.clients.pick(LEAST_LOADED, affinity) or min(candidates, key=lambda i: i.in_flight)
+
+    async def capture_client(self, info, priority=INTERACTIVE, deadline=None, max_age=None):
+        """Like capture(), from a client chosen with pick_client().
+
+        A capture that finished at most ``max_age`` seconds ago (default
+        COALESCE_WINDOW) is shared instead of taking another one.
+        """
+        image, _ = await self.capture_frame(info, priority, deadline, max_age)
+        return image
+
+    async def capture_frame(self, info, priority=INTERACTIVE, deadline=None, max_age=None):
+        """Like capture_client(), returning (image, tab): the TAB_KEYS of the tab it shows.
+
+        Extensions that don't name the tab in their reply get the client's
+        last known tab.
+        """
+        return await self.captures.run(info.websocket, lambda: self._capture_from(info, priority, deadline),
+                                       max_age=max_age)
+
+    async def _capture_from(self, info, priority, deadline):
+        loop = asyncio.get_running_loop()
+        capture_id = str(uuid.uuid4())
+        TRACER.mark(capture_id, "issued")
+        try:
+            await self.scheduler.acquire(info.websocket, priority, deadline)
+            await self.clients.acquire(client=info.websocket, timeout=CAPTURE_TIMEOUT)
+        except CaptureRejected:
+            TRACER.finish(capture_id, "rejected")
+            raise
+        except BaseException:
+            TRACER.finish(capture_id, "error")
+            raise
+        started = loop.time()
+        future = loop.create_future()
+        self.pending[capture_id] = (future, info.websocket)
+        outcome = "error"
+        try:
+            await info.websocket.send_str(json.dumps({"action": "capture", "id": capture_id}))
+            TRACER.mark(capture_id, "sent")
+            image, reply = await asyncio.wait_for(future, timeout=CAPTURE_TIMEOUT)
+            outcome = "ok"
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise
+        finally:
+            self.pending.pop(capture_id, None)
+            self.clients.release(info, loop.time() - started, outcome == "ok")
+            if outcome == "ok":
+                self.scheduler.record(info.websocket, loop.time() - started)
+            if outcome != "ok":
+                TRACER.finish(capture_id, outcome)
+
+        known = (info.tab_id, info.window_id, info.tab_url, info.tab_title)
+        tab = {key: reply.get(key, default) for key, default in zip(TAB_KEYS, known)}
+        if self.writer is not None:
+            saved = await self.writer.submit(image, client=info.client_id, tab=tab["tabId"],
+                                             tab_url=tab["tabUrl"], tab_title=tab["tabTitle"])
+            saved.add_done_callback(lambda f: self._trace_persisted(capture_id, f))
+        else:
+            TRACER.finish(capture_id, "ok")
+        return image, tab
+
+    async def capture_batch(self, targets, affinity=None, priority=INTERACTIVE, deadline=None):
+        """Capture several tabs/windows with one command, yielding (header, image) as each arrives.
+
+        ``targets`` are dicts with a tabId, a windowId (its active tab) or a
+        url (every tab whose URL contains it). The extension captures them
+        one after another at Chrome's capture rate; failed targets are
+        yielded with an "error" in the header and no image. Waits at most
+        CAPTURE_TIMEOUT for each result.
+        """
+        info = self.pick_client(affinity, BATCH_CAPTURE)
+        # The batch is one scheduling unit; the extension paces the captures in it
+        await self.scheduler.acquire(info.websocket, priority, deadline)
+        await self.clients.acquire(client=info.websocket, timeout=CAPTURE_TIMEOUT)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        batch_id = str(uuid.uuid4())
+        queue = asyncio.Queue()
+        self.batches[batch_id] = (queue, info.websocket)
+        ok = False
+        try:
+            await info.websocket.send_str(json.dumps({"action": "capture_batch", "id": batch_id, "targets": targets}))
+            while True:
+                item = await asyncio.wait_for(queue.get(), timeout=CAPTURE_TIMEOUT)
+                if isinstance(item, Exception):
+                    raise item
+                header, image = item
+                if header.get("action") == "batch_done":
+                    break
+                if image is None:
+                    header.setdefault("error", "No screenshot data received")
+                elif self.writer is not None:
+                    # Results arrive within the same second; each one is its own file and row
+                    await self.writer.submit(image, client=info.client_id, tab=header.get("tabId"),
+                                             tab_url=header.get("tabUrl"), tab_title=header.get("tabTitle"),
+                                             commandId=batch_id)
+                yield header, image
+            ok = True
+        finally:
+            self.batches.pop(batch_id, None)
+            self.clients.release(info, loop.time() - started, ok)
+
+    def _trace_persisted(self, capture_id, saved):
+        if saved.cancelled() or saved.exception() is not None:
+            TRACER.finish(capture_id, "persist_error")
+        else:
+            TRACER.mark(capture_id, "persisted")
+            TRACER.finish(capture_id, "ok")
+
+    # --- HTTP side ---
+
+    @staticmethod
+    def affinity(request):
+        return request.query.get("client") or request.query.get("tab")
+
+    def variant(self, request):
+        variant = variant_from_args(request.query)
+        if not variant.is_original and not self.transcoder.available:
+            raise web.HTTPNotImplemented(text="Transcoding needs Pillow: pip install pillow")
+        return variant
+
+    async def capture_variant(self, request):
+        """Capture and transcode for an HTTP request; errors become HTTP responses"""
+        try:
+            variant = self.variant(request)
+            priority = parse_priority(request.query.get("priority"))
+            timeout = float(request.query.get("deadline_ms", CAPTURE_TIMEOUT * 1000)) / 1000
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        try:
+            image = await self.capture(self.affinity(request), priority, time.monotonic() + timeout)
+            return variant, await self.transcoder.transcode(image, variant)
+        except CaptureRejected as e:
+            headers = {"Retry-After": str(max(1, round(e.retry_after)))} if e.retry_after else None
+            raise web.HTTPTooManyRequests(text=str(e), headers=headers)
+        except ConnectionError as e:
+            raise web.HTTPServiceUnavailable(text=str(e))
+        except asyncio.TimeoutError:
+            raise web.HTTPGatewayTimeout(text="Screenshot capture timed out")
+        except RuntimeError as e:
+            raise web.HTTPBadGateway(text=f"Extension failed to capture screenshot: {e}")
+        except OSError as e:
+            raise web.HTTPBadGateway(text=f"Transcoding failed: {e}")
+
+    async def handle_screenshot(self, request):
+        """
+        GET /screenshot - the active tab as one image.
+
+        Query parameters:
+          format/width/quality - transcoded variant (see transcoder.py)
+          client or tab        - route to the extension with this client id,
+                                 or whose tab URL/title contains this text
+          priority             - interactive (default) or monitoring
+          deadline_ms          - answer 429 right away if the capture can't
+                                 finish within this many ms (default 15000)
+        """
+        variant, body = await self.capture_variant(request)
+        return web.Response(body=body, content_type=variant.mime_type)
+
+    async def handle_capture(self, request):
+        """GET /capture - like /screenshot, as the multipart body server.py returns"""
+        variant, body = await self.capture_variant(request)
+        return web.Response(
+            body=b"--frame\r\nContent-Type: " + variant.mime_type.encode() + b"\r\n\r\n"
+                 + body + b"\r\n--frame--\r\n",
+            headers={"Content-Type": "multipart/x-mixed-replace; boundary=frame"},
+        )
+
+    async def handle_stream(self, request):
+        """
+        GET /stream?fps=N - live multipart/x-mixed-replace stream.
+
+        Viewers of the same browser share captures through the single-flight
+        coalescing, so extra viewers don't cost extra captureVisibleTab calls.
+        """
+        try:
+            fps = min(max(float(request.query.get("fps", 1.0)), 0.1), MAX_STREAM_FPS)
+            variant = self.variant(request)
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        affinity = self.affinity(request)
+        if not any(info.matches(affinity) for info in self.clients.infos()):
+            raise web.HTTPServiceUnavailable(text="No matching extension connected")
+        response = web.StreamResponse(headers={"Content-Type": "multipart/x-mixed-replace; boundary=frame"})
+        await response.prepare(request)
+        loop = asyncio.get_running_loop()
+        try:
+            while request.transport is not None and not request.transport.is_closing():
+                started = loop.time()
+                try:
+                    image = await self.capture(affinity, MONITORING, time.monotonic() + CAPTURE_TIMEOUT)
+                    frame = await self.transcoder.transcode(image, variant)
+                except CaptureRejected:
+                    # Interactive requests are using the budget; skip this frame
+                    frame = None
+                except ConnectionError as e:
+                    print(f"[Gateway] Stream ended: {e}")
+                    break
+                except (RuntimeError, OSError, asyncio.TimeoutError) as e:
+                    print(f"[Gateway] Stream capture failed: {e}")
+                    frame = None
+                if frame is not None:
+                    await response.write(
+                        b"--frame\r\nContent-Type: " + variant.mime_type.encode()
+                        + f"\r\nContent-Length: {len(frame)}\r\n\r\n".encode() + frame + b"\r\n"
+                    )
+                await asyncio.sleep(max(0.0, 1.0 / fps - (loop.time() - started)))
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        return response
+
+    @staticmethod
+    def batch_targets(request, body):
+        """Targets from a JSON body ({"targets": [...]}) or tabId/windowId/url query parameters"""
+        if body is not None:
+            targets = body.get("targets") if isinstance(body, dict) else None
+            if not isinstance(targets, list):
+                raise ValueError('Body must be {"targets": [{"tabId": ...}, {"windowId": ...}, {"url": ...}]}')
+        else:
+            targets = [{key: value} for key in BATCH_TARGET_KEYS
+                       for values in request.query.getall(key, []) for value in values.split(",") if value]
+        if not targets:
+            raise ValueError("No targets: pass tabId, windowId or url")
+        if len(targets) > MAX_BATCH_TARGETS:
+            raise ValueError(f"At most {MAX_BATCH_TARGETS} targets per batch")
+        cleaned = []
+        for target in targets:
+            keys = [key for key in BATCH_TARGET_KEYS if isinstance(target, dict) and key in target]
+            if len(keys) != 1:
+                raise ValueError(f"Each target needs exactly one of tabId, windowId or url: {target!r}")
+            key = keys[0]
+            try:
+                cleaned.append({key: str(target[key]) if key == "url" else int(target[key])})
+            except (TypeError, ValueError):
+                raise ValueError(f"{key} must be an integer: {target!r}")
+        return cleaned
+
+    async def handle_capture_batch(self, request):
+        """
+        GET or POST /capture-batch - several tabs or windows with one command.
+
+        Targets come from repeated (or comma-separated) query parameters
+        tabId, windowId (that window's active tab) and url (every tab whose
+        URL contains the text), or from a POST body
+        {"targets": [{"tabId": 12}, {"windowId": 3}, {"url": "grafana"}]}.
+        format/width/quality, client and priority work as for /screenshot.
+
+        The response is multipart/mixed and streamed: each image is written
+        as soon as it arrives, with an X-Capture-Info JSON header naming the
+        target index, tab and window. A target that failed gets an
+        application/json part with its error instead.
+        """
+        try:
+            body = await request.json() if request.method == "POST" and request.can_read_body else None
+            targets = self.batch_targets(request, body)
+            variant = self.variant(request)
+            priority = parse_priority(request.query.get("priority"))
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        results = self.capture_batch(targets, self.affinity(request), priority,
+                                     time.monotonic() + CAPTURE_TIMEOUT)
+        response = web.StreamResponse(headers={"Content-Type": "multipart/mixed; boundary=frame"})
+        try:
+            # Errors before the first result still become a plain HTTP status
+            first = await results.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except CaptureRejected as e:
+            headers = {"Retry-After": str(max(1, round(e.retry_after)))} if e.retry_after else None
+            raise web.HTTPTooManyRequests(text=str(e), headers=headers)
+        except ConnectionError as e:
+            raise web.HTTPServiceUnavailable(text=str(e))
+        except asyncio.TimeoutError:
+            raise web.HTTPGatewayTimeout(text="Batch capture timed out")
+        await response.prepare(request)
+        try:
+            try:
+                if first is not None:
+                    await self._write_batch_part(response, variant, *first)
+                    async for header, image in results:
+                        await self._write_batch_part(response, variant, header, image)
+            except (ConnectionResetError, asyncio.CancelledError):
+                # The caller went away; the generator's cleanup frees the client
+                raise
+            except (ConnectionError, asyncio.TimeoutError) as e:
+                # Too late for a status code: end the stream with an error part
+                await self._write_part(response, "application/json",
+                                       json.dumps({"error": str(e) or "Batch capture timed out"}).encode())
+            await response.write(b"--frame--\r\n")
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            await results.aclose()
+        return response
+
+    async def _write_batch_part(self, response, variant, header, image):
+        capture_info = {key: header.get(key) for key in
+                        ("index", "target", "tabId", "windowId", "tabUrl", "tabTitle")}
+        if image is not None:
+            try:
+                body = await self.transcoder.transcode(image, variant)
+                await self._write_part(response, variant.mime_type, body, capture_info)
+                return
+            except OSError as e:
+                header = dict(header, error=f"Transcoding failed: {e}")
+        capture_info["error"] = header.get("error")
+        await self._write_part(response, "application/json", json.dumps(capture_info).encode(), capture_info)
+
+    @staticmethod
+    async def _write_part(response, content_type, body, capture_info=None):
+        headers = f"--frame\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+        if capture_info is not None:
+            # ensure_ascii keeps tab titles valid in an HTTP header
+            headers += f"X-Capture-Info: {json.dumps(capture_info)}\r\n"
+        await response.write(headers.encode() + b"\r\n" + body + b"\r\n")
+
+    async def handle_status(self, request):
+        return web.json_response({"extension_connected": len(self.clients) > 0, "clients": len(self.clients)})
+
+    async def handle_clients(self, request):
+        return web.json_response([info.to_dict() for info in self.clients.infos()])
+
+    async def handle_metrics(self, request):
+        return web.Response(body=metrics.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+    # --- Lifecycle ---
+
+    async def start(self):
+        """Start listening; for embedding the gateway in another program's loop"""
+        self.loop_monitor.start()
+        self.loop_monitor.install_signal_handlers()
+        if self.writer is not None:
+            await self.writer.start()
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        ports = [self.port] + ([self.http_port] if self.http_port and self.http_port != self.port else [])
+        for port in ports:
+            await web.TCPSite(self._runner, self.host, port).start()
+        print(f"[Gateway] Extension WebSocket on ws://{self.host}:{self.port}")
+        print("[Gateway] HTTP API on " + ", ".join(f"http://{self.host}:{port}" for port in ports))
+
+    async def stop(self):
+        self.loop_monitor.stop()
+        await self._runner.cleanup()
+        if self.writer is not None:
+            await self.writer.close()
+        self.transcoder.close()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Future()
+        finally:
+            await self.stop()
+
+
+def run(coro, use_uvloop=False):
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            print("💡 uvloop not installed, using the default event loop: pip install uvloop")
+        else:
+            print("[Gateway] Using uvloop")
+            return uvloop.run(coro)
+    return asyncio.run(coro)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extension WebSocket and HTTP API on one event loop")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT, help="WebSocket (and HTTP) port")
+    parser.add_argument("--http-port", type=int, help="also serve the HTTP API on this port")
+    parser.add_argument("--uvloop", action="store_true", help="run on uvloop if installed")
+    parser.add_argument("--no-save", action="store_true", help="don't write captures to disk")
+    parser.add_argument("--debug-endpoints", action="store_true",
+                        help="serve /debug/loop, /debug/profile and /debug/tracemalloc")
+    args = parser.parse_args()
+    gateway = Gateway(args.host, args.port, args.http_port, save_captures=not args.no_save,
+                      debug_endpoints=args.debug_endpoints)
+    try:
+        run(gateway.serve_forever(), args.uvloop)
+    except KeyboardInterrupt:
+        print("\n[Gateway] Stopped")
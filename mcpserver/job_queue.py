@@ -0,0 +1,184 @@
+"""
+Durable screenshot job queue for the polling (sserver.py) protocol.
+
+Jobs live in a SQLite database in WAL mode, so pending requests survive a
+restart and several server processes (e.g. gunicorn workers) can share one
+queue. The extension's /check-status poll claims a batch of jobs in a single
+write transaction; a claimed job becomes visible again after
+``visibility_timeout`` seconds unless /upload-screenshot completes it, so
+work an extension took but never uploaded is retried instead of lost.
+
+Job lifecycle:
+
+    pending --claim--> claimed --complete--> done
+                          |
+                          +--visibility timeout--> claimable again
+                          +--max_attempts claims--> failed
+
+Long-polls block on a condition variable for requests made in this process
+and re-check the database every ``poll_interval`` for those made by others.
+"""
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from screenshot_store import SCREENSHOTS_DIR
+
+DEFAULT_PATH = SCREENSHOTS_DIR / "jobs.sqlite3"
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id           TEXT PRIMARY KEY,
+    status       TEXT NOT NULL,
+    created      REAL NOT NULL,
+    visible_at   REAL NOT NULL,
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    claimed_by   TEXT,
+    claimed_at   REAL,
+    completed_at REAL,
+    result_path  TEXT,
+    result_size  INTEGER,
+    error        TEXT,
+    payload      TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_claimable ON jobs (status, visible_at, created);
+CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created);
+"""
+
+
+class JobQueue:
+    def __init__(self, path=DEFAULT_PATH, visibility_timeout=60, max_attempts=3, poll_interval=0.5):
+        """
+        visibility_timeout - seconds a claimed job may go without an upload
+                             before another poll can claim it again
+        max_attempts       - claims before a job is marked failed
+        poll_interval      - how often long-polls re-check the database for
+                             jobs added by other processes
+        """
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = str(path)
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        """One connection per thread; sqlite3 connections aren't shareable"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # Autocommit mode: transactions are explicit BEGIN IMMEDIATE blocks
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def put(self, job_id, payload=None):
+        """Queue a job; re-requesting a known id queues it again"""
+        now = time.time()
+        self._db().execute(
+            """
+            INSERT INTO jobs (id, status, created, visible_at, payload) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                status = excluded.status, created = excluded.created,
+                visible_at = excluded.visible_at, attempts = 0, claimed_by = NULL,
+                claimed_at = NULL, completed_at = NULL, error = NULL, payload = excluded.payload
+            """,
+            (job_id, PENDING, now, now, json.dumps(payload) if payload is not None else None),
+        )
+        with self._cond:
+            self._cond.notify()
+
+    def claim(self, max_items=1, worker=None):
+        """Atomically claim up to max_items claimable jobs, oldest first"""
+        db = self._db()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # Jobs claimed too often are given up on rather than retried forever
+            db.execute(
+                "UPDATE jobs SET status = ?, error = 'no upload after repeated claims' "
+                "WHERE status = ? AND visible_at <= ? AND attempts >= ?",
+                (FAILED, CLAIMED, now, self.max_attempts),
+            )
+            rows = db.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?) AND visible_at <= ? "
+                "ORDER BY created LIMIT ?",
+                (PENDING, CLAIMED, now, max_items),
+            ).fetchall()
+            if rows:
+                db.executemany(
+                    "UPDATE jobs SET status = ?, claimed_by = ?, claimed_at = ?, visible_at = ?, "
+                    "attempts = attempts + 1 WHERE id = ?",
+                    [(CLAIMED, worker, now, now + self.visibility_timeout, row['id']) for row in rows],
+                )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return [self._to_request(row) for row in rows]
+
+    def take(self, max_items=1, timeout=0, worker=None):
+        """Claim up to max_items jobs, long-polling for up to ``timeout`` seconds"""
+        deadline = time.monotonic() + timeout
+        while True:
+            jobs = self.claim(max_items, worker)
+            remaining = deadline - time.monotonic()
+            if jobs or remaining <= 0:
+                return jobs
+            with self._cond:
+                self._cond.wait(min(remaining, self.poll_interval))
+
+    def complete(self, job_id, result_path=None, result_size=None):
+        """Record a job's result; also accepts uploads for ids nobody queued"""
+        now = time.time()
+        self._db().execute(
+            """
+            INSERT INTO jobs (id, status, created, visible_at, completed_at, result_path, result_size)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                status = excluded.status, completed_at = excluded.completed_at,
+                result_path = excluded.result_path, result_size = excluded.result_size, error = NULL
+            """,
+            (job_id, DONE, now, now, now, result_path, result_size),
+        )
+
+    def fail(self, job_id, error):
+        self._db().execute(
+            "UPDATE jobs SET status = ?, error = ?, completed_at = ? WHERE id = ?",
+            (FAILED, error, time.time(), job_id),
+        )
+
+    def get(self, job_id):
+        """The job's row as a dict, or None"""
+        row = self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def counts(self):
+        rows = self._db().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def __len__(self):
+        """Jobs waiting to be claimed, including ones whose claim expired"""
+        return self._db().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?) AND visible_at <= ?",
+            (PENDING, CLAIMED, time.time()),
+        ).fetchone()[0]
+
+    @staticmethod
+    def _to_request(row):
+        """The shape /check-status has always handed to the extension"""
+        request = json.loads(row['payload']) if row['payload'] else {}
+        request.update({"id": row['id'], "status": PENDING, "timestamp": row['created'],
+                        "attempt": row['attempts'] + 1})
+        return request
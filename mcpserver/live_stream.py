@@ -0,0 +1,141 @@
+"""
+Live multi-subscriber screenshot streams.
+
+One LiveStream runs a single capture loop per browser and fans the frames out
+to any number of HTTP subscribers through a small shared ring buffer. A
+subscriber always jumps to the newest frame, so a slow viewer skips frames
+instead of queueing them, and memory stays bounded no matter how many
+viewers there are.
+
+The capture loop runs on the WebSocket event loop; subscribers are Flask
+worker threads, so the ring is guarded by a threading.Condition.
+"""
+import asyncio
+import threading
+import time
+
+
+class FrameRing:
+    """Fixed-size ring of the most recent frames, tagged with sequence numbers"""
+
+    def __init__(self, size=4):
+        self._frames = [None] * size
+        self._seq = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def publish(self, frame):
+        with self._cond:
+            self._seq += 1
+            self._frames[self._seq % len(self._frames)] = frame
+            self._cond.notify_all()
+            return self._seq
+
+    def latest_after(self, seq, timeout):
+        """Newest (seq, frame) newer than ``seq``; None on timeout or close"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq > seq or self._closed, timeout=timeout)
+            if self._seq <= seq:
+                return None
+            return self._seq, self._frames[self._seq % len(self._frames)]
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+
+class LiveStream:
+    def __init__(self, capture, loop, max_fps=2.0, ring_size=4):
+        """
+        capture  - coroutine function returning one frame's bytes
+        loop     - event loop the capture loop runs on
+        max_fps  - upper bound on captures per second; Chrome rate-limits
+                   captureVisibleTab, so every subscriber shares this budget
+        """
+        self.capture = capture
+        self.loop = loop
+        self.max_fps = max_fps
+        self.ring = FrameRing(ring_size)
+        self._lock = threading.Lock()
+        self._subscribers = {}  # token -> requested fps
+        self._task = None
+
+    @property
+    def subscribers(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def frames(self, fps, timeout=15):
+        """Generator of frame bytes for one subscriber at up to ``fps``.
+
+        When no new frame arrives for ``timeout`` seconds the last one is
+        sent again as a keep-alive: a failed write is the only way a WSGI
+        server notices a viewer that went away, and the capture loop runs
+        until every viewer has. A stream without any frame by then ends.
+        """
+        token = object()
+        self._subscribe(token, fps)
+        try:
+            seq, frame = 0, None
+            interval = 1.0 / fps
+            while not self.ring.closed:
+                started = time.monotonic()
+                item = self.ring.latest_after(seq, timeout)
+                if item is not None:
+                    seq, frame = item
+                elif self.ring.closed or frame is None:
+                    return
+                yield frame
+                # A subscriber asking for fewer fps than the loop produces
+                # simply skips the frames in between
+                remaining = interval - (time.monotonic() - started)
+                if remaining > 0:
+                    time.sleep(remaining)
+        finally:
+            self._unsubscribe(token)
+
+    def close(self):
+        """Stop capturing and end every subscriber's stream"""
+        self.ring.close()
+        if self._task is not None:
+            self.loop.call_soon_threadsafe(self._task.cancel)
+
+    def _subscribe(self, token, fps):
+        with self._lock:
+            self._subscribers[token] = fps
+            if self._task is None:
+                self._task = asyncio.run_coroutine_threadsafe(self._run(), self.loop)
+
+    def _unsubscribe(self, token):
+        with self._lock:
+            self._subscribers.pop(token, None)
+
+    async def _run(self):
+        try:
+            while True:
+                with self._lock:
+                    if not self._subscribers:
+                        # Cleared under the lock so a new subscriber starts a new loop
+                        self._task = None
+                        return
+                    fps = min(self.max_fps, max(self._subscribers.values()))
+                started = self.loop.time()
+                try:
+                    frame = await self.capture()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"[Stream] Capture failed: {e}")
+                    frame = None
+                if frame is not None:
+                    self.ring.publish(bytes(frame))
+                await asyncio.sleep(max(0.0, 1.0 / fps - (self.loop.time() - started)))
+        except BaseException:
+            with self._lock:
+                self._task = None
+            raise
@@ -0,0 +1,283 @@
+"""
+Event loop health: lag sampling, a blocked-loop watchdog and on-demand profiling.
+
+Everything on an asyncio server shares one thread, so one slow callback (a
+json.loads of a multi-MB message, a synchronous file write, printing a data
+URL) stalls every client. LoopMonitor makes that visible:
+
+    lag       a timer fires every ``interval`` seconds; how late it runs goes
+              into webmcp_event_loop_lag_seconds (histogram) and
+              webmcp_event_loop_lag_seconds_max (worst since start)
+    watchdog  a thread notices when the timer hasn't run for
+              ``block_threshold`` seconds and grabs the loop thread's stack
+              *while it is still blocked*, so the log names the culprit;
+              stalls are counted in webmcp_event_loop_blocked_total
+    profiles  profile_cpu(seconds) runs cProfile on the loop thread and
+              trace_memory(seconds) diffs two tracemalloc snapshots; both
+              write a text report to PROFILES_DIR and return it
+
+Profiles are opt-in, triggered by signals (install_signal_handlers, Unix):
+
+    kill -USR1 <pid>    cProfile for PROFILE_SECONDS
+    kill -USR2 <pid>    tracemalloc for PROFILE_SECONDS
+
+or, on aiohttp servers started with --debug-endpoints, over HTTP
+(add_routes):
+
+    GET /debug/loop                         lag, stalls and their stacks
+    GET /debug/profile?seconds=10&sort=cumulative
+    GET /debug/tracemalloc?seconds=10&limit=30
+"""
+import asyncio
+import cProfile
+import io
+import logging
+import pstats
+import signal
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import deque
+from datetime import datetime
+
+import metrics
+from screenshot_store import SCREENSHOTS_DIR
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.1
+BLOCK_THRESHOLD = 0.25
+PROFILE_SECONDS = 10
+MAX_PROFILE_SECONDS = 120
+MAX_RECENT_STALLS = 20
+PROFILES_DIR = SCREENSHOTS_DIR.parent / "profiles"
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LOOP_LAG = metrics.REGISTRY.histogram(
+    'webmcp_event_loop_lag_seconds', 'How late the event loop ran a timer', buckets=LAG_BUCKETS)
+LOOP_LAG_MAX = metrics.REGISTRY.gauge(
+    'webmcp_event_loop_lag_seconds_max', 'Largest event loop lag since start')
+LOOP_BLOCKED_TOTAL = metrics.REGISTRY.counter(
+    'webmcp_event_loop_blocked_total', 'Times the event loop was blocked for over the threshold')
+
+
+class Stall:
+    """One period the loop was blocked, with the stack that was running"""
+    __slots__ = ("started", "duration", "stack")
+
+    def __init__(self, started, duration, stack):
+        self.started = started
+        self.duration = duration
+        self.stack = stack
+
+    def to_dict(self):
+        return {"started": self.started, "duration": round(self.duration, 4), "stack": self.stack}
+
+
+class LoopMonitor:
+    def __init__(self, interval=SAMPLE_INTERVAL, block_threshold=BLOCK_THRESHOLD):
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.max_lag = 0.0
+        self.stalls = deque(maxlen=MAX_RECENT_STALLS)
+        self.loop = None
+        self._handle = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        self._loop_thread = None
+        # Written by the loop, read by the watchdog thread
+        self._last_beat = time.monotonic()
+        self._stall_stack = None
+        self._profiling = False
+
+    def start(self, loop=None):
+        """Start sampling ``loop`` (default: the running loop); call from its thread"""
+        self.loop = loop or asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._schedule()
+        if self.block_threshold:
+            self._watchdog = threading.Thread(target=self._watch, daemon=True, name="loop-watchdog")
+            self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    # --- Lag ---
+
+    def _schedule(self):
+        self._handle = self.loop.call_at(self.loop.time() + self.interval, self._beat,
+                                         self.loop.time() + self.interval)
+
+    def _beat(self, expected):
+        lag = max(0.0, self.loop.time() - expected)
+        LOOP_LAG.observe(lag)
+        if lag > self.max_lag:
+            self.max_lag = lag
+            LOOP_LAG_MAX.set(lag)
+        if self._stall_stack is not None:
+            self._report_stall(lag, self._stall_stack)
+            self._stall_stack = None
+        self._last_beat = time.monotonic()
+        if not self._stopped.is_set():
+            self._schedule()
+
+    # --- Watchdog ---
+
+    def _watch(self):
+        reported_beat = None
+        while not self._stopped.wait(self.block_threshold / 2):
+            beat = self._last_beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.block_threshold or beat == reported_beat:
+                continue
+            # Still blocked: this is the code holding the loop up
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                self._stall_stack = "".join(traceback.format_stack(frame))
+                reported_beat = beat
+
+    def _report_stall(self, duration, stack):
+        LOOP_BLOCKED_TOTAL.inc()
+        self.stalls.append(Stall(time.time() - duration, duration, stack))
+        logger.warning(f"⚠️ Event loop blocked for {duration * 1000:.0f} ms in:\n{stack}")
+
+    def status(self):
+        return {
+            "interval": self.interval,
+            "block_threshold": self.block_threshold,
+            "max_lag": round(self.max_lag, 4),
+            "blocked": int(LOOP_BLOCKED_TOTAL.value()),
+            "profiling": self._profiling,
+            "recent_stalls": [stall.to_dict() for stall in self.stalls],
+        }
+
+    # --- Profiling ---
+
+    def _begin_profile(self, seconds):
+        if self._profiling:
+            raise RuntimeError("A profile is already running")
+        seconds = float(seconds)
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            raise ValueError(f"seconds must be between 0 and {MAX_PROFILE_SECONDS}")
+        self._profiling = True
+        return seconds
+
+    async def profile_cpu(self, seconds=PROFILE_SECONDS, sort='cumulative', limit=60):
+        """cProfile everything the loop runs for ``seconds``; the report text.
+
+        cProfile follows the thread that enables it, which is the loop's
+        thread here, so work in thread or process pools isn't included.
+        """
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            raise ValueError(f"Unknown sort key: {sort}")
+        seconds = self._begin_profile(seconds)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profiler.disable()
+        finally:
+            self._profiling = False
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats(sort).print_stats(limit)
+        return self._save("cpu", f"cProfile of the event loop thread for {seconds:g} s\n" + out.getvalue(),
+                          lambda path: stats.dump_stats(path.with_suffix(".pstats")))
+
+    async def trace_memory(self, seconds=PROFILE_SECONDS, limit=30):
+        """Allocations made during ``seconds`` that are still alive, by source line"""
+        seconds = self._begin_profile(seconds)
+        started_here = not tracemalloc.is_tracing()
+        try:
+            if started_here:
+                tracemalloc.start(10)
+            before = tracemalloc.take_snapshot()
+            await asyncio.sleep(seconds)
+            after = tracemalloc.take_snapshot()
+        finally:
+            if started_here:
+                tracemalloc.stop()
+            self._profiling = False
+        lines = [f"tracemalloc growth over {seconds:g} s (top {limit})"]
+        lines += [str(stat) for stat in after.compare_to(before, 'lineno')[:limit]]
+        current = sum(stat.size for stat in after.statistics('filename'))
+        lines.append(f"Traced memory at the end: {current / 1e6:.1f} MB")
+        return self._save("memory", "\n".join(lines) + "\n")
+
+    @staticmethod
+    def _save(kind, report, extra=None):
+        """Write a report next to the screenshots; profiles must survive a restart"""
+        try:
+            PROFILES_DIR.mkdir(parents=True, exist_ok=True)
+            path = PROFILES_DIR / f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt"
+            path.write_text(report)
+            if extra is not None:
+                extra(path)
+            logger.info(f"📝 {kind} profile written to {path}")
+        except OSError as e:
+            logger.error(f"❌ Could not write {kind} profile: {e}")
+        return report
+
+    # --- Triggers ---
+
+    def install_signal_handlers(self, seconds=PROFILE_SECONDS):
+        """SIGUSR1 runs a CPU profile, SIGUSR2 a memory trace (Unix only)"""
+        if not hasattr(signal, "SIGUSR1"):
+            return
+
+        def trigger(run):
+            task = self.loop.create_task(run(seconds))
+            task.add_done_callback(self._log_failure)
+
+        try:
+            self.loop.add_signal_handler(signal.SIGUSR1, trigger, self.profile_cpu)
+            self.loop.add_signal_handler(signal.SIGUSR2, trigger, self.trace_memory)
+        except (RuntimeError, ValueError):
+            # Only the main thread's loop can take signals
+            logger.info("Profiling signals unavailable on this event loop")
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"❌ Profiling failed: {task.exception()}")
+
+
+def add_routes(app, monitor):
+    """Mount /debug/loop, /debug/profile and /debug/tracemalloc on an aiohttp app"""
+    from aiohttp import web
+
+    async def handle_loop(request):
+        return web.json_response(monitor.status())
+
+    async def run(request, profile, **kwargs):
+        try:
+            seconds = float(request.query.get("seconds", PROFILE_SECONDS))
+            return web.Response(text=await profile(seconds, **kwargs))
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=400)
+        except RuntimeError as e:
+            return web.json_response({"error": str(e)}, status=409)
+
+    async def handle_profile(request):
+        return await run(request, monitor.profile_cpu, sort=request.query.get("sort", "cumulative"))
+
+    async def handle_tracemalloc(request):
+        try:
+            limit = int(request.query.get("limit", 30))
+        except ValueError:
+            return web.json_response({"error": "limit must be an integer"}, status=400)
+        return await run(request, monitor.trace_memory, limit=limit)
+
+    app.router.add_get("/debug/loop", handle_loop)
+    app.router.add_get("/debug/profile", handle_profile)
+    app.router.add_get("/debug/tracemalloc", handle_tracemalloc)
@@ -0,0 +1,162 @@
+"""
+MCP server for WebMCP.
+
+Exposes the browser extension to MCP clients (agents) as tools, over stdio
+or streamable HTTP, on top of the same extension WebSocket gateway.py runs:
+
+    take_screenshot  - the active tab as an image; ``max_age_ms`` lets a
+                       recent enough frame of that tab be returned from the
+                       frame cache instead of capturing again
+    list_tabs        - connected extensions and the tab each one shows
+    find_frames      - saved frames by URL, client, tab and time range
+    get_frame        - one saved frame's image
+
+    python mcp_server.py                        stdio (for Claude Desktop etc.)
+    python mcp_server.py --transport http       streamable HTTP on :8766/mcp
+
+The extension still connects to ws://localhost:8765, and gateway.py's HTTP
+endpoints stay available there. The gateway runs in the MCP server's
+lifespan, on the same event loop as the tools.
+
+Requires the MCP Python SDK 2.x: pip install "mcp>=2"
+"""
+import argparse
+import asyncio
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from capture_scheduler import INTERACTIVE, CaptureRejected
+from frame_cache import FrameCache
+from gateway import CAPTURE_TIMEOUT, Gateway
+from transcoder import DEFAULT_QUALITY, variant_from_args
+
+try:
+    from mcp.server.mcpserver import Image, MCPServer
+    from mcp.server.mcpserver.exceptions import ToolError
+except ImportError:
+    MCPServer = None
+
+MCP_PORT = 8766
+MAX_FRAMES_PER_QUERY = 100
+
+
+def build_server(gateway, cache):
+    """The MCP server with WebMCP's tools bound to a gateway and frame cache"""
+
+    @asynccontextmanager
+    async def lifespan(server):
+        await gateway.start()
+        try:
+            yield {}
+        finally:
+            await gateway.stop()
+            # Over stdio, fd 1 only points at stderr while the server runs;
+            # don't leave buffered log lines to be flushed onto the wire
+            sys.stdout.flush()
+
+    server = MCPServer("WebMCP", lifespan=lifespan)
+
+    @server.tool()
+    async def take_screenshot(max_age_ms: int = 0, tab: Optional[str] = None, format: str = "png",
+                              width: Optional[int] = None, quality: int = DEFAULT_QUALITY) -> Image:
+        """Screenshot of the visible area of a browser tab.
+
+        max_age_ms: return the tab's last captured frame if it is at most this
+            old instead of capturing again (0 = always capture a new one)
+        tab: client id, or text contained in the tab's URL or title; default
+            is the least busy connected browser
+        format: png, webp or jpeg; width: downscale to this many pixels wide;
+        quality: 1-100 for webp/jpeg
+        """
+        try:
+            variant = variant_from_args({"format": format, "width": width, "quality": quality})
+            info = gateway.pick_client(tab)
+            cached = cache.get((info.client_id, info.tab_id), max_age_ms)
+            if cached is not None:
+                image = cached.image
+            else:
+                started = time.monotonic()
+                image, shown = await gateway.capture_frame(info, INTERACTIVE, started + CAPTURE_TIMEOUT,
+                                                           max_age=max_age_ms / 1000)
+                # Cached under the tab the frame shows, which may not be the
+                # one the client reported when the capture was sent
+                cache.put((info.client_id, shown["tabId"]), image, started, shown["tabUrl"])
+        except asyncio.TimeoutError:
+            raise ToolError("The extension did not answer in time")
+        except (ConnectionError, CaptureRejected, RuntimeError, ValueError) as e:
+            # Reported to the agent as a tool error instead of a server fault
+            raise ToolError(str(e))
+        body = await gateway.transcoder.transcode(image, variant)
+        return Image(data=body, format=variant.format)
+
+    @server.tool()
+    async def list_tabs() -> list:
+        """Connected browser extensions with the tab each one is showing"""
+        return [info.to_dict() for info in gateway.clients.infos()]
+
+    @server.tool()
+    async def find_frames(url: Optional[str] = None, url_prefix: Optional[str] = None,
+                          client: Optional[str] = None, since: Optional[float] = None,
+                          until: Optional[float] = None, order: str = "desc", limit: int = 20,
+                          cursor: Optional[str] = None) -> dict:
+        """Saved frames matching every given filter; since/until are Unix timestamps.
+
+        Pass the returned "next" value as cursor to get the following page.
+        """
+        if gateway.index is None:
+            raise ToolError("Frames are not being saved (--no-save)")
+        try:
+            frames, next_cursor = await asyncio.to_thread(
+                gateway.index.query, url=url, url_prefix=url_prefix, client=client, since=since,
+                until=until, order=order, limit=min(limit, MAX_FRAMES_PER_QUERY), cursor=cursor,
+            )
+        except ValueError as e:
+            raise ToolError(str(e))
+        return {"frames": frames, "next": next_cursor}
+
+    @server.tool()
+    async def get_frame(frame_id: int) -> Image:
+        """The image of a saved frame, by the id find_frames returned"""
+        if gateway.index is None:
+            raise ToolError("Frames are not being saved (--no-save)")
+        frame = await asyncio.to_thread(gateway.index.get, frame_id)
+        if frame is None:
+            raise ToolError(f"No frame with id {frame_id}")
+        try:
+            data = await asyncio.to_thread(gateway.index.read_image, frame)
+        except OSError:
+            raise ToolError(f"Image of frame {frame_id} is no longer stored")
+        return Image(data=data, format="png")
+
+    return server
+
+
+async def serve(args):
+    gateway = Gateway(args.host, args.ws_port, save_captures=not args.no_save)
+    server = build_server(gateway, FrameCache())
+    if args.transport == "stdio":
+        # While serving, the SDK points fd 1 at stderr, so the gateway's
+        # prints can't corrupt the JSON-RPC stream (see lifespan above)
+        await server.run_stdio_async()
+    else:
+        print(f"[MCP] Streamable HTTP on http://{args.host}:{args.port}/mcp")
+        await server.run_streamable_http_async(host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WebMCP tools over the Model Context Protocol")
+    parser.add_argument("--transport", choices=["stdio", "http"], default="stdio")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=MCP_PORT, help="streamable HTTP port")
+    parser.add_argument("--ws-port", type=int, default=8765, help="extension WebSocket port")
+    parser.add_argument("--no-save", action="store_true", help="don't write captures to disk")
+    args = parser.parse_args()
+    if MCPServer is None:
+        print('💡 The MCP server needs the MCP Python SDK 2.x: pip install "mcp>=2"', file=sys.stderr)
+        sys.exit(1)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,283 @@
+"""
+Prometheus-format metrics and per-capture latency tracing.
+
+Counters, gauges and histograms live in a process-wide REGISTRY and are
+rendered in the Prometheus text exposition format by render(). The HTTP
+servers expose that on GET /metrics; servers without an HTTP side can call
+serve_http(port) to get a tiny standalone /metrics listener.
+
+CaptureTracer records the stages of each capture, keyed by command id:
+
+    issued -> sent -> ack -> received -> decoded -> persisted
+
+Each stage's time since the previous recorded stage goes into the
+webmcp_capture_stage_seconds histogram, and the whole capture into
+webmcp_capture_seconds once it finishes. Stages that a server doesn't have
+(no ack in the action protocol, no persist for HTTP-only replies) are
+simply skipped.
+
+All metrics are thread-safe: Flask handlers and asyncio loops share them.
+"""
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTE_BUCKETS = (16e3, 64e3, 256e3, 1e6, 2e6, 4e6, 8e6, 16e6)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in pairs)
+    return '{%s}' % body
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn, **labels):
+        """Read the gauge from fn() at scrape time (e.g. a queue's length)"""
+        with self._lock:
+            self._functions[_label_key(labels)] = fn
+
+    def samples(self):
+        samples = super().samples()
+        with self._lock:
+            functions = list(self._functions.items())
+        for key, fn in functions:
+            try:
+                samples.append((self.name, key, fn()))
+            except Exception:
+                pass
+        return samples
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def count(self, **labels):
+        with self._lock:
+            series = self._series.get(_label_key(labels))
+            return series[-1] if series else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                samples.append((self.name + '_bucket', key + (('le', _format_value(bound)),), cumulative))
+            samples.append((self.name + '_bucket', key + (('le', '+Inf'),), series[-1]))
+            samples.append((self.name + '_sum', key, series[-2]))
+            samples.append((self.name + '_count', key, series[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            return metric
+
+    def counter(self, name, help):
+        return self._get_or_create(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._get_or_create(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help, buckets=buckets)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+CAPTURE_STAGE_SECONDS = REGISTRY.histogram(
+    'webmcp_capture_stage_seconds', 'Time from the previous capture stage to this one')
+CAPTURE_SECONDS = REGISTRY.histogram(
+    'webmcp_capture_seconds', 'End-to-end capture latency from request to last stage')
+CAPTURES_TOTAL = REGISTRY.counter(
+    'webmcp_captures_total', 'Finished captures by outcome')
+CAPTURE_TIMEOUTS_TOTAL = REGISTRY.counter(
+    'webmcp_capture_timeouts_total', 'Captures that timed out waiting for the extension')
+PAYLOAD_BYTES_TOTAL = REGISTRY.counter(
+    'webmcp_payload_bytes_total', 'Screenshot payload bytes received, by encoding')
+PAYLOAD_BYTES = REGISTRY.histogram(
+    'webmcp_payload_bytes', 'Size of received screenshot payloads', buckets=BYTE_BUCKETS)
+CONNECTED_CLIENTS = REGISTRY.gauge(
+    'webmcp_connected_clients', 'Connected browser extensions')
+QUEUE_DEPTH = REGISTRY.gauge(
+    'webmcp_queue_depth', 'Items waiting in internal queues')
+
+
+def record_payload(size, encoding):
+    """Count one received screenshot payload ('binary' or 'base64')"""
+    PAYLOAD_BYTES_TOTAL.inc(size, encoding=encoding)
+    PAYLOAD_BYTES.observe(size)
+
+
+def render():
+    return REGISTRY.render()
+
+
+class CaptureTracer:
+    """Per-capture stage timestamps keyed by command id"""
+
+    def __init__(self, max_open=10000):
+        self.max_open = max_open
+        self._open = OrderedDict()  # command id -> [first_ts, last_ts]
+        self._lock = threading.Lock()
+
+    def mark(self, command_id, stage, timestamp=None):
+        """Record that a capture reached a stage; starts the trace on first use"""
+        if command_id is None:
+            return
+        now = time.perf_counter() if timestamp is None else timestamp
+        with self._lock:
+            trace = self._open.get(command_id)
+            if trace is None:
+                trace = self._open[command_id] = [now, now]
+                # Traces that never finish must not grow without bound
+                while len(self._open) > self.max_open:
+                    self._open.popitem(last=False)
+                elapsed = None
+            else:
+                elapsed = now - trace[1]
+                trace[1] = now
+        if elapsed is not None:
+            CAPTURE_STAGE_SECONDS.observe(elapsed, stage=stage)
+
+    def finish(self, command_id, outcome='ok'):
+        """Close a trace; records the end-to-end latency for successful captures"""
+        if command_id is None:
+            return
+        with self._lock:
+            trace = self._open.pop(command_id, None)
+        CAPTURES_TOTAL.inc(outcome=outcome)
+        if outcome == 'timeout':
+            CAPTURE_TIMEOUTS_TOTAL.inc()
+        if trace is not None and outcome == 'ok':
+            CAPTURE_SECONDS.observe(trace[1] - trace[0])
+
+    def __len__(self):
+        with self._lock:
+            return len(self._open)
+
+
+TRACER = CaptureTracer()
+QUEUE_DEPTH.set_function(lambda: len(TRACER), queue='open_traces')
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_http(port, host='localhost'):
+    """Serve GET /metrics on a background thread (for WebSocket-only servers)"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True, name='metrics-http')
+    thread.start()
+    return server
@@ -2,83 +2,299 @@ import asyncio
 import websockets
 import json
 import logging
-import base64
 import os
-from datetime import datetime
+import time
+from collections import OrderedDict
 import uuid
+from frames import decode_frame, decode_data_url, hello_response
+from screenshot_store import FileStore
+from screenshot_writer import ScreenshotWriter
+from frame_index import FrameIndex
+from client_registry import ClientRegistry, LEAST_LOADED
+from client_outbox import ClientOutbox
+from capture_scheduler import INTERACTIVE, CaptureScheduler
+from loop_health import LoopMonitor
+import metrics
+from metrics import TRACER
+from payload_log import PayloadLogger
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Finished commands are kept a little while for wait_for_screenshot callers
+# that only get to await them after the result (or error) arrived
+MAX_FINISHED_COMMANDS = 32
+FINISHED_COMMAND_TTL = 30
+
+class PendingCommand:
+    """A screenshot command that has been sent and is waiting for its result"""
+    def __init__(self, future, targets, timer, client_info=None, sent_at=None):
+        self.future = future
+        self.targets = targets
+        self.timer = timer
+        # Routed commands hold a concurrency slot on this client until done
+        self.client_info = client_info
+        self.sent_at = sent_at
+
 class WebSocketServer:
-    def __init__(self, host='localhost', port=8765):
+    def __init__(self, host='localhost', port=8765, request_timeout=30, durability='none',
+                 max_in_flight_per_client=4, metrics_port=None, captures_per_second=2.0):
         self.host = host
         self.port = port
-        self.clients = set()
+        # Connected extensions with identity, tab info, load and latency
+        self.clients = ClientRegistry(max_in_flight=max_in_flight_per_client)
         self.screenshots_dir = 'webmcp_screenshots'
+        self.request_timeout = request_timeout
+        # commandId -> PendingCommand for every screenshot still in flight
+        self.pending_commands = {}
+        # commandId -> future of a finished command nobody has awaited yet
+        self.finished_commands = OrderedDict()
         self.ensure_screenshots_dir()
+        # Screenshots are written on a thread pool so disk I/O never blocks the loop;
+        # each one is recorded in the frame index with the tab it came from
+        self.writer = ScreenshotWriter(FileStore(), durability=durability, index=FrameIndex())
+        # Token bucket per client so commands stay under Chrome's capture rate limit
+        self.scheduler = CaptureScheduler(rate=captures_per_second)
+        # Prometheus /metrics on its own port, since this server only speaks WebSocket
+        self.metrics_port = metrics_port
+        # Loop lag and stalls go to /metrics; SIGUSR1/SIGUSR2 dump profiles
+        self.loop_monitor = LoopMonitor()
+        metrics.CONNECTED_CLIENTS.set_function(lambda: len(self.clients))
+        metrics.QUEUE_DEPTH.set_function(lambda: self.writer.backlog, queue='writer')
+        metrics.QUEUE_DEPTH.set_function(lambda: len(self.pending_commands), queue='pending_commands')
+        metrics.QUEUE_DEPTH.set_function(
+            lambda: sum(len(info.outbox) for info in self.clients.infos()), queue='outbox'
+        )
+        # Messages can carry multi-MB images: log a truncated sample only
+        self.payload_log = PayloadLogger(logger, sample_rate=0.01)
 
     async def register_client(self, websocket):
         """Register a new client connection"""
-        self.clients.add(websocket)
+        info = self.clients.add(websocket)
+        # All writes to this client go through its own bounded queue and writer task
+        info.outbox = ClientOutbox(websocket, on_evict=self.unregister_client)
+        info.outbox.start()
         logger.info(f"Client connected. Total clients: {len(self.clients)}")
 
     async def unregister_client(self, websocket):
         """Unregister a client connection"""
-        self.clients.discard(websocket)
+        info = self.clients.remove(websocket)
+        if info is None:
+            # Already evicted
+            return
+        await info.outbox.close()
+        self.scheduler.remove(websocket)
         logger.info(f"Client disconnected. Total clients: {len(self.clients)}")
 
+        # Fail commands that can no longer be answered by anyone
+        for command_id, pending in list(self.pending_commands.items()):
+            if websocket in pending.targets:
+                pending.targets.discard(websocket)
+                if not pending.targets and not pending.future.done():
+                    pending.future.set_exception(
+                        ConnectionError(f"Client disconnected before answering {command_id}")
+                    )
+
     def ensure_screenshots_dir(self):
         """Create screenshots directory if it doesn't exist"""
         if not os.path.exists(self.screenshots_dir):
             os.makedirs(self.screenshots_dir)
             logger.info(f"Created screenshots directory: {self.screenshots_dir}")
 
-    async def request_screenshot(self, save_local=True, send_to_server=True):
-        """Request a screenshot from all connected clients"""
+    async def request_screenshot(self, save_local=True, send_to_server=True,
+                                 client=None, broadcast=False, timeout=None,
+                                 policy=LEAST_LOADED, affinity=None, priority=INTERACTIVE):
+        """Send a screenshot command and register it as in flight.
+
+        The command goes to ``client`` when given, otherwise to the client
+        chosen by the routing ``policy`` (least loaded by default; an
+        ``affinity`` restricts it to clients whose id, tab URL or title
+        match). Waits while every eligible client is at its concurrency cap.
+        ``broadcast=True`` sends it to every client instead and the first
+        result wins. Returns the command id, or False when no client is
+        connected.
+
+        Commands also wait for the chosen client's capture rate limit, in
+        ``priority`` order; CaptureRejected is raised when that wait would
+        overrun ``timeout``. Broadcasts bypass the scheduler.
+        """
         if not self.clients:
             logger.warning("No clients connected to request screenshot from")
             return False
 
+        loop = asyncio.get_running_loop()
+        issued_at = time.perf_counter()
+        if timeout is None:
+            timeout = self.request_timeout
+        client_info = None
+        if broadcast:
+            targets = set(self.clients)
+        else:
+            acquire_started = loop.time()
+            client_info = await self.clients.acquire(policy, affinity, timeout=timeout, client=client)
+            targets = {client_info.websocket}
+            try:
+                deadline = time.monotonic() + timeout - (loop.time() - acquire_started)
+                await self.scheduler.acquire(client_info.websocket, priority, deadline)
+            except BaseException:
+                self.clients.release(client_info)
+                raise
+            # Time spent waiting for a slot counts against the request's timeout
+            timeout = max(0.0, timeout - (loop.time() - acquire_started))
+
         command_id = str(uuid.uuid4())
+        TRACER.mark(command_id, 'issued', issued_at)
         screenshot_command = {
             'type': 'screenshot_command',
             'commandId': command_id,
             'saveLocal': save_local,
             'sendToServer': send_to_server,
-            'timestamp': asyncio.get_event_loop().time()
+            'timestamp': loop.time()
         }
 
-        logger.info(f"📸 Requesting screenshot from {len(self.clients)} client(s)")
+        future = loop.create_future()
+        timer = loop.call_later(timeout, self._expire_command, command_id)
+        self.pending_commands[command_id] = PendingCommand(
+            future, targets, timer, client_info=client_info, sent_at=loop.time()
+        )
+        future.add_done_callback(lambda _: self._forget_command(command_id))
 
-        await self.broadcast_message(json.dumps(screenshot_command))
+        logger.info(f"📸 Requesting screenshot from {len(targets)} client(s)")
+
+        message = json.dumps(screenshot_command)
+        queued = [self.send_to(target, message) for target in targets]
+        if not any(queued) and not future.done():
+            future.set_exception(ConnectionError("Failed to queue screenshot command: client outbox full"))
+        else:
+            TRACER.mark(command_id, 'sent')
         return command_id
 
+    async def wait_for_screenshot(self, command_id):
+        """Wait for the PNG bytes of a command issued by request_screenshot.
+
+        Cancelling the waiter cancels the command. Results that arrived
+        before this is called are kept for FINISHED_COMMAND_TTL seconds.
+        """
+        pending = self.pending_commands.get(command_id)
+        if pending is not None:
+            return await pending.future
+        future = self.finished_commands.pop(command_id, None)
+        if future is None:
+            raise KeyError(f"Unknown or expired screenshot command: {command_id}")
+        return future.result()
+
+    async def capture_screenshot(self, client=None, timeout=None, save_local=True, send_to_server=True,
+                                 policy=LEAST_LOADED, affinity=None, priority=INTERACTIVE):
+        """Request a screenshot and return its PNG bytes (a memoryview for binary frames)"""
+        command_id = await self.request_screenshot(
+            save_local=save_local,
+            send_to_server=send_to_server,
+            client=client,
+            timeout=timeout,
+            policy=policy,
+            affinity=affinity,
+            priority=priority
+        )
+        if not command_id:
+            raise ConnectionError("No clients connected")
+        return await self.wait_for_screenshot(command_id)
+
+    def cancel_screenshot(self, command_id):
+        """Cancel an in-flight screenshot command"""
+        pending = self.pending_commands.get(command_id)
+        if pending is None:
+            return False
+        return pending.future.cancel()
+
+    def _expire_command(self, command_id):
+        pending = self.pending_commands.get(command_id)
+        if pending is not None and not pending.future.done():
+            pending.future.set_exception(
+                asyncio.TimeoutError(f"Screenshot command {command_id} timed out")
+            )
+
+    def _forget_command(self, command_id):
+        pending = self.pending_commands.pop(command_id, None)
+        if pending is not None:
+            pending.timer.cancel()
+            ok = not pending.future.cancelled() and pending.future.exception() is None
+            if pending.client_info is not None:
+                latency = asyncio.get_running_loop().time() - pending.sent_at
+                self.clients.release(pending.client_info, latency, ok)
+                if ok:
+                    self.scheduler.record(pending.client_info.websocket, latency)
+            if pending.future.cancelled():
+                TRACER.finish(command_id, 'cancelled')
+            elif isinstance(pending.future.exception(), asyncio.TimeoutError):
+                TRACER.finish(command_id, 'timeout')
+            elif not ok:
+                TRACER.finish(command_id, 'error')
+            # Successful traces finish once the screenshot is persisted
+            # Nobody may be awaiting fire-and-forget commands
+            if not pending.future.cancelled():
+                pending.future.exception()
+            self._keep_finished(command_id, pending.future)
+
+    def _keep_finished(self, command_id, future):
+        self.finished_commands[command_id] = future
+        while len(self.finished_commands) > MAX_FINISHED_COMMANDS:
+            self.finished_commands.popitem(last=False)
+        asyncio.get_running_loop().call_later(
+            FINISHED_COMMAND_TTL, self.finished_commands.pop, command_id, None
+        )
+
     async def handle_client(self, websocket):
         """Handle messages from a client"""
         await self.register_client(websocket)
         try:
             async for message in websocket:
+                received_at = time.perf_counter()
+                if isinstance(message, bytes):
+                    # Binary frame: JSON header + raw PNG bytes, no base64
+                    try:
+                        header, payload = decode_frame(message)
+                    except ValueError as e:
+                        logger.error(f"❌ Invalid binary frame: {e}")
+                        continue
+                    if header.get('type') == 'screenshot_result':
+                        metrics.record_payload(len(payload), 'binary')
+                        await self.handle_screenshot_result(header, payload, received_at, websocket)
+                    continue
+
                 try:
                     # Parse incoming JSON message
-                                        # Parse incoming JSON message
                     try:
                         data = json.loads(message)
-                    except (json.JSONDecodeError, TypeError):
-                        logger.info("Error ========================: {message}")
+                    except (json.JSONDecodeError, TypeError) as e:
+                        # One bad message must not drop the client and its in-flight commands
+                        logger.error(f"❌ Invalid JSON message: {e}: {message[:100]}")
+                        self.send_to(websocket, json.dumps({
+                            'type': 'error',
+                            'message': 'Invalid JSON format',
+                            'timestamp': asyncio.get_event_loop().time()
+                        }))
+                        continue
+                    if not isinstance(data, dict):
+                        logger.error("❌ Ignoring JSON message that isn't an object")
+                        continue
                     
-                    logger.info(f"Received message: {data}")
+                    self.payload_log.log("Received message: ", data)
                     
                     # Handle different message types
-                    if data.get('type') == 'ping':
+                    if data.get('type') == 'hello':
+                        # Capability negotiation (binary screenshot frames)
+                        self.clients.get(websocket).update_from_hello(data)
+                        self.send_to(websocket, hello_response(data, key='type'))
+
+                    elif data.get('type') == 'ping':
                         # Respond to ping with pong
                         response = {
                             'type': 'pong',
                             'message': 'Server is alive',
                             'timestamp': asyncio.get_event_loop().time()
                         }
-                        await websocket.send(json.dumps(response))
+                        self.send_to(websocket, json.dumps(response))
                     
                     elif data.get('type') == 'echo':
                         # Echo the message back
@@ -87,7 +303,7 @@ class WebSocketServer:
                             'original_message': data.get('message', ''),
                             'timestamp': asyncio.get_event_loop().time()
                         }
-                        await websocket.send(json.dumps(response))
+                        self.send_to(websocket, json.dumps(response))
                     
                     elif data.get('type') == 'broadcast':
                         # Broadcast message to all connected clients
@@ -101,15 +317,20 @@ class WebSocketServer:
                     
                     elif data.get('type') == 'screenshot_result':
                         # Handle screenshot data from client
-                        await self.handle_screenshot_result(data)
+                        metrics.record_payload(len(data.get('dataUrl') or ''), 'base64')
+                        await self.handle_screenshot_result(data, received_at=received_at, websocket=websocket)
                     
                     elif data.get('type') == 'screenshot_status':
                         # Handle screenshot status from client
                         logger.info(f"📸 Screenshot status: {data}")
+                        self.clients.get(websocket).update_tab(data)
                         if data.get('success'):
+                            if data.get('commandId') in self.pending_commands:
+                                TRACER.mark(data['commandId'], 'ack', received_at)
                             logger.info(f"✅ Screenshot successful - Tab: {data.get('tabTitle', 'Unknown')}")
                         else:
                             logger.error(f"❌ Screenshot failed: {data.get('error', 'Unknown error')}")
+                            self.fail_command(data.get('commandId'), data.get('error', 'Unknown error'))
                     
                     else:
                         # Handle unknown message types
@@ -118,7 +339,7 @@ class WebSocketServer:
                             'message': f"Unknown message type: {data.get('type', 'undefined')}",
                             'timestamp': asyncio.get_event_loop().time()
                         }
-                        await websocket.send(json.dumps(response))
+                        self.send_to(websocket, json.dumps(response))
                         
                 except json.JSONDecodeError:
                     # Handle invalid JSON
@@ -127,7 +348,7 @@ class WebSocketServer:
                         'message': 'Invalid JSON format',
                         'timestamp': asyncio.get_event_loop().time()
                     }
-                    await websocket.send(json.dumps(error_response))
+                    self.send_to(websocket, json.dumps(error_response))
                     
         except websockets.exceptions.ConnectionClosed:
             logger.info("Client connection closed")
@@ -136,17 +357,32 @@ class WebSocketServer:
         finally:
             await self.unregister_client(websocket)
 
-    async def broadcast_message(self, message):
-        """Broadcast a message to all connected clients"""
-        if self.clients:
-            await asyncio.gather(
-                *[client.send(message) for client in self.clients],
-                return_exceptions=True
-            )
+    def send_to(self, websocket, message, coalesce_key=None):
+        """Queue a message for one client; returns False if it was dropped"""
+        info = self.clients.get(websocket)
+        if info is None:
+            return False
+        return info.outbox.send_nowait(message, coalesce_key)
+
+    async def broadcast_message(self, message, coalesce_key=None):
+        """Broadcast a message to all connected clients.
+
+        Only enqueues on each client's outbox, so a stalled client never
+        delays the others. Messages with a ``coalesce_key`` replace an
+        unsent one with the same key and are dropped for full queues.
+        """
+        for client in self.clients:
+            self.send_to(client, message, coalesce_key)
 
     async def start_server(self):
         """Start the WebSocket server"""
         logger.info(f"Starting WebSocket server on {self.host}:{self.port}")
+        await self.writer.start()
+        self.loop_monitor.start()
+        self.loop_monitor.install_signal_handlers()
+        if self.metrics_port:
+            metrics.serve_http(self.metrics_port, self.host)
+            logger.info(f"Metrics available at http://{self.host}:{self.metrics_port}/metrics")
         
         # Start the server (websockets library handles CORS automatically for WebSocket connections)
         server = await websockets.serve(
@@ -159,25 +395,84 @@ class WebSocketServer:
         logger.info(f"Extension can connect to: ws://{self.host}:{self.port}")
         
         # Keep the server running
-        await server.wait_closed()
+        try:
+            await server.wait_closed()
+        finally:
+            self.loop_monitor.stop()
+            await self.writer.close()
+
+    async def handle_screenshot_result(self, data, payload=None, received_at=None, websocket=None):
+        """Handle screenshot data received from client.
 
-    async def handle_screenshot_result(self, data):
-        """Handle screenshot data received from client"""
+        ``payload`` holds the raw image bytes of a binary frame; legacy
+        clients send a base64 ``dataUrl`` in the JSON message instead.
+        ``websocket`` is the sender, whose last reported tab is indexed with
+        the frame when the result doesn't name one.
+        """
+        command_id = data.get('commandId')
+        if data.get('error'):
+            logger.error(f"❌ Screenshot failed: {data.get('error')}")
+            self.fail_command(command_id, data.get('error'))
+            return
+        # Late or duplicate results must not open orphan traces
+        traced = command_id in self.pending_commands
+        if traced:
+            TRACER.mark(command_id, 'received', received_at)
         try:
            dataUrl = data.get('dataUrl')
-           print(dataUrl)
-           if dataUrl:
-                data = dataUrl.split(",", 1)[1]
-                screenshots_dir = Path("~/Downloads/Webmcp/screenshots").expanduser()
-                screenshots_dir.mkdir(exist_ok=True)
-                filename = f"screenshot-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.png"
-                full_path = screenshots_dir / filename
-                with open(full_path, "wb") as f:
-                    f.write(base64.b64decode(data))
-                    print(f"Saved screenshot as {filename}")
-            
+           if payload is None and dataUrl:
+                payload = decode_data_url(dataUrl)
+           if payload is not None:
+                if traced:
+                    TRACER.mark(command_id, 'decoded')
+                saved = await self.writer.submit(payload, commandId=command_id,
+                                                 **self._frame_meta(data, websocket))
+                if traced:
+                    saved.add_done_callback(lambda f: self._trace_persisted(command_id, f))
+                self.resolve_command(command_id, payload)
+           else:
+                self.fail_command(command_id, data.get('error', 'No screenshot data received'))
+
         except Exception as e:
             logger.error(f"❌ Failed to handle screenshot: {e}")
+            self.fail_command(command_id, str(e))
+
+    def _frame_meta(self, data, websocket):
+        """Client and tab details to index a frame under"""
+        info = self.clients.get(websocket) if websocket is not None else None
+        if info is None:
+            return {'tab': data.get('tabId'), 'tab_url': data.get('tabUrl'), 'tab_title': data.get('tabTitle')}
+        return {
+            'client': info.client_id,
+            'tab': data.get('tabId', info.tab_id),
+            'tab_url': data.get('tabUrl', info.tab_url),
+            'tab_title': data.get('tabTitle', info.tab_title),
+        }
+
+    def _trace_persisted(self, command_id, saved):
+        if saved.cancelled() or saved.exception() is not None:
+            TRACER.finish(command_id, 'persist_error')
+        else:
+            TRACER.mark(command_id, 'persisted')
+            TRACER.finish(command_id, 'ok')
+
+    def resolve_command(self, command_id, image_bytes):
+        """Hand screenshot bytes to whoever is waiting on command_id"""
+        pending = self.pending_commands.get(command_id)
+        if pending is None or pending.future.done():
+            # Late, duplicate (broadcast) or uncorrelated result
+            logger.debug(f"No pending command for screenshot result {command_id}")
+            return False
+        pending.future.set_result(image_bytes)
+        return True
+
+    def fail_command(self, command_id, error):
+        """Fail the pending command with an error reported by the client"""
+        pending = self.pending_commands.get(command_id)
+        if pending is None or pending.future.done():
+            return False
+        pending.future.set_exception(RuntimeError(f"Screenshot failed: {error}"))
+        return True
 
     async def send_periodic_messages(self):
         """Send periodic messages to all clients (optional feature)"""
@@ -189,7 +484,7 @@ class WebSocketServer:
                     'timestamp': asyncio.get_event_loop().time(),
                     'connected_clients': len(self.clients)
                 }
-                await self.broadcast_message(json.dumps(message))
+                await self.broadcast_message(json.dumps(message), coalesce_key='server_heartbeat')
             await asyncio.sleep(30)  # Send every 30 seconds
 
     async def interactive_mode(self):
@@ -212,18 +507,21 @@ class WebSocketServer:
                     'timestamp': asyncio.get_event_loop().time(),
                     'connected_clients': len(self.clients)
                 }
-                await self.broadcast_message(json.dumps(message))
+                await self.broadcast_message(json.dumps(message), coalesce_key='server_heartbeat')
             await asyncio.sleep(30)  # Send every 30 seconds
 
 async def main():
     # Create server instance
-    server = WebSocketServer(host='localhost', port=8765)
+    server = WebSocketServer(host='localhost', port=8765, metrics_port=8767)
     
     print("🚀 Starting WebSocket Server with Screenshot Support...")
     print("📸 Screenshots will be saved to: webmcp_screenshots/")
     print("🔗 Extension will connect to: ws://localhost:8765")
+    print("📊 Metrics: http://localhost:8767/metrics")
+    print("🔎 Query saved frames: python frame_index.py (http://localhost:8768/frames)")
     print("\n📋 Available commands:")
     print("  - Type 'screenshot' to capture active tab")
+    print("  - Type 'clients' to list connected extensions")
     print("  - Type 'quit' to stop server")
     print("  - Press Ctrl+C to stop server")
     print("\n" + "="*50)
@@ -236,7 +534,7 @@ async def main():
         import aioconsole
         while True:
             try:
-                command = await aioconsole.ainput("Enter command (screenshot/quit): ")
+                command = await aioconsole.ainput("Enter command (screenshot/clients/quit): ")
                 command = command.strip().lower()
                 
                 if command == 'quit':
@@ -248,10 +546,13 @@ async def main():
                         print(f"📸 Screenshot requested (ID: {command_id[:8]}...)")
                     else:
                         print("❌ No clients connected")
+                elif command == 'clients':
+                    for info in server.clients.infos():
+                        print(f"  {json.dumps(info.to_dict())}")
                 elif command == '':
                     continue
                 else:
-                    print("❓ Unknown command. Use 'screenshot' or 'quit'")
+                    print("❓ Unknown command. Use 'screenshot', 'clients' or 'quit'")
                     
             except EOFError:
                 break
@@ -0,0 +1,43 @@
+"""
+Cheap logging of messages that may carry multi-megabyte screenshots.
+
+summarize() shortens a message to something worth printing: long string
+fields (data URLs) are replaced by their length and the result is capped.
+PayloadLogger only formats and emits a sampled fraction of messages, so
+logging stays off the hot path.
+"""
+import logging
+import random
+
+MAX_FIELD_CHARS = 80
+MAX_SUMMARY_CHARS = 300
+
+
+def summarize(message, limit=MAX_SUMMARY_CHARS):
+    """Short printable form of a message, dict or raw frame"""
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        return f"<binary {len(message)} bytes>"
+    if isinstance(message, dict):
+        message = {
+            key: (f"<{len(value)} chars>" if isinstance(value, str) and len(value) > MAX_FIELD_CHARS else value)
+            for key, value in message.items()
+        }
+    text = str(message)
+    if len(text) > limit:
+        return f"{text[:limit]}... ({len(text)} chars)"
+    return text
+
+
+class PayloadLogger:
+    def __init__(self, logger, sample_rate=0.01, level=logging.INFO):
+        """Log roughly ``sample_rate`` of the messages passed to log()"""
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.level = level
+
+    def log(self, prefix, message):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        if not self.logger.isEnabledFor(self.level):
+            return
+        self.logger.log(self.level, "%s%s", prefix, summarize(message))
@@ -0,0 +1,73 @@
+"""
+In-memory cache of recent screenshot results.
+
+ResultCache is a thread-safe LRU keyed by request id with a total byte
+budget: once the cached images exceed ``max_bytes`` the least recently used
+ones are evicted. Readers can block until a result for an id arrives.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Recently marked-ready ids remembered for late wait()ers
+MAX_READY = 1024
+
+
+class ResultCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()  # id -> (data, etag)
+        self._ready = OrderedDict()  # ids saved elsewhere without being cached
+        self._cond = threading.Condition()
+
+    def put(self, key, data):
+        """Cache a result, evicting old ones to stay within the budget"""
+        data = bytes(data)
+        etag = hashlib.sha1(data).hexdigest()
+        with self._cond:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            # Results bigger than the whole budget are served from disk only
+            if len(data) <= self.max_bytes:
+                self._entries[key] = (data, etag)
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    _, (evicted, _) = self._entries.popitem(last=False)
+                    self.size -= len(evicted)
+            self._cond.notify_all()
+        return etag
+
+    def get(self, key):
+        """Return (data, etag) for a cached result, or None"""
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def mark_ready(self, key):
+        """Wake wait()ers for a result that was stored (e.g. on disk) but not cached"""
+        with self._cond:
+            self._ready[key] = None
+            while len(self._ready) > MAX_READY:
+                self._ready.popitem(last=False)
+            self._cond.notify_all()
+
+    def wait(self, key, timeout):
+        """Like get(), but wait up to ``timeout`` seconds for the result.
+
+        Returns early, possibly with None, once mark_ready(key) is called.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: key in self._entries or key in self._ready, timeout=timeout)
+            return self.get(key)
+
+    def __contains__(self, key):
+        with self._cond:
+            return key in self._entries
+
+    def __len__(self):
+        with self._cond:
+            return len(self._entries)
@@ -0,0 +1,175 @@
+"""
+Storage backends for received screenshots.
+
+A store is a plain synchronous object with a ``save(data, meta, fsync=False)``
+method. It runs on the writer's thread pool (see screenshot_writer.py), never
+on the event loop, and returns the path it wrote to (or None when nothing had
+to be written).
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+SCREENSHOTS_DIR = Path("~/Downloads/Webmcp/screenshots").expanduser()
+
+
+def fsync_path(path):
+    """Flush an already written file (or directory) to disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FileStore:
+    """Store each screenshot as its own PNG file"""
+
+    def __init__(self, directory=SCREENSHOTS_DIR):
+        self.directory = Path(directory).expanduser()
+        # Created once here instead of on every frame
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def save(self, data, meta, fsync=False):
+        """Write one screenshot and return its path.
+
+        ``meta['name']`` picks the file name, otherwise it is the frame's
+        timestamp (to the millisecond) plus a random suffix: several writer
+        threads may save frames taken in the same second.
+        """
+        name = meta.get('name')
+        path = self.directory / (name or self._unique_name(meta.get('timestamp') or time.time()))
+        # Generated names are opened exclusively: never overwrite another frame
+        with open(path, "wb" if name else "xb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        return path
+
+    @staticmethod
+    def _unique_name(timestamp):
+        taken = datetime.fromtimestamp(timestamp)
+        millis = taken.microsecond // 1000
+        return f"screenshot-{taken.strftime('%Y%m%d-%H%M%S')}-{millis:03d}-{uuid.uuid4().hex[:8]}.png"
+
+
+class ContentStore:
+    """Content-addressed store that keeps each unique screenshot once.
+
+    Layout under ``directory``:
+        blobs/<2 hex>/<sha256>.png   one file per distinct payload
+        index.jsonl                  one line per saved frame:
+                                     {"t": ts, "c": client, "tab": tab, "id": commandId, "h": sha256}
+                                     plus "b": changed boxes when known
+
+    A frame whose hash is already stored only appends an index line; the
+    image itself is not written again.
+    """
+
+    def __init__(self, directory=SCREENSHOTS_DIR / "store"):
+        self.directory = Path(directory).expanduser()
+        self.blobs_dir = self.directory / "blobs"
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.directory / "index.jsonl"
+        self._lock = threading.Lock()
+        self._known = self._scan_blobs()
+        self._by_command = self._scan_index()  # command id -> digest
+        self._index = open(self.index_path, "a", encoding="utf-8")
+
+    def _scan_blobs(self):
+        known = set()
+        for prefix in os.scandir(self.blobs_dir):
+            if prefix.is_dir():
+                known.update(
+                    entry.name[:-len(".png")]
+                    for entry in os.scandir(prefix.path)
+                    if entry.name.endswith(".png")
+                )
+        return known
+
+    def _scan_index(self):
+        by_command = {}
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash mid-write
+                        continue
+                    if record.get("id") is not None:
+                        by_command[record["id"]] = record["h"]
+        except FileNotFoundError:
+            pass
+        return by_command
+
+    def blob_path(self, digest):
+        """Where the blob for a sha256 hex digest lives"""
+        return self.blobs_dir / digest[:2] / f"{digest}.png"
+
+    def save(self, data, meta, fsync=False):
+        """Store one frame; returns the blob path if it was new, else None.
+
+        The digest and blob path are recorded in ``meta['hash']`` and
+        ``meta['path']`` for the caller.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        meta['hash'] = digest
+        meta['path'] = str(self.blob_path(digest))
+        with self._lock:
+            is_new = digest not in self._known
+            # Claim the digest so a concurrent identical frame doesn't write it too
+            self._known.add(digest)
+
+        path = None
+        if is_new:
+            path = self.blob_path(digest)
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                    if fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+            except Exception:
+                with self._lock:
+                    self._known.discard(digest)
+                raise
+
+        record = {
+            "t": meta.get("timestamp", time.time()),
+            "c": meta.get("client"),
+            "tab": meta.get("tab"),
+            "id": meta.get("commandId"),
+            "h": digest,
+        }
+        if meta.get("boxes") is not None:
+            # Changed regions reported by change detection
+            record["b"] = meta["boxes"]
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            if record["id"] is not None:
+                self._by_command[record["id"]] = digest
+            self._index.write(line)
+            self._index.flush()
+            if fsync:
+                os.fsync(self._index.fileno())
+        return path
+
+    def lookup(self, command_id):
+        """Blob path of the frame saved for a command id, or None"""
+        with self._lock:
+            digest = self._by_command.get(command_id)
+        return None if digest is None else self.blob_path(digest)
+
+    def close(self):
+        with self._lock:
+            self._index.close()
@@ -0,0 +1,166 @@
+"""
+Non-blocking screenshot persistence.
+
+WebSocket handlers hand frames to a ScreenshotWriter instead of writing them
+inline. Frames go through a bounded asyncio queue to a thread pool that calls
+the store, so disk I/O never stalls the event loop (pings, other clients).
+
+Durability modes:
+    none  - rely on the OS page cache (fastest)
+    fsync - fsync every file before reporting it saved
+    batch - fsync written files in groups, every ``batch_size`` files or
+            ``batch_interval`` seconds, whichever comes first
+
+With an ``index`` (see frame_index.py) every saved frame is also recorded
+there, from the same writer thread.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from screenshot_store import fsync_path
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_NONE = 'none'
+DURABILITY_FSYNC = 'fsync'
+DURABILITY_BATCH = 'batch'
+
+
+class ScreenshotWriter:
+    def __init__(self, store, max_queue=64, workers=2, durability=DURABILITY_NONE,
+                 batch_size=32, batch_interval=1.0, index=None):
+        if durability not in (DURABILITY_NONE, DURABILITY_FSYNC, DURABILITY_BATCH):
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.store = store
+        self.index = index
+        self.durability = durability
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="screenshot-writer")
+        self._tasks = []
+        self._unsynced = []
+        self._unsynced_lock = threading.Lock()
+        self._closing = False
+
+    async def start(self):
+        """Start the writer tasks; call from the running event loop"""
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.durability == DURABILITY_BATCH:
+            self._tasks.append(asyncio.create_task(self._flush_periodically()))
+
+    @property
+    def backlog(self):
+        """Number of frames waiting to be written"""
+        return self.queue.qsize()
+
+    @property
+    def pressure(self):
+        """Queue fill ratio between 0.0 and 1.0; producers can throttle on it"""
+        return self.queue.qsize() / self.queue.maxsize
+
+    async def submit(self, data, **meta):
+        """Queue a frame for writing.
+
+        Waits while the queue is full, which is how backpressure reaches the
+        producer. Returns a future resolved with the saved path once written.
+        """
+        if self._closing:
+            raise RuntimeError("Screenshot writer is shutting down")
+        # When the frame arrived, not when a worker got round to it
+        meta.setdefault('timestamp', time.time())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((data, meta, future))
+        return future
+
+    def try_submit(self, data, **meta):
+        """Queue a frame without waiting; returns None when the queue is full"""
+        if self._closing:
+            raise RuntimeError("Screenshot writer is shutting down")
+        meta.setdefault('timestamp', time.time())
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((data, meta, future))
+        except asyncio.QueueFull:
+            logger.warning(f"Screenshot writer queue full ({self.queue.maxsize}), dropping frame")
+            return None
+        return future
+
+    async def close(self):
+        """Write everything still queued, flush pending fsyncs and stop"""
+        self._closing = True
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._flush_batch)
+        self.executor.shutdown(wait=True)
+        if hasattr(self.store, 'close'):
+            self.store.close()
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            data, meta, future = await self.queue.get()
+            try:
+                path = await loop.run_in_executor(self.executor, self._write, data, meta)
+                if not future.done():
+                    future.set_result(path)
+            except Exception as e:
+                logger.error(f"❌ Failed to save screenshot: {e}")
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+            # Nobody has to await the result of a fire-and-forget write
+            if not future.cancelled():
+                future.exception()
+
+    def _write(self, data, meta):
+        path = self.store.save(data, meta, fsync=self.durability == DURABILITY_FSYNC)
+        if self.durability == DURABILITY_BATCH and path is not None:
+            with self._unsynced_lock:
+                self._unsynced.append(path)
+                full = len(self._unsynced) >= self.batch_size
+            if full:
+                self._flush_batch()
+        if self.index is not None:
+            try:
+                self.index.add(data, meta, path)
+            except Exception as e:
+                # The frame itself is saved; a missing index row isn't worth failing it
+                logger.error(f"❌ Failed to index screenshot: {e}")
+        return path
+
+    async def _flush_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.batch_interval)
+            await loop.run_in_executor(self.executor, self._flush_batch)
+
+    def _flush_batch(self):
+        with self._unsynced_lock:
+            paths, self._unsynced = self._unsynced, []
+        if not paths:
+            return
+        directories = set()
+        for path in paths:
+            try:
+                fsync_path(path)
+                directories.add(os.path.dirname(path))
+            except OSError as e:
+                logger.error(f"❌ fsync failed for {path}: {e}")
+        for directory in directories:
+            try:
+                fsync_path(directory)
+            except OSError:
+                pass
@@ -1,42 +1,129 @@
-from flask import Flask, Response, jsonify
+from flask import Flask, Response, jsonify, request
 import asyncio
 import websockets
 import threading
 import base64
 import json
 import time
-import queue
-from io import BytesIO
+import uuid
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from frames import decode_frame, hello_response
+from live_stream import LiveStream
+from loop_health import LoopMonitor
+from capture_scheduler import INTERACTIVE, MONITORING, CaptureRejected, CaptureScheduler, parse_priority
+from transcoder import Transcoder, variant_from_args
+import metrics
+from metrics import TRACER
 
 app = Flask(__name__)
 
 # Shared state
 ws_connection = None
 ws_loop = None
-# Use a thread-safe queue for communication
-screenshot_queue = queue.Queue()
+# Set while an extension is connected; Flask threads wait on it instead of polling
+ws_connected = threading.Event()
+ws_started = threading.Event()
+# Capture id -> Future a Flask worker thread is waiting on. Each /capture
+# request gets its own id, so concurrent requests never see each other's frames.
+pending_captures = {}
+pending_lock = threading.Lock()
+
+CONNECT_TIMEOUT = 5
+CAPTURE_TIMEOUT = 15
+# Chrome allows only a couple of captureVisibleTab calls per second
+MAX_STREAM_FPS = 2.0
+
+# Extension connection -> LiveStream shared by every /stream viewer of it
+live_streams = {}
+live_streams_lock = threading.Lock()
+
+# WebP/JPEG and resized variants are encoded in worker processes
+transcoder = Transcoder()
+
+# Rate limits captures per extension; lives on the WebSocket loop
+scheduler = CaptureScheduler(rate=2.0)
+
+metrics.CONNECTED_CLIENTS.set_function(lambda: int(ws_connected.is_set()))
+metrics.QUEUE_DEPTH.set_function(lambda: len(pending_captures), queue='pending_captures')
+
+def is_pending(capture_id):
+    """Whether a capture is still waited for (and so has an open trace)"""
+    with pending_lock:
+        return capture_id in pending_captures
+
+def resolve_capture(capture_id, data=None, error=None):
+    """Complete the Future of the /capture request waiting for capture_id"""
+    with pending_lock:
+        future = pending_captures.pop(capture_id, None)
+        if future is None and capture_id is None and data is not None and pending_captures:
+            # Older extension builds don't echo the id; answer the oldest request
+            future = pending_captures.pop(next(iter(pending_captures)))
+    if future is None or future.done():
+        print(f"[WebSocket] No pending capture for id {capture_id}")
+        return
+    if error is not None:
+        future.set_exception(RuntimeError(error))
+    else:
+        future.set_result(data)
+
+def fail_pending_captures(error):
+    with pending_lock:
+        futures = list(pending_captures.values())
+        pending_captures.clear()
+    for future in futures:
+        if not future.done():
+            future.set_exception(RuntimeError(error))
 
 # --- WebSocket Handler ---
 async def websocket_handler(ws):
     global ws_connection
     print("[WebSocket] Extension connected.")
     ws_connection = ws
+    ws_connected.set()
     try:
         async for message in ws:
+            received_at = time.perf_counter()
+            if isinstance(message, bytes):
+                # Binary frame: JSON header + raw PNG bytes, no base64
+                try:
+                    header, payload = decode_frame(message)
+                except ValueError as e:
+                    print(f"[WebSocket] Invalid binary frame: {e}")
+                    continue
+                print(f"[WebSocket] Received binary frame: {len(payload)} bytes")
+                metrics.record_payload(len(payload), "binary")
+                # Late results must not reopen a trace that already finished
+                if is_pending(header.get("id")):
+                    TRACER.mark(header.get("id"), "received", received_at)
+                if header.get("error"):
+                    print(f"[WebSocket] Extension error: {header.get('error')}")
+                    resolve_capture(header.get("id"), error=header["error"])
+                else:
+                    resolve_capture(header.get("id"), data=payload)
+                continue
+
             print(f"[WebSocket] Received message: {message[:100]}...")  # Log first 100 chars
             data = json.loads(message)
-            if data.get("action") == "screenshot":
+            if data.get("action") == "hello":
+                await ws.send(hello_response(data))
+            elif data.get("error"):
+                print(f"[WebSocket] Extension error: {data.get('error')}")
+                resolve_capture(data.get("id"), error=data["error"])
+            elif data.get("action") == "screenshot":
                 data_url = data.get("dataUrl", "")
+                metrics.record_payload(len(data_url), "base64")
+                traced = is_pending(data.get("id"))
+                if traced:
+                    TRACER.mark(data.get("id"), "received", received_at)
                 if "," in data_url:
                     base64_data = data_url.split(",", 1)[1]
-                    print("[WebSocket] Putting screenshot data in queue")
-                    screenshot_queue.put(base64.b64decode(base64_data))
+                    decoded = base64.b64decode(base64_data)
+                    if traced:
+                        TRACER.mark(data.get("id"), "decoded")
+                    resolve_capture(data.get("id"), data=decoded)
                 else:
                     print("[WebSocket] Invalid data URL format")
-                    screenshot_queue.put(None)  # Signal error
-            elif data.get("error"):
-                print(f"[WebSocket] Extension error: {data.get('error')}")
-                screenshot_queue.put(None)  # Signal error
+                    resolve_capture(data.get("id"), error="Invalid data URL format")
             else:
                 print(f"[WebSocket] Unknown action: {data.get('action')}")
     except websockets.exceptions.ConnectionClosed:
@@ -45,94 +132,228 @@ async def websocket_handler(ws):
         print(f"[WebSocket] Error: {e}")
     finally:
         print("[WebSocket] Extension disconnected.")
-        ws_connection = None
+        scheduler.remove(ws, "Extension disconnected")
+        if ws_connection is ws:
+            ws_connection = None
+            ws_connected.clear()
+            fail_pending_captures("Extension disconnected")
+        with live_streams_lock:
+            stream = live_streams.pop(ws, None)
+        if stream is not None:
+            stream.close()
+
+# Lag and stalls of the WebSocket loop go to /metrics. It runs on a thread,
+# which can't take signals, so there are no profiling triggers here.
+loop_monitor = LoopMonitor()
 
 def start_websocket_server():
     global ws_loop
     async def start():
         print("[WebSocket] Starting server on ws://localhost:8765")
         await websockets.serve(websocket_handler, "localhost", 8765)
+        loop_monitor.start()
     
     ws_loop = asyncio.new_event_loop()
     asyncio.set_event_loop(ws_loop)
     ws_loop.run_until_complete(start())
+    ws_started.set()
     ws_loop.run_forever()
 
-# Start the WebSocket server thread
-ws_thread = threading.Thread(target=start_websocket_server, daemon=True)
-ws_thread.start()
-
-# Give the WebSocket server time to start
-time.sleep(1)
-
 # --- Streaming Capture Endpoint ---
 @app.route("/capture", methods=["GET"])
 def capture_and_stream():
-    print(f"[HTTP] Capture request received. WebSocket connected: {ws_connection is not None}")
+    """
+    Capture the active tab and return it as a multipart stream.
+
+    Query parameters:
+      format  - png (default), webp or jpeg
+      width   - downscale to this width, keeping the aspect ratio
+      quality - webp/jpeg quality, 1-100 (default 80)
+      priority    - interactive (default) or monitoring
+      deadline_ms - answer 429 right away if the capture can't finish in
+                    time (default CAPTURE_TIMEOUT)
+    """
+    print(f"[HTTP] Capture request received. WebSocket connected: {ws_connected.is_set()}")
+    try:
+        variant = variant_from_args(request.args)
+        priority = parse_priority(request.args.get("priority"))
+        timeout = request.args.get("deadline_ms", CAPTURE_TIMEOUT * 1000, type=float) / 1000
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not variant.is_original and not transcoder.available:
+        return jsonify({"error": "Transcoding needs Pillow: pip install pillow"}), 501
     
-    # Wait up to 5 seconds for WebSocket to be ready
-    for i in range(50):
-        if ws_connection is not None:
-            print(f"[HTTP] WebSocket ready after {i * 0.1:.1f}s")
-            break
-        time.sleep(0.1)
-    else:
+    # Wait up to CONNECT_TIMEOUT seconds for the extension to connect
+    started = time.monotonic()
+    if not ws_connected.wait(timeout=CONNECT_TIMEOUT):
         print("[HTTP] WebSocket connection timeout")
         return jsonify({"error": "Extension not connected"}), 503
+    print(f"[HTTP] WebSocket ready after {time.monotonic() - started:.1f}s")
     
     if ws_loop is None:
         print("[HTTP] WebSocket loop not initialized")
         return jsonify({"error": "WebSocket loop not initialized"}), 500
     
-    # Clear any old screenshots from the queue
-    while not screenshot_queue.empty():
-        try:
-            screenshot_queue.get_nowait()
-        except queue.Empty:
-            break
+    capture_id = str(uuid.uuid4())
+    TRACER.mark(capture_id, "issued")
+    future = Future()
+    with pending_lock:
+        pending_captures[capture_id] = future
     
-    # Send capture command to extension
+    outcome = "error"
     try:
-        print("[HTTP] Sending capture command to extension")
-        future = asyncio.run_coroutine_threadsafe(
-            ws_connection.send('{"action": "capture"}'), 
-            ws_loop
-        )
-        future.result(timeout=5)  # Wait for send to complete
-        print("[HTTP] Capture command sent successfully")
-    except Exception as e:
-        print(f"[HTTP] Failed to send capture command: {str(e)}")
-        return jsonify({"error": f"Failed to send capture command: {str(e)}"}), 500
-    
-    def generate():
-        print("[HTTP] Starting to wait for screenshot data")
+        # Send capture command to extension
+        connection = ws_connection
+        if connection is None:
+            return jsonify({"error": "Extension not connected"}), 503
+        deadline = time.monotonic() + timeout
         try:
-            # Wait for screenshot data from WebSocket via queue
-            data = screenshot_queue.get(timeout=15)
-            if data is None:
-                print("[HTTP] Received error signal from extension")
-                yield b"Error: Extension failed to capture screenshot\r\n"
-                return
-            
-            print(f"[HTTP] Received screenshot data: {len(data)} bytes")
-            yield b"--frame\r\n"
-            yield b"Content-Type: image/png\r\n\r\n" + data + b"\r\n"
-            yield b"--frame--\r\n"
-        except queue.Empty:
+            print(f"[HTTP] Sending capture command {capture_id[:8]} to extension")
+            scheduled = asyncio.run_coroutine_threadsafe(
+                schedule_capture(connection, capture_id, priority, deadline),
+                ws_loop
+            )
+            scheduled.result(timeout=timeout)  # Wait for a rate-limit slot and the send
+            TRACER.mark(capture_id, "sent")
+        except CaptureRejected as e:
+            print(f"[HTTP] Capture rejected: {e}")
+            outcome = "rejected"
+            response = jsonify({"error": str(e)})
+            if e.retry_after:
+                response.headers["Retry-After"] = str(max(1, round(e.retry_after)))
+            return response, 429
+        except FutureTimeoutError:
+            print("[HTTP] Timed out waiting for a capture slot")
+            scheduled.cancel()  # don't send a capture nobody is waiting for
+            outcome = "timeout"
+            return jsonify({"error": "Timed out waiting for a capture slot"}), 504
+        except Exception as e:
+            print(f"[HTTP] Failed to send capture command: {str(e)}")
+            return jsonify({"error": f"Failed to send capture command: {str(e)}"}), 500
+
+        sent_at = time.monotonic()
+        try:
+            data = future.result(timeout=max(0.0, deadline - sent_at))
+            outcome = "ok"
+            ws_loop.call_soon_threadsafe(scheduler.record, connection, time.monotonic() - sent_at)
+        except FutureTimeoutError:
             print("[HTTP] Screenshot capture timed out")
-            yield b"Error: Screenshot capture timed out\r\n"
+            outcome = "timeout"
+            return jsonify({"error": "Screenshot capture timed out"}), 504
         except Exception as e:
-            print(f"[HTTP] Error in generate: {str(e)}")
-            yield f"Error: {str(e)}".encode()
+            print(f"[HTTP] Extension failed to capture screenshot: {str(e)}")
+            return jsonify({"error": f"Extension failed to capture screenshot: {str(e)}"}), 502
+    finally:
+        with pending_lock:
+            pending_captures.pop(capture_id, None)
+        TRACER.finish(capture_id, outcome)
+    
+    print(f"[HTTP] Received screenshot data: {len(data)} bytes")
+    try:
+        # WSGI bodies must be bytes; binary frames arrive as memoryviews
+        body = transcoder.transcode_sync(data, variant, timeout=CAPTURE_TIMEOUT)
+    except Exception as e:
+        print(f"[HTTP] Transcoding failed: {e}")
+        return jsonify({"error": f"Transcoding failed: {e}"}), 500
+    if not variant.is_original:
+        print(f"[HTTP] Transcoded to {variant.key()}: {len(body)} bytes")
+
+    def generate():
+        yield b"--frame\r\n"
+        yield f"Content-Type: {variant.mime_type}\r\n\r\n".encode()
+        yield body
+        yield b"\r\n--frame--\r\n"
     
     return Response(generate(), mimetype="multipart/x-mixed-replace; boundary=frame")
 
+async def schedule_capture(connection, capture_id, priority=INTERACTIVE, deadline=None):
+    """Wait for the extension's rate-limit budget, then send the capture command"""
+    await scheduler.acquire(connection, priority, deadline)
+    await connection.send(json.dumps({"action": "capture", "id": capture_id}))
+
+async def capture_on_loop(connection):
+    """Capture one screenshot from the WebSocket loop (used by live streams)"""
+    capture_id = str(uuid.uuid4())
+    TRACER.mark(capture_id, "issued")
+    future = Future()
+    with pending_lock:
+        pending_captures[capture_id] = future
+    outcome = "error"
+    try:
+        try:
+            await schedule_capture(connection, capture_id, MONITORING, time.monotonic() + CAPTURE_TIMEOUT)
+        except CaptureRejected:
+            # Interactive /capture requests are using the budget; skip this frame
+            outcome = "rejected"
+            return None
+        TRACER.mark(capture_id, "sent")
+        try:
+            image = await asyncio.wait_for(asyncio.wrap_future(future), timeout=CAPTURE_TIMEOUT)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise
+        outcome = "ok"
+        return image
+    finally:
+        with pending_lock:
+            pending_captures.pop(capture_id, None)
+        TRACER.finish(capture_id, outcome)
+
+def get_live_stream(connection):
+    with live_streams_lock:
+        stream = live_streams.get(connection)
+        if stream is None:
+            stream = LiveStream(lambda: capture_on_loop(connection), ws_loop, max_fps=MAX_STREAM_FPS)
+            live_streams[connection] = stream
+        return stream
+
+# --- Live Stream Endpoint ---
+@app.route("/stream", methods=["GET"])
+def live_stream():
+    """
+    Live multipart/x-mixed-replace stream of the active tab.
+
+    Query parameters:
+      fps - target frames per second (default 1, capped at MAX_STREAM_FPS)
+
+    All viewers share one capture loop per extension; a slow viewer skips
+    to the latest frame instead of buffering.
+    """
+    fps = min(max(request.args.get("fps", 1.0, type=float), 0.1), MAX_STREAM_FPS)
+    if not ws_connected.wait(timeout=CONNECT_TIMEOUT) or ws_connection is None:
+        return jsonify({"error": "Extension not connected"}), 503
+
+    stream = get_live_stream(ws_connection)
+    print(f"[HTTP] Stream viewer joined at {fps} fps ({stream.subscribers + 1} viewers)")
+
+    def generate():
+        for frame in stream.frames(fps, timeout=CAPTURE_TIMEOUT):
+            yield (
+                b"--frame\r\n"
+                b"Content-Type: image/png\r\n"
+                + f"Content-Length: {len(frame)}\r\n\r\n".encode()
+                + frame
+                + b"\r\n"
+            )
+
+    return Response(generate(), mimetype="multipart/x-mixed-replace; boundary=frame")
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
 @app.route("/status")
 def status():
-    connected = ws_connection is not None
+    connected = ws_connected.is_set()
     print(f"[HTTP] Status check: extension_connected={connected}")
     return jsonify({"extension_connected": connected})
 
 if __name__ == "__main__":
+    # Started here rather than at import, so transcoder workers that
+    # re-import this script don't open a second WebSocket server
+    ws_thread = threading.Thread(target=start_websocket_server, daemon=True)
+    ws_thread.start()
+    # Wait until the WebSocket server is listening
+    ws_started.wait(timeout=5)
     print("[Flask] Starting Flask server on port 8766")
     app.run(port=8766, threaded=True, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,61 @@
+"""
+Single-flight request coalescing.
+
+Concurrent callers asking for the same key share one in-flight call instead
+of each starting their own. A result that finished less than ``window``
+seconds ago is handed to new callers as well, so a burst of requests that
+arrives just after a capture completes doesn't trigger another one. Results
+are dropped once the window has passed; forget() drops a key's state early,
+e.g. when the client it belongs to disconnects. Callers that need something
+fresher than the window pass ``max_age`` to run().
+"""
+import asyncio
+
+
+class SingleFlight:
+    def __init__(self, window=0.0):
+        self.window = window
+        self._inflight = {}  # key -> shared task
+        self._recent = {}    # key -> (finished_at, result)
+
+    async def run(self, key, fn, max_age=None):
+        """Return fn()'s result, sharing it with every concurrent caller of key.
+
+        A recent result is only reused when it is at most ``max_age`` seconds
+        old (default: the window); max_age=0 always waits for a call that is
+        still running or starts a new one.
+        """
+        loop = asyncio.get_running_loop()
+        max_age = self.window if max_age is None else min(max_age, self.window)
+        recent = self._recent.get(key)
+        if recent is not None and loop.time() - recent[0] <= max_age:
+            return recent[1]
+
+        shared = self._inflight.get(key)
+        if shared is None:
+            shared = asyncio.ensure_future(fn())
+            self._inflight[key] = shared
+            shared.add_done_callback(lambda task: self._finish(key, task))
+        # One caller giving up must not cancel the call for the others
+        return await asyncio.shield(shared)
+
+    def inflight(self, key):
+        return key in self._inflight
+
+    def forget(self, key):
+        """Drop the recent result kept for ``key``"""
+        self._recent.pop(key, None)
+
+    def _finish(self, key, task):
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        if self.window > 0:
+            loop = asyncio.get_running_loop()
+            entry = self._recent[key] = (loop.time(), task.result())
+            loop.call_later(self.window, self._expire, key, entry)
+
+    def _expire(self, key, entry):
+        # A newer result for the key has its own timer
+        if self._recent.get(key) is entry:
+            del self._recent[key]
@@ -1,19 +1,69 @@
 import datetime
 from pathlib import Path
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
 import time
-import base64
 import os
+import re
+import uuid
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from job_queue import JobQueue
+from result_cache import ResultCache
+from transcoder import THUMBNAIL, Transcoder, variant_from_args
+from upload_stream import copy_stream, read_json_upload
+import metrics
+from metrics import TRACER
 
 app = Flask(__name__)
 # Enable CORS for the Chrome extension
 CORS(app)
 
-# Simple in-memory storage for pending screenshot requests and results.
-# In a real-world application, you would use a database.
-screenshot_requests = []
-screenshot_results = []
+SCREENSHOTS_DIR = Path.home() / "Downloads" / "Webmcp" / "screenshots"
+
+# Uploads are streamed to disk; bodies above this are refused with a 413
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+RAW_UPLOAD_TYPES = ('image/png', 'application/octet-stream')
+# Request ids become file names, so they may not contain path separators
+REQUEST_ID_PATTERN = re.compile(r'[\w.-]+')
+
+# Pending requests live in SQLite (WAL), so they survive restarts and can be
+# shared by several server processes. A request the extension claimed but
+# never uploaded is handed out again after VISIBILITY_TIMEOUT seconds.
+VISIBILITY_TIMEOUT = 60
+screenshot_requests = JobQueue(SCREENSHOTS_DIR / "jobs.sqlite3", visibility_timeout=VISIBILITY_TIMEOUT)
+# Recent results by request id, so callers get their image without a disk read
+screenshot_results = ResultCache(max_bytes=256 * 1024 * 1024)
+THUMBNAILS_DIR = SCREENSHOTS_DIR / "thumbnails"
+
+# Encode a small WebP next to every upload (needs Pillow); other formats and
+# widths are transcoded on first request and then served from the cache
+GENERATE_THUMBNAILS = True
+transcoder = Transcoder()
+# Longest a request waits for a worker process to encode a variant
+TRANSCODE_TIMEOUT = 30
+
+# Longest time a /check-status long-poll is held open, and the most
+# requests handed out per round trip
+MAX_POLL_WAIT = 25
+MAX_POLL_BATCH = 10
+# Longest time GET /screenshot/<id> waits for a result to arrive
+MAX_RESULT_WAIT = 30
+# Results uploaded to another server process only show up on disk; waiting
+# readers re-check this often
+RESULT_POLL_INTERVAL = 0.5
+
+metrics.QUEUE_DEPTH.set_function(lambda: len(screenshot_requests), queue='screenshot_requests')
+metrics.QUEUE_DEPTH.set_function(lambda: len(screenshot_results), queue='cached_results')
+
+INVALID_ID_MESSAGE = "Request ID may only contain letters, digits, '_', '-' and '.'."
+
+def is_valid_id(request_id):
+    """Whether a client-supplied id is safe to use as a file name"""
+    return (isinstance(request_id, str) and REQUEST_ID_PATTERN.fullmatch(request_id) is not None
+            and '..' not in request_id)
 
 @app.route('/request-screenshot', methods=['POST'])
 def request_screenshot():
@@ -27,9 +77,12 @@ def request_screenshot():
 
     if not request_id:
         request_id = f"screenshot-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    elif not is_valid_id(request_id):
+        return jsonify({"error": INVALID_ID_MESSAGE}), 400
 
     # Add the new request to our queue.
-    screenshot_requests.append({"id": request_id, "status": "pending", "timestamp": time.time()})
+    TRACER.mark(request_id, 'issued')
+    screenshot_requests.put(request_id)
     print(f"Screenshot request received for ID: {request_id}")
     return jsonify({"message": f"Screenshot request sent with ID: {request_id}"})
 
@@ -38,14 +91,29 @@ def check_status():
     """
     API Endpoint: /check-status
     The Chrome extension polls this endpoint to check for new requests.
+
+    Query parameters:
+      wait - long-poll: hold the request open for up to this many seconds
+             until work arrives (default 0, answer immediately)
+      max  - hand out up to this many pending requests at once (default 1)
+
+    Handed-out requests are claimed, not removed: if no upload arrives
+    within VISIBILITY_TIMEOUT seconds they are handed out again.
     """
-    if screenshot_requests:
-        # Return the first pending request to the extension.
-        request_obj = screenshot_requests.pop(0)
-        return jsonify({"request": request_obj})
-    else:
-        # No pending requests, so send an empty response.
-        return jsonify({"request": None})
+    wait = min(max(request.args.get('wait', 0, type=float), 0), MAX_POLL_WAIT)
+    max_items = min(max(request.args.get('max', 1, type=int), 1), MAX_POLL_BATCH)
+
+    worker = request.args.get('worker') or request.remote_addr
+    requests_out = screenshot_requests.take(max_items, timeout=wait, worker=worker)
+    for item in requests_out:
+        # Handing a request to the extension is this protocol's "sent"
+        TRACER.mark(item['id'], 'sent')
+    # "request" keeps old extension builds working; "requests" carries the batch
+    return jsonify({
+        "request": requests_out[0] if requests_out else None,
+        "requests": requests_out,
+        "wait": wait,
+    })
 
 @app.route('/upload-screenshot', methods=['POST'])
 def upload_screenshot():
@@ -53,41 +121,186 @@ def upload_screenshot():
     API Endpoint: /upload-screenshot
     The Chrome extension uses this endpoint to send the screenshot data back.
     This function has been updated to save the screenshot locally.
+
+    Accepted bodies, all streamed to disk in chunks:
+      application/json    - {"id": ..., "screenshotData": "data:image/png;base64,..."}
+      image/png           - the raw image, with ?id=<request id>
+      multipart/form-data - an "id" field and a "screenshot" file part
     """
-    data = request.json
-    request_id = data.get('id')
-    screenshot_data = data.get('screenshotData')
+    received_at = time.perf_counter()
+    SCREENSHOTS_DIR.mkdir(parents=True, exist_ok=True)
+    # Written under a temporary name: the id may only show up after the image
+    tmp_name = SCREENSHOTS_DIR / f".upload-{uuid.uuid4().hex}.tmp"
+    request_id = None
+    try:
+        with open(tmp_name, 'wb') as f:
+            if request.mimetype == 'multipart/form-data':
+                # Werkzeug spools big file parts to disk, not memory
+                request_id = request.form.get('id') or request.args.get('id')
+                upload = request.files.get('screenshot')
+                if upload is None:
+                    return jsonify({"error": "Request ID and screenshot data are required."}), 400
+                size = copy_stream(upload.stream, f)
+                metrics.record_payload(size, 'binary')
+            elif request.mimetype in RAW_UPLOAD_TYPES:
+                request_id = request.args.get('id')
+                size = copy_stream(request.stream, f)
+                metrics.record_payload(size, 'binary')
+            else:
+                fields, size, encoded = read_json_upload(request.stream, f)
+                request_id = fields.get('id')
+                metrics.record_payload(encoded, 'base64')
+        if not request_id or not size:
+            return jsonify({"error": "Request ID and screenshot data are required."}), 400
+        request_id = str(request_id)
+        if not is_valid_id(request_id):
+            return jsonify({"error": INVALID_ID_MESSAGE}), 400
+        TRACER.mark(request_id, 'received', received_at)
+        TRACER.mark(request_id, 'decoded')
 
-    if not request_id or not screenshot_data:
-        return jsonify({"error": "Request ID and screenshot data are required."}), 400
+        # Rename into place: other server processes may read it right away
+        filename = f"{SCREENSHOTS_DIR}/{request_id}.png"
+        os.replace(tmp_name, filename)
+        screenshot_requests.complete(request_id, filename, size)
+        TRACER.mark(request_id, 'persisted')
+        TRACER.finish(request_id, 'ok')
 
-    try:
-        # Create a directory to store screenshots if it doesn't exist
-        screenshots_dir = Path.home() / "Downloads" / "Webmcp" / "screenshots"
-        if not os.path.exists(screenshots_dir):
-            os.makedirs(screenshots_dir)
-
-        # The screenshot data is a Data URL (e.g., 'data:image/png;base64,iVBORw...').
-        # We need to remove the prefix to get the raw base64 data.
-        header, base64_data = screenshot_data.split(',', 1)
-
-        # Decode the base64 string to binary data
-        binary_data = base64.b64decode(base64_data)
-        
-
-        # Define a filename based on the request ID and save the image
-        filename = f"{screenshots_dir}/{request_id}.png"
-        print("HELLO", filename)
-        with open(filename, 'wb') as f:
-            f.write(binary_data)
-        
         print(f"Screenshot for ID: {request_id} saved to {filename}")
+        # Readers load it from disk (and cache it) when they ask for it
+        screenshot_results.mark_ready(request_id)
+        if GENERATE_THUMBNAILS and transcoder.available:
+            # Runs in a worker process that reads the file; the upload doesn't wait for it
+            transcoder.submit(filename, THUMBNAIL).add_done_callback(
+                lambda future: save_thumbnail(request_id, future)
+            )
 
         return jsonify({"message": f"Screenshot for ID: {request_id} received and saved."})
 
+    except HTTPException:
+        # e.g. 413 once the body passes MAX_UPLOAD_BYTES
+        TRACER.finish(request_id, 'error')
+        raise
+    except ValueError as e:
+        print(f"Rejected screenshot upload: {e}")
+        TRACER.finish(request_id, 'error')
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error processing screenshot upload: {e}")
+        TRACER.finish(request_id, 'error')
         return jsonify({"error": "Failed to process screenshot upload."}), 500
+    finally:
+        if tmp_name.exists():
+            tmp_name.unlink()
+
+def load_result(request_id):
+    """Read a result through the cache, falling back to the saved file"""
+    entry = screenshot_results.get(request_id)
+    if entry is not None:
+        return entry
+    path = SCREENSHOTS_DIR / f"{request_id}.png"
+    if not path.is_file():
+        return None
+    data = path.read_bytes()
+    etag = screenshot_results.put(request_id, data)
+    return data, etag
+
+def save_thumbnail(request_id, future):
+    if future.cancelled() or future.exception() is not None:
+        print(f"Thumbnail for ID: {request_id} failed: {future.exception()}")
+        return
+    thumbnail = future.result()[0]
+    THUMBNAILS_DIR.mkdir(parents=True, exist_ok=True)
+    (THUMBNAILS_DIR / f"{request_id}.webp").write_bytes(thumbnail)
+    screenshot_results.put(variant_key(request_id, THUMBNAIL), thumbnail)
+
+def variant_key(request_id, variant):
+    return f"{request_id}@{variant.key()}"
+
+def load_variant(request_id, variant):
+    """Like load_result, for a transcoded variant; encodes it on a cache miss"""
+    if variant.is_original:
+        return load_result(request_id)
+    key = variant_key(request_id, variant)
+    entry = screenshot_results.get(key)
+    if entry is not None:
+        return entry
+    thumbnail = THUMBNAILS_DIR / f"{request_id}.webp"
+    if variant == THUMBNAIL and thumbnail.is_file():
+        data = thumbnail.read_bytes()
+        return data, screenshot_results.put(key, data)
+    original = load_result(request_id)
+    if original is None:
+        return None
+    data = transcoder.transcode_sync(original[0], variant, timeout=TRANSCODE_TIMEOUT)
+    return data, screenshot_results.put(key, data)
+
+@app.route('/screenshot/<request_id>', methods=['GET'])
+def get_screenshot(request_id):
+    """
+    API Endpoint: /screenshot/<id>
+    Returns the PNG uploaded for a request id.
+
+    Query parameters:
+      wait    - block for up to this many seconds until the result arrives
+                (default 0, answer 404 immediately when it isn't there yet)
+      format  - png (default), webp or jpeg
+      width   - downscale to this width, keeping the aspect ratio
+      quality - webp/jpeg quality, 1-100 (default 80)
+    format=webp&width=320&quality=70 is the pre-generated thumbnail.
+    Supports If-None-Match with the returned ETag.
+    """
+    if not is_valid_id(request_id):
+        return jsonify({"error": INVALID_ID_MESSAGE}), 400
+    wait = min(max(request.args.get('wait', 0, type=float), 0), MAX_RESULT_WAIT)
+    try:
+        variant = variant_from_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not variant.is_original and not transcoder.available:
+        return jsonify({"error": "Transcoding needs Pillow: pip install pillow"}), 501
+
+    deadline = time.monotonic() + wait
+    while load_result(request_id) is None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        screenshot_results.wait(request_id, min(remaining, RESULT_POLL_INTERVAL))
+    try:
+        entry = load_variant(request_id, variant)
+    except (OSError, BrokenProcessPool, FutureTimeoutError) as e:
+        # Pillow couldn't decode it, a worker died, or the pool is backed up
+        return jsonify({"error": f"Transcoding failed: {e or type(e).__name__}"}), 500
+    if entry is None:
+        job = screenshot_requests.get(request_id)
+        return jsonify({
+            "error": f"No screenshot for ID: {request_id}",
+            "status": job['status'] if job else None,
+        }), 404
+
+    data, etag = entry
+    response = Response(data, mimetype=variant.mime_type)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    return response.make_conditional(request)
+
+@app.route('/job/<request_id>', methods=['GET'])
+def get_job(request_id):
+    """
+    API Endpoint: /job/<id>
+    Queue state of a request: status (pending, claimed, done, failed),
+    attempts, who claimed it and where its result was saved.
+    """
+    job = screenshot_requests.get(request_id)
+    if job is None:
+        return jsonify({"error": f"No job for ID: {request_id}"}), 404
+    job.pop('payload', None)
+    return jsonify(job)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics: capture stage latencies, payload sizes, queue depths"""
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
 
 if __name__ == '__main__':
-    app.run(port=3000, debug=True)
\ No newline at end of file
+    # Long-polls hold a worker thread each, so keep the server threaded
+    app.run(port=3000, debug=True, threaded=True)
\ No newline at end of file
@@ -0,0 +1,200 @@
+"""
+Screenshot transcoding on a process pool.
+
+captureVisibleTab hands us full-resolution PNGs, which are large and slow
+to encode. Transcoder re-encodes them to WebP or JPEG, downscales them to a
+requested width and makes thumbnails. Decoding and encoding are CPU bound and
+hold the GIL, so the work runs in a ProcessPoolExecutor: event loops await
+it, Flask worker threads block on it, and neither stalls the other requests.
+
+HTTP endpoints take the variant from query parameters:
+
+    format  - png (default), webp or jpeg
+    width   - downscale to this width in pixels, keeping the aspect ratio
+    quality - 1-100 for webp/jpeg (default 80)
+
+Requires Pillow: pip install pillow
+"""
+import asyncio
+import io
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+MIME_TYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+}
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+
+DEFAULT_QUALITY = 80
+MAX_WIDTH = 8192
+THUMBNAIL_WIDTH = 320
+# How often workers check that the server that started them is still there
+PARENT_CHECK_INTERVAL = 1.0
+
+
+class Variant:
+    """An output format, width and quality; hashable so it can key caches"""
+
+    def __init__(self, format='png', width=None, quality=DEFAULT_QUALITY):
+        self.format = format
+        self.width = width
+        self.quality = quality
+
+    @property
+    def mime_type(self):
+        return MIME_TYPES[self.format]
+
+    @property
+    def is_original(self):
+        """PNG at full size is exactly what the extension sent"""
+        return self.format == 'png' and self.width is None
+
+    def key(self):
+        return f"{self.format}:{self.width or 'full'}:{self.quality}"
+
+    def __eq__(self, other):
+        return isinstance(other, Variant) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return f"Variant({self.key()})"
+
+
+THUMBNAIL = Variant('webp', THUMBNAIL_WIDTH, 70)
+
+
+def variant_from_args(args):
+    """Variant requested by Flask request.args or aiohttp request.query.
+
+    Raises ValueError with a message suitable for a 400 response.
+    """
+    format = (args.get('format') or 'png').lower()
+    format = FORMAT_ALIASES.get(format, format)
+    if format not in MIME_TYPES:
+        raise ValueError(f"Unsupported format {format!r}; use one of {', '.join(MIME_TYPES)}")
+    try:
+        width = int(args['width']) if args.get('width') else None
+        quality = int(args.get('quality') or DEFAULT_QUALITY)
+    except ValueError:
+        raise ValueError("width and quality must be integers")
+    if width is not None and not 1 <= width <= MAX_WIDTH:
+        raise ValueError(f"width must be between 1 and {MAX_WIDTH}")
+    if not 1 <= quality <= 100:
+        raise ValueError("quality must be between 1 and 100")
+    return Variant(format, width, quality)
+
+
+def render(image, variants):
+    """Decode once and encode every variant; runs in a worker process.
+
+    ``image`` is the encoded image or the path of a file holding it.
+    """
+    source = image if isinstance(image, (str, os.PathLike)) else io.BytesIO(image)
+    with Image.open(source) as image:
+        image.load()
+        results = []
+        for variant in variants:
+            frame = image
+            if variant.width is not None and variant.width < image.width:
+                height = max(1, round(image.height * variant.width / image.width))
+                frame = image.resize((variant.width, height), Image.LANCZOS)
+            if variant.format == 'jpeg' and frame.mode not in ('RGB', 'L'):
+                # JPEG has no alpha channel
+                frame = frame.convert('RGB')
+            out = io.BytesIO()
+            if variant.format == 'png':
+                frame.save(out, 'PNG', optimize=False)
+            elif variant.format == 'webp':
+                frame.save(out, 'WEBP', quality=variant.quality, method=4)
+            else:
+                frame.save(out, 'JPEG', quality=variant.quality, optimize=True)
+            results.append(out.getvalue())
+    return results
+
+
+def _init_worker():
+    # Ctrl-C reaches the whole process group; leave shutting workers down to
+    # the parent instead of dying mid-task
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # A worker holds both ends of its result pipe, so if the server exits
+    # without collecting a big result the worker would block forever
+    parent = os.getppid()
+    threading.Thread(target=_exit_with_parent, args=(parent,), daemon=True).start()
+
+
+def _exit_with_parent(parent):
+    while os.getppid() == parent:
+        time.sleep(PARENT_CHECK_INTERVAL)
+    os._exit(1)
+
+
+class Transcoder:
+    def __init__(self, max_workers=None):
+        """max_workers - worker processes (default: one per CPU)"""
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return Image is not None
+
+    def _pool(self):
+        if Image is None:
+            raise ImportError("Transcoding needs Pillow: pip install pillow")
+        with self._lock:
+            if self._executor is None:
+                # The servers run threads (WebSocket loops, Flask workers), and
+                # forking a threaded process can copy a lock another thread
+                # holds; start workers from a clean process instead
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=context, initializer=_init_worker
+                )
+            return self._executor
+
+    def submit(self, image, *variants):
+        """concurrent.futures.Future of the encoded bytes of each variant.
+
+        Pass a path instead of bytes to have the worker read the file itself.
+        """
+        if not isinstance(image, (str, os.PathLike)):
+            image = bytes(image)
+        return self._pool().submit(render, image, variants)
+
+    def transcode_sync(self, image_bytes, variant, timeout=None):
+        """Blocking transcode for worker threads (Flask handlers)"""
+        if variant.is_original:
+            return bytes(image_bytes)
+        return self.submit(image_bytes, variant).result(timeout)[0]
+
+    async def transcode(self, image_bytes, variant):
+        """Transcode without blocking the running event loop"""
+        if variant.is_original:
+            return bytes(image_bytes)
+        results = await asyncio.wrap_future(self.submit(image_bytes, variant))
+        return results[0]
+
+    async def transcode_many(self, image_bytes, *variants):
+        """Several variants of one image from a single decode"""
+        return await asyncio.wrap_future(self.submit(image_bytes, *variants))
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
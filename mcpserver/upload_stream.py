@@ -0,0 +1,234 @@
+"""
+Bounded-memory screenshot upload parsing.
+
+An upload used to be read with ``request.json``, split and base64-decoded in
+one go, holding several full copies of the image at once. These helpers read
+the request body in CHUNK_SIZE pieces and write the decoded image straight
+to a file instead:
+
+    read_json_upload  - the extension's {"id": ..., "screenshotData": "data:...;base64,..."}
+                        body; the data URL is unescaped and base64-decoded
+                        incrementally, other fields are returned as a dict
+    copy_stream       - raw image/png bodies and multipart file parts, which
+                        skip base64 altogether
+
+Memory per upload stays around one chunk whatever the image size.
+"""
+import base64
+import binascii
+import json
+import re
+
+CHUNK_SIZE = 64 * 1024
+# Fields other than the image are ids and such; refuse anything bigger
+MAX_FIELD_BYTES = 64 * 1024
+# The "data:image/png;base64" prefix of a data URL
+MAX_DATA_URL_HEADER = 256
+
+_SPECIAL = re.compile(rb'["\\]')
+_SCALAR_END = re.compile(rb'[,}\s]')
+_ESCAPES = {
+    ord('"'): b'"', ord('\\'): b'\\', ord('/'): b'/', ord('b'): b'\b',
+    ord('f'): b'\f', ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t',
+}
+_WHITESPACE = b' \t\r\n'
+
+
+def copy_stream(stream, out, chunk_size=CHUNK_SIZE):
+    """Copy a file-like object to ``out`` chunk by chunk; returns bytes copied"""
+    size = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return size
+        out.write(chunk)
+        size += len(chunk)
+
+
+class Base64Decoder:
+    """Decode base64 that arrives in arbitrarily split pieces"""
+
+    def __init__(self):
+        self._pending = b''
+
+    def feed(self, chunk):
+        data = self._pending + chunk.translate(None, _WHITESPACE)
+        usable = len(data) - len(data) % 4
+        self._pending = data[usable:]
+        try:
+            return base64.b64decode(data[:usable], validate=True)
+        except binascii.Error as e:
+            raise ValueError(f"Invalid base64 data: {e}")
+
+    def finish(self):
+        if self._pending:
+            raise ValueError("Truncated base64 data")
+        return b''
+
+
+class _DataUrlSink:
+    """Takes a data URL's characters and writes the decoded bytes to ``out``"""
+
+    def __init__(self, out):
+        self.out = out
+        self.header = b''
+        self.decoder = None
+        self.encoded = 0
+        self.size = 0
+
+    def __call__(self, piece):
+        if self.decoder is None:
+            self.header += piece
+            comma = self.header.find(b',')
+            if comma < 0:
+                if len(self.header) > MAX_DATA_URL_HEADER:
+                    raise ValueError("screenshotData is not a data URL")
+                return
+            self.header, piece = self.header[:comma], self.header[comma + 1:]
+            if not self.header.endswith(b';base64'):
+                raise ValueError("screenshotData must be a base64 data URL")
+            self.decoder = Base64Decoder()
+        self.encoded += len(piece)
+        self._write(self.decoder.feed(piece))
+
+    def _write(self, data):
+        if data:
+            self.out.write(data)
+            self.size += len(data)
+
+    def finish(self):
+        if self.decoder is None:
+            raise ValueError("screenshotData is not a data URL")
+        self._write(self.decoder.finish())
+
+
+class _Reader:
+    """Just enough of a streaming JSON reader for a flat object"""
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buf = b''
+        self.pos = 0
+
+    def _fill(self, needed=1):
+        """Make at least ``needed`` unread bytes available; False at EOF"""
+        while len(self.buf) - self.pos < needed:
+            chunk = self.stream.read(self.chunk_size)
+            if not chunk:
+                return False
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+        return True
+
+    def next_char(self):
+        """The next non-whitespace byte, without consuming it"""
+        while True:
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON body")
+            c = self.buf[self.pos]
+            if c not in _WHITESPACE:
+                return c
+            self.pos += 1
+
+    def expect(self, char):
+        if self.next_char() != ord(char):
+            raise ValueError(f"Expected {char!r} in JSON body")
+        self.pos += 1
+
+    def string(self, sink):
+        """Pass a string's unescaped UTF-8 bytes to ``sink`` in pieces"""
+        self.expect('"')
+        while True:
+            if not self._fill():
+                raise ValueError("Unterminated string in JSON body")
+            match = _SPECIAL.search(self.buf, self.pos)
+            end = match.start() if match else len(self.buf)
+            if end > self.pos:
+                sink(self.buf[self.pos:end])
+                self.pos = end
+            if match is None:
+                continue
+            if self.buf[self.pos] == ord('"'):
+                self.pos += 1
+                return
+            if not self._fill(2):
+                raise ValueError("Unterminated string in JSON body")
+            escape = self.buf[self.pos + 1]
+            if escape == ord('u'):
+                if not self._fill(6):
+                    raise ValueError("Unterminated string in JSON body")
+                code = self.buf[self.pos:self.pos + 6]
+                sink(json.loads(b'"' + code + b'"').encode('utf-8', 'surrogatepass'))
+                self.pos += 6
+            elif escape in _ESCAPES:
+                sink(_ESCAPES[escape])
+                self.pos += 2
+            else:
+                raise ValueError("Invalid escape in JSON body")
+
+    def small_string(self):
+        parts = []
+        size = 0
+
+        def collect(piece):
+            nonlocal size
+            size += len(piece)
+            if size > MAX_FIELD_BYTES:
+                raise ValueError("JSON field too large")
+            parts.append(piece)
+
+        self.string(collect)
+        return b''.join(parts).decode('utf-8', 'surrogatepass')
+
+    def scalar(self):
+        """A number, true, false or null"""
+        parts = []
+        size = 0
+        while self._fill():
+            match = _SCALAR_END.search(self.buf, self.pos)
+            end = match.start() if match else len(self.buf)
+            parts.append(self.buf[self.pos:end])
+            size += end - self.pos
+            self.pos = end
+            if match:
+                break
+            if size > MAX_FIELD_BYTES:
+                raise ValueError("JSON field too large")
+        return json.loads(b''.join(parts))
+
+
+def read_json_upload(stream, out, field='screenshotData', chunk_size=CHUNK_SIZE):
+    """Parse a JSON upload body, decoding the data URL in ``field`` into ``out``.
+
+    Returns (other fields, decoded bytes written, base64 characters read).
+    Raises ValueError for malformed bodies, including nested objects or
+    arrays, which no uploader sends.
+    """
+    reader = _Reader(stream, chunk_size)
+    sink = _DataUrlSink(out)
+    fields = {}
+    found = False
+    reader.expect('{')
+    if reader.next_char() == ord('}'):
+        raise ValueError(f"{field} is required")
+    while True:
+        key = reader.small_string()
+        reader.expect(':')
+        c = reader.next_char()
+        if key == field and c == ord('"'):
+            reader.string(sink)
+            sink.finish()
+            found = True
+        elif c == ord('"'):
+            fields[key] = reader.small_string()
+        elif c in b'{[':
+            raise ValueError(f"Unsupported nested value for {key!r}")
+        else:
+            fields[key] = reader.scalar()
+        if reader.next_char() == ord('}'):
+            break
+        reader.expect(',')
+    if not found:
+        raise ValueError(f"{field} is required")
+    return fields, sink.size, sink.encoded
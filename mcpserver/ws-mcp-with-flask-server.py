@@ -1,71 +1,191 @@
 import asyncio
 import websockets
 import json, base64
+import time
+import uuid
 from aiohttp import web
-from pathlib import Path
-import datetime
+from frames import decode_frame, hello_response
+from screenshot_store import FileStore
+from screenshot_writer import ScreenshotWriter
+from single_flight import SingleFlight
+from capture_scheduler import CaptureRejected, CaptureScheduler
+from transcoder import Transcoder, variant_from_args
+from loop_health import LoopMonitor, add_routes as add_debug_routes
+import metrics
+from metrics import TRACER
 
 
 clients = set()
 
-# This will map HTTP requests to futures waiting for a screenshot
-pending_futures = []
+# Capture id -> future waiting for that screenshot
+pending_futures = {}
+
+# Chrome rate-limits captureVisibleTab, so concurrent /screenshot callers share
+# one in-flight capture per browser; a capture that finished within the
+# window is served to late arrivals too
+CAPTURE_TIMEOUT = 5
+COALESCE_WINDOW = 0.25
+captures = SingleFlight(window=COALESCE_WINDOW)
+# Keeps each browser under Chrome's captureVisibleTab rate limit
+scheduler = CaptureScheduler(rate=2.0)
+
+# WebP/JPEG and resized variants are encoded in worker processes, off the loop
+transcoder = Transcoder()
+
+# Frames are written on a thread pool so disk I/O never blocks the loop
+writer = None
+
+# Loop lag and stalls go to /metrics; SIGUSR1/SIGUSR2 dump profiles. With
+# DEBUG_ENDPOINTS they can also be fetched from /debug/* (see loop_health.py)
+loop_monitor = LoopMonitor()
+DEBUG_ENDPOINTS = False
+
+def resolve_capture(data, image):
+    """Hand a screenshot (or the extension's error) to the request waiting for it"""
+    capture_id = data.get("id")
+    future = pending_futures.pop(capture_id, None)
+    if future is None and capture_id is None and image is not None and pending_futures:
+        # Older extension builds don't echo the id; answer the oldest request
+        future = pending_futures.pop(next(iter(pending_futures)))
+    if future is None or future.done():
+        return
+    if data.get("error"):
+        future.set_exception(RuntimeError(data["error"]))
+    elif image is not None:
+        future.set_result(image)
 
 async def ws_handler(ws):
     print("[WebSocket] Client connected")
     clients.add(ws)
     try:
         async for message in ws:
+            received_at = time.perf_counter()
+            if isinstance(message, bytes):
+                # Binary frame: JSON header + raw PNG bytes, no base64
+                try:
+                    header, payload = decode_frame(message)
+                except ValueError as e:
+                    print(f"[WebSocket] Invalid binary frame: {e}")
+                    continue
+                if header.get("action") == 'screenshot':
+                    metrics.record_payload(len(payload), "binary")
+                    if header.get("id") in pending_futures:
+                        TRACER.mark(header["id"], "received", received_at)
+                    if not header.get("error"):
+                        await writer.submit(payload)
+                    resolve_capture(header, payload)
+                continue
             data = json.loads(message)
-            if data.get("action") == 'screenshot':
+            if data.get("action") == "hello":
+                await ws.send(hello_response(data))
+            elif data.get("action") == 'screenshot':
                 data_url = data.get('dataUrl')
-                print("hello")
+                image = None
+                traced = data.get("id") in pending_futures
+                if traced:
+                    TRACER.mark(data["id"], "received", received_at)
                 if data_url:
+                    metrics.record_payload(len(data_url), "base64")
                     base64_data = data_url.split(",", 1)[1]
-                    latest_screenshot = base64.b64decode(base64_data)
-                    screenshots_dir = Path.home() / "Downloads" / "Webmcp" / "screenshots"
-                    screenshots_dir.mkdir(parents=True, exist_ok=True)
-                    filename = screenshots_dir / f"screenshot-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.png"
-                    with open(filename, "wb") as f:
-                        f.write(latest_screenshot)
-                    print(f"Saved screenshot as {filename}")
+                    image = base64.b64decode(base64_data)
+                    if traced:
+                        TRACER.mark(data["id"], "decoded")
+                    await writer.submit(image)
+                resolve_capture(data, image)
     finally:
         print("[WebSocket] Client disconnected")
         clients.remove(ws)
+        scheduler.remove(ws, "Extension disconnected")
+        captures.forget(ws)
 
 async def start_websocket_server():
     print("[Server] Starting WebSocket on ws://localhost:8765")
     async with websockets.serve(ws_handler, "localhost", 8765, max_size=10 * 1024 * 1024):
         await asyncio.Future()  # Run forever
 
+async def capture(ws):
+    """Ask one extension for a screenshot and wait for its bytes"""
+    capture_id = str(uuid.uuid4())
+    TRACER.mark(capture_id, "issued")
+    future = asyncio.get_running_loop().create_future()
+    pending_futures[capture_id] = future
+    outcome = "error"
+    try:
+        await scheduler.acquire(ws, deadline=time.monotonic() + CAPTURE_TIMEOUT)
+        await ws.send(json.dumps({ "action": "capture", "id": capture_id }))
+        TRACER.mark(capture_id, "sent")
+        sent_at = time.monotonic()
+        image = await asyncio.wait_for(future, timeout=CAPTURE_TIMEOUT)
+        scheduler.record(ws, time.monotonic() - sent_at)
+        outcome = "ok"
+        return image
+    except CaptureRejected:
+        outcome = "rejected"
+        raise
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+        raise
+    finally:
+        pending_futures.pop(capture_id, None)
+        TRACER.finish(capture_id, outcome)
+
 async def handle_screenshot_request(request):
+    """GET /screenshot[?format=webp|jpeg&width=N&quality=Q]"""
+    try:
+        variant = variant_from_args(request.query)
+    except ValueError as e:
+        return web.Response(text=str(e), status=400)
+    if not variant.is_original and not transcoder.available:
+        return web.Response(text="Transcoding needs Pillow: pip install pillow", status=501)
     if not clients:
         return web.Response(text="No extension connected", status=400)
 
-    # Send capture message to all clients
-    for ws in clients:
-        await ws.send(json.dumps({ "action": "capture" }))
-
-    # Wait for the screenshot
-    future = asyncio.get_event_loop().create_future()
-    pending_futures.append(future)
-
+    ws = next(iter(clients))
     try:
-        image_bytes = await asyncio.wait_for(future, timeout=5)
-        return web.Response(body=image_bytes, content_type="image/png")
+        image_bytes = await captures.run(ws, lambda: capture(ws))
+        body = await transcoder.transcode(image_bytes, variant)
+        return web.Response(body=body, content_type=variant.mime_type)
+    except CaptureRejected as e:
+        return web.Response(text=str(e), status=429)
+    except ConnectionError as e:
+        return web.Response(text=str(e), status=503)
     except asyncio.TimeoutError:
         return web.Response(text="Screenshot timed out", status=504)
+    except RuntimeError as e:
+        return web.Response(text=f"Screenshot failed: {e}", status=502)
+    except OSError as e:
+        # Pillow could not decode what the extension sent
+        return web.Response(text=f"Transcoding failed: {e}", status=502)
+
+async def handle_metrics(request):
+    return web.Response(body=metrics.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
 
 def start_http_server():
     app = web.Application()
     app.router.add_get("/screenshot", handle_screenshot_request)
+    app.router.add_get("/metrics", handle_metrics)
+    if DEBUG_ENDPOINTS:
+        add_debug_routes(app, loop_monitor)
     return app
 
 async def main():
-    await asyncio.gather(
-        start_websocket_server(),
-        web._run_app(start_http_server(), port=5001)
-    )
+    global writer
+    writer = ScreenshotWriter(FileStore())
+    await writer.start()
+    metrics.CONNECTED_CLIENTS.set_function(lambda: len(clients))
+    metrics.QUEUE_DEPTH.set_function(lambda: writer.backlog, queue="writer")
+    metrics.QUEUE_DEPTH.set_function(lambda: len(pending_futures), queue="pending_captures")
+    loop_monitor.start()
+    loop_monitor.install_signal_handlers()
+    try:
+        await asyncio.gather(
+            start_websocket_server(),
+            web._run_app(start_http_server(), port=5001)
+        )
+    finally:
+        loop_monitor.stop()
+        await writer.close()
+        transcoder.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,43 +1,138 @@
 import asyncio
 import websockets
 import json, base64
-from pathlib import Path
-import datetime
+import time
+from frames import decode_frame, hello_response
+from screenshot_store import ContentStore
+from archive_store import ArchiveStore
+from frame_index import FrameIndex
+from screenshot_writer import ScreenshotWriter
+from change_detector import AdaptiveInterval, ChangeDetector
+import metrics
+from loop_health import LoopMonitor
+from capture_scheduler import MONITORING, CaptureRejected, CaptureScheduler
+
+# Change detection: drop frames that barely differ from the last kept one and
+# capture less often while the page is static
+CHANGE_DETECTION = True
+CHANGE_THRESHOLD = 0.002  # share of 32x32 tiles that must change
+MIN_INTERVAL = 0.5
+MAX_INTERVAL = 30.0
+
+# Chrome allows about two captureVisibleTab calls per second per window
+CAPTURES_PER_SECOND = 2.0
+scheduler = CaptureScheduler(rate=CAPTURES_PER_SECOND)
+
+# 'content' keeps one file per distinct frame; 'archive' packs frames into
+# rolling segment files (see archive_store.py) and drops whole segments once
+# they are older than ARCHIVE_MAX_AGE or the archive exceeds ARCHIVE_MAX_BYTES
+STORAGE = 'content'
+ARCHIVE_MAX_AGE = 7 * 24 * 3600
+ARCHIVE_MAX_BYTES = 20 * 1024 ** 3
+
+# This server has no HTTP side; Prometheus scrapes a small standalone listener
+METRICS_PORT = 8767
 
 connected = set()
+
+# Frames are written on a thread pool so disk I/O never blocks the loop
+writer = None
+
 async def handler(ws):
     print("[Server] Client connected")
+    client_id = "%s:%s" % ws.remote_address[:2]
     connected.add(ws)
+    detector = None
+    interval = AdaptiveInterval(minimum=MIN_INTERVAL, maximum=MAX_INTERVAL)
+    if CHANGE_DETECTION:
+        try:
+            detector = ChangeDetector(min_changed_fraction=CHANGE_THRESHOLD)
+        except ImportError as e:
+            print(f"💡 {e}")
     try:
         async def send_capture():
             print("hello")
             while True:
-                await asyncio.sleep(2)
+                period = interval.current if detector else 2
+                await asyncio.sleep(period)
+                if writer.pressure >= 0.9:
+                    # Disk can't keep up; skip this tick rather than pile up frames
+                    print(f"[Server] Writer backlog {writer.backlog}, skipping capture")
+                    continue
+                try:
+                    # Monitoring captures are worthless once the next tick is due
+                    await scheduler.acquire(ws, MONITORING, deadline=time.monotonic() + period)
+                except CaptureRejected as e:
+                    print(f"[Server] Skipping capture: {e}")
+                    continue
                 await ws.send('{"action": "capture"}')
+        async def save_if_changed(image, message):
+            meta = {}
+            if detector:
+                # Decoding and diffing is CPU work; keep it off the loop
+                changed, boxes, fraction = await asyncio.to_thread(detector.compare, image)
+                interval.update(changed)
+                if not changed:
+                    return
+                meta['boxes'] = boxes
+            await writer.submit(image, client=client_id, tab=message.get('tabId'),
+                                tab_url=message.get('tabUrl'), tab_title=message.get('tabTitle'), **meta)
         async def receiveAndSave():
             async for message in ws:
+                if isinstance(message, bytes):
+                    # Binary frame: JSON header + raw PNG bytes, no base64
+                    try:
+                        header, payload = decode_frame(message)
+                    except ValueError as e:
+                        print(f"[Server] Invalid binary frame: {e}")
+                        continue
+                    metrics.record_payload(len(payload), 'binary')
+                    if header.get("error"):
+                        print(header.get('error'))
+                    else:
+                        await save_if_changed(payload, header)
+                    continue
                 data = json.loads(message)
-                if data.get("error"):
+                if data.get("action") == "hello":
+                    await ws.send(hello_response(data))
+                elif data.get("error"):
                     print(data.get('error'))
                 elif data.get("action") == 'screenshot':
                     dataUrl = data.get('dataUrl')
                     if dataUrl:
-                        data = dataUrl.split(",", 1)[1]
-                        screenshots_dir = Path("~/Downloads/Webmcp/screenshots").expanduser()
-                        screenshots_dir.mkdir(exist_ok=True)
-                        filename = f"screenshot-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.png"
-                        full_path = screenshots_dir / filename
-                        with open(full_path, "wb") as f:
-                            f.write(base64.b64decode(data))
-                        print(f"Saved screenshot as {filename}")
+                        metrics.record_payload(len(dataUrl), 'base64')
+                        await save_if_changed(base64.b64decode(dataUrl.split(",", 1)[1]), data)
         await asyncio.gather(send_capture(), receiveAndSave())
     finally:
         connected.remove(ws)
+        scheduler.remove(ws)
 
 
 async def main():
+    global writer
+    if STORAGE == 'archive':
+        store = ArchiveStore(max_age=ARCHIVE_MAX_AGE, max_bytes=ARCHIVE_MAX_BYTES)
+    else:
+        # The capture loop sees the same pixels over and over on static pages;
+        # the content-addressed store writes each distinct frame only once
+        store = ContentStore()
+    # Saved frames are indexed for lookups by time, tab and URL (frame_index.py)
+    writer = ScreenshotWriter(store, index=FrameIndex())
+    await writer.start()
+    metrics.CONNECTED_CLIENTS.set_function(lambda: len(connected))
+    metrics.QUEUE_DEPTH.set_function(lambda: writer.backlog, queue='writer')
+    metrics.serve_http(METRICS_PORT)
+    # Loop lag and stalls go to /metrics; SIGUSR1/SIGUSR2 dump profiles
+    loop_monitor = LoopMonitor()
+    loop_monitor.start()
+    loop_monitor.install_signal_handlers()
     print("[Server] Starting WebSocket server on ws://localhost:8765")
-    async with websockets.serve(handler, "localhost", 8765):
-        await asyncio.Future()
+    print(f"[Server] Metrics on http://localhost:{METRICS_PORT}/metrics")
+    try:
+        async with websockets.serve(handler, "localhost", 8765):
+            await asyncio.Future()
+    finally:
+        loop_monitor.stop()
+        await writer.close()
 
 asyncio.run(main())
\ No newline at end of file